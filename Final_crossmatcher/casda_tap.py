@@ -0,0 +1,287 @@
+import os
+import re
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import run_metrics
+from sky_separation import angular_separation, cone_filter, search_around
+
+# Import the centralized logger
+from logger_config import logger
+
+
+CASDA_TAP_URL = "https://casda.csiro.au/casda_vo_tools/tap"
+
+# Selavy continuum components and the catalogues they belong to
+COMPONENT_TABLE = "casda.continuum_component"
+CATALOGUE_TABLE = "casda.catalogue"
+
+# Name of the uploaded table of planet positions, referenced in ADQL as TAP_UPLOAD.<name>
+UPLOAD_TABLE_NAME = "planets"
+
+# Only the catalogues casda_util.casda_search downloads
+CATALOGUE_FILENAME_PATTERN = "%.cont.taylor.0.restored.conv.components.xml"
+
+# The same catalogues as a regular expression on the pubdat filenames
+CATALOGUE_FILENAME_REGEX = r'.*.cont.taylor.0.restored.conv.components.xml$'
+
+# Catalogues whose centres are within this many degrees of a planet cover it, as in casda_util.casda_search
+CATALOGUE_SEARCH_RADIUS = 3
+
+# Proper motion allowance of the cone radii, in years either side of the Gaia reference epoch
+PROPER_MOTION_YEARS = 15
+
+
+def cone_join_query(upload_name: str = UPLOAD_TABLE_NAME) -> str:
+    """ADQL joining the components to an uploaded table of cones, one cone per planet
+
+    Args:
+        upload_name (str, optional): name of the uploaded table, with 'pl_name', 'ra', 'dec' and
+            'radius' columns in degrees. Defaults to UPLOAD_TABLE_NAME.
+
+    Returns:
+        str: ADQL query returning every component inside any cone, with the planet name and the
+        filename of its catalogue
+    """
+    return (f"SELECT u.pl_name, cat.filename AS source_filename, c.* "
+            f"FROM {COMPONENT_TABLE} AS c "
+            f"JOIN {CATALOGUE_TABLE} AS cat ON c.catalogue_id = cat.id "
+            f"JOIN TAP_UPLOAD.{upload_name} AS u "
+            f"ON 1 = CONTAINS(POINT('ICRS', c.ra_deg_cont, c.dec_deg_cont), CIRCLE('ICRS', u.ra, u.dec, u.radius)) "
+            f"WHERE cat.filename LIKE '{CATALOGUE_FILENAME_PATTERN}'")
+
+
+class TapPlusClient:
+    """TAP client running queries with table uploads on a TAP service through astroquery"""
+
+    def __init__(self, url: str = CASDA_TAP_URL):
+        """
+        Args:
+            url (str, optional): TAP service url. Defaults to the CASDA TAP service.
+        """
+        # imported here so the local stand-in works without astroquery and astropy
+        from astroquery.utils.tap.core import TapPlus
+        self.tap = TapPlus(url=url)
+
+    def run(self, adql: str, upload: pd.DataFrame = None, upload_name: str = UPLOAD_TABLE_NAME) -> pd.DataFrame:
+        """Run an asynchronous query, uploading a table it can join against
+
+        Args:
+            adql (str): ADQL query
+            upload (pd.DataFrame, optional): table to upload. Defaults to None.
+            upload_name (str, optional): name of the uploaded table. Defaults to UPLOAD_TABLE_NAME.
+
+        Returns:
+            DataFrame: query results
+        """
+        if upload is None:
+            return self.tap.launch_job_async(adql).get_results().to_pandas()
+
+        from astropy.table import Table
+
+        upload_file, upload_path = tempfile.mkstemp(suffix=".xml")
+        os.close(upload_file)
+        try:
+            Table.from_pandas(upload).write(upload_path, format='votable', overwrite=True)
+            job = self.tap.launch_job_async(adql, upload_resource=upload_path, upload_table_name=upload_name)
+            return job.get_results().to_pandas()
+        finally:
+            os.remove(upload_path)
+
+
+class LocalTapClient:
+    """Local stand-in for the CASDA TAP service holding components in memory. It only understands
+    the cone join of 'cone_join_query', which it evaluates with sky_separation.search_around."""
+
+    def __init__(self, components: pd.DataFrame):
+        """
+        Args:
+            components (pd.DataFrame): components with 'ra_deg_cont', 'dec_deg_cont' and
+                'source_filename', e.g. parsed from downloaded catalogues
+        """
+        self.components = components.reset_index(drop=True)
+        self.queries = []
+
+    def run(self, adql: str, upload: pd.DataFrame = None, upload_name: str = UPLOAD_TABLE_NAME) -> pd.DataFrame:
+        """Evaluate the cone join of an uploaded table of cones
+
+        Args:
+            adql (str): ADQL query built by 'cone_join_query'
+            upload (pd.DataFrame): cones with 'pl_name', 'ra', 'dec' and 'radius' in degrees
+            upload_name (str, optional): name of the uploaded table. Defaults to UPLOAD_TABLE_NAME.
+
+        Returns:
+            DataFrame: components inside each cone, with the planet name
+        """
+        if upload is None or f"TAP_UPLOAD.{upload_name}" not in adql or "CONTAINS" not in adql:
+            raise ValueError("LocalTapClient only runs cone joins against an uploaded table")
+        self.queries.append(adql)
+
+        pattern = re.search(r"LIKE '([^']*)'", adql)
+        components = self.components
+        if pattern:
+            filename_regex = re.escape(pattern.group(1)).replace('%', '.*')
+            components = components[components['source_filename'].str.fullmatch(filename_regex)].reset_index(drop=True)
+
+        # a single search at the largest radius, then each pair is held to the radius of its own cone
+        radius = upload['radius'].to_numpy(dtype=np.float64)
+        upload_index, component_index, separation = search_around(upload['ra'].to_numpy(dtype=np.float64),
+                                                                  upload['dec'].to_numpy(dtype=np.float64),
+                                                                  components['ra_deg_cont'].to_numpy(dtype=np.float64),
+                                                                  components['dec_deg_cont'].to_numpy(dtype=np.float64),
+                                                                  radius.max() if len(radius) else 0)
+        inside = separation <= radius[upload_index]
+
+        results = components.iloc[component_index[inside]].reset_index(drop=True)
+        results.insert(0, 'pl_name', upload['pl_name'].to_numpy()[upload_index[inside]])
+
+        return results
+
+
+def planet_cones(planets: pd.DataFrame, search_radius: float,
+                 proper_motion_years: float = PROPER_MOTION_YEARS) -> pd.DataFrame:
+    """Table of cones to upload, widened by how far each planet can move through proper motion
+
+    Args:
+        planets (pd.DataFrame): planets with 'pl_name', 'ra', 'dec' and optionally 'sy_pmra'/'sy_pmdec' in mas/yr
+        search_radius (float): crossmatch radius in arcseconds
+        proper_motion_years (float, optional): years of proper motion allowed for. Defaults to PROPER_MOTION_YEARS.
+
+    Returns:
+        DataFrame: 'pl_name', 'ra', 'dec' and 'radius', all angles in degrees
+    """
+    total_proper_motion = np.zeros(len(planets))
+    if 'sy_pmra' in planets and 'sy_pmdec' in planets:
+        total_proper_motion = np.nan_to_num(np.hypot(planets['sy_pmra'].to_numpy(dtype=np.float64),
+                                                     planets['sy_pmdec'].to_numpy(dtype=np.float64)))
+
+    radius = (search_radius + total_proper_motion / 1000 * proper_motion_years) / 3600
+
+    return pd.DataFrame({'pl_name': planets['pl_name'].to_numpy(),
+                         'ra': planets['ra'].to_numpy(dtype=np.float64),
+                         'dec': planets['dec'].to_numpy(dtype=np.float64),
+                         'radius': radius})
+
+
+def cone_search_planets(planets: pd.DataFrame, search_radius: float, client=None, batch_size: int = 500,
+                        proper_motion_years: float = PROPER_MOTION_YEARS) -> pd.DataFrame:
+    """Fetch only the components near each planet with server-side cone queries, many planets at once
+
+    Args:
+        planets (pd.DataFrame): planets with 'pl_name', 'ra', 'dec' and proper motions
+        search_radius (float | list): crossmatch radius in arcseconds, or radii of a sweep
+        client (optional): TAP client with a 'run(adql, upload, upload_name)' method. Defaults to a
+            TapPlusClient of the CASDA TAP service.
+        batch_size (int, optional): number of planets uploaded per query. Defaults to 500.
+        proper_motion_years (float, optional): years of proper motion allowed for. Defaults to PROPER_MOTION_YEARS.
+
+    Returns:
+        DataFrame: components near each planet, with 'pl_name' and 'source_filename'
+    """
+    if client is None:
+        client = TapPlusClient()
+
+    cones = planet_cones(planets, float(np.max(search_radius)), proper_motion_years)
+    adql = cone_join_query()
+
+    result_dfs = []
+    for start in range(0, len(cones), batch_size):
+        batch = cones.iloc[start:start + batch_size]
+        results = client.run(adql, upload=batch, upload_name=UPLOAD_TABLE_NAME)
+        run_metrics.increment('tap_queries')
+        run_metrics.increment('tap_components', len(results))
+        run_metrics.increment('tap_bytes', int(results.memory_usage(deep=True).sum()))
+        result_dfs.append(results)
+
+    if not result_dfs:
+        return pd.DataFrame(columns=['pl_name', 'source_filename', 'ra_deg_cont', 'dec_deg_cont'])
+
+    components = pd.concat(result_dfs, ignore_index=True)
+    logger.info(f"TAP cone queries returned {len(components)} components for {len(cones)} planets "
+                f"in {-(-len(cones) // batch_size)} queries")
+
+    return components
+
+
+def closest_catalogue_centre(pubdat: pd.DataFrame, source_ra: float, source_dec: float) -> str:
+    """Catalogue whose centre is closest to a planet, among those within CATALOGUE_SEARCH_RADIUS
+
+    Args:
+        pubdat (pd.DataFrame): CASDA public data table with 'filename', 's_ra' and 's_dec'
+        source_ra (float): planet right ascension in degrees
+        source_dec (float): planet declination in degrees
+
+    Returns:
+        str: catalogue filename, or None if no catalogue covers the planet
+    """
+    catalogues = pubdat[pubdat['filename'].str.contains(CATALOGUE_FILENAME_REGEX, regex=True)]
+    matches, seps = cone_filter(source_ra, source_dec, catalogues['s_ra'].to_numpy(dtype=np.float64),
+                                catalogues['s_dec'].to_numpy(dtype=np.float64), CATALOGUE_SEARCH_RADIUS)
+    if len(matches) == 0:
+        return None
+
+    return catalogues['filename'].iloc[matches[int(np.argmin(seps))]]
+
+
+def closest_catalogue(components: pd.DataFrame, planet_name: str, source_ra: float, source_dec: float,
+                      pubdat: pd.DataFrame = None) -> str:
+    """Catalogue of the component closest to a planet, the TAP counterpart of
+    casda_util.casda_search_closest_catalogue
+
+    Args:
+        components (pd.DataFrame): components from 'cone_search_planets'
+        planet_name (str): planet name as in 'pl_name'
+        source_ra (float): planet right ascension in degrees
+        source_dec (float): planet declination in degrees
+        pubdat (pd.DataFrame, optional): public data table, for planets without a fetched component
+            the catalogue with the closest centre is used (see 'closest_catalogue_centre'). Defaults to None.
+
+    Returns:
+        str: catalogue filename, or None if there are no components near the planet and no catalogue covers it
+    """
+    planet_components = components[components['pl_name'] == planet_name]
+    if planet_components.empty:
+        # the cones only reach a few arcseconds, a planet without a detection is still covered by its catalogues
+        return None if pubdat is None else closest_catalogue_centre(pubdat, source_ra, source_dec)
+
+    seps = angular_separation(source_ra, source_dec, planet_components['ra_deg_cont'].to_numpy(dtype=np.float64),
+                              planet_components['dec_deg_cont'].to_numpy(dtype=np.float64))
+
+    return planet_components['source_filename'].iloc[int(np.argmin(seps))]
+
+
+def planet_matches(components: pd.DataFrame, planet_name: str, source_ra: float, source_dec: float,
+                   search_radius: float = 3, output_filename: str = 'matches') -> pd.DataFrame:
+    """Matches of a proper motion corrected planet among its fetched components, saved like the
+    outputs of casda_util.casda_search so crossmatching runs unchanged
+
+    Args:
+        components (pd.DataFrame): components from 'cone_search_planets'
+        planet_name (str): planet name as in 'pl_name'
+        source_ra (float): corrected planet right ascension in degrees
+        source_dec (float): corrected planet declination in degrees
+        search_radius (float | list): crossmatch radius in arcseconds, the largest is used for a sweep. Defaults to 3.
+        output_filename (str, optional): name of the output csv files. Defaults to 'matches'.
+
+    Returns:
+        DataFrame: components within the search radius, empty if the planet has no fetched components
+    """
+    CASDA_CSV_DOWNLOAD_PATH = os.path.join(os.path.dirname(__file__), "casda_csv_downloads\\")
+    CASDA_MATCHES_PATH      = os.path.join(os.path.dirname(__file__), "casda_matches\\")
+
+    # a planet without fetched components still gets its (empty) csv files, like a search without matches
+    planet_components = components[components['pl_name'] == planet_name].drop(columns='pl_name')
+
+    os.makedirs(CASDA_CSV_DOWNLOAD_PATH, exist_ok=True)
+    planet_components.to_csv(CASDA_CSV_DOWNLOAD_PATH + output_filename + ".csv")
+
+    seps = angular_separation(source_ra, source_dec, planet_components['ra_deg_cont'].to_numpy(dtype=np.float64),
+                              planet_components['dec_deg_cont'].to_numpy(dtype=np.float64)) * 3600 # arcseconds
+    matches = planet_components[seps < float(np.max(search_radius))]
+
+    os.makedirs(CASDA_MATCHES_PATH, exist_ok=True)
+    matches.to_csv(CASDA_MATCHES_PATH + output_filename + ".csv", index=False)
+
+    return matches
@@ -6,8 +6,15 @@ from astropy.table import Table
 from astroquery.casda import Casda
 from astroquery.utils.tap.core import TapPlus
 from astropy.io.votable import parse
-from astropy.coordinates import SkyCoord
-import astropy.units as un
+
+import run_metrics
+import pubdat_index
+from catalogue_cache import catalogue_cache
+from compact_schema import compact_catalogue
+from sky_separation import angular_separation, cone_filter, sweep_radii
+
+# End of a complete VOTable, a download that was cut off part way lacks it
+VOTABLE_END = b'</VOTABLE>'
 
 # Import the centralized logger
 from logger_config import logger
@@ -28,6 +35,172 @@ def convert_xml_to_pandas(xml_file_name: str):
     return bill.to_pandas()
 
 
+def load_catalogue(xml_file_name: str) -> pd.DataFrame:
+    """Parse a selavy catalogue keeping only the columns the pipeline uses, in compact dtypes
+    (see compact_schema.CATALOGUE_COLUMNS)
+
+    Args:
+        xml_file_name (str): Name of XML File to be converted
+
+    Returns:
+        DataFrame: compact catalogue
+    """
+    return compact_catalogue(convert_xml_to_pandas(xml_file_name))
+
+
+def catalogue_filename(xml_file: str) -> str:
+    """Filename of a downloaded catalogue, as stored in the 'source_filename' column
+
+    Args:
+        xml_file (str): path of the catalogue xml file
+
+    Returns:
+        str: filename without the download directory
+    """
+    return xml_file.split("\\")[-1]
+
+
+def iter_catalogue_blocks(xml_filelist: list):
+    """Yield the parsed catalogues of a source one file at a time, for consumers that reduce each
+    catalogue on its own and never need them assembled
+
+    Args:
+        xml_filelist (list): paths of the catalogue xml files
+
+    Yields:
+        filename (str): catalogue filename
+        catalogue_df (DataFrame): parsed catalogue, shared with the catalogue cache so must not be modified in place
+    """
+    # catalogues missing from the catalogue cache are parsed together by the catalogue parser pool,
+    # catalogues that cannot be parsed were deleted by the parser and are left out
+    for xml_file, catalogue_df in zip(xml_filelist, catalogue_cache.get_many(xml_filelist)):
+        if catalogue_df is not None:
+            yield catalogue_filename(xml_file), catalogue_df
+
+
+def empty_catalogue() -> pd.DataFrame:
+    """Assembled catalogue without components, for sources none of whose catalogues could be read"""
+    return pd.DataFrame({'ra_deg_cont': pd.Series(dtype=np.float64), 'dec_deg_cont': pd.Series(dtype=np.float64),
+                         'source_filename': pd.Categorical([])})
+
+
+def assemble_catalogues(xml_filelist: list) -> pd.DataFrame:
+    """Concatenate the catalogues of a source in a single copy, in the order of the file list.
+    The filename of each component is stored as a categorical, i.e. as a file index into the
+    list of catalogue filenames rather than as a repeated string.
+
+    Args:
+        xml_filelist (list): paths of the catalogue xml files
+
+    Returns:
+        DataFrame: components of all catalogues with 'source_filename'
+    """
+    blocks = list(iter_catalogue_blocks(xml_filelist))
+    if not blocks:
+        return empty_catalogue()
+    filenames, catalogue_dfs = zip(*blocks)
+
+    # the cached catalogues are only read here, concat copies each of them once into the result
+    catalogue_dfs_assembled = pd.concat(catalogue_dfs, ignore_index=True)
+
+    categories = list(dict.fromkeys(filenames))
+    file_index = np.repeat(np.array([categories.index(filename) for filename in filenames], dtype=np.int32),
+                           [len(catalogue_df) for catalogue_df in catalogue_dfs])
+    catalogue_dfs_assembled['source_filename'] = pd.Categorical.from_codes(file_index, categories=categories)
+
+    return catalogue_dfs_assembled
+
+
+def stream_catalogue_matches(xml_filelist: list, source_ra: float, source_dec: float, search_radius: float,
+                             csv_path: str) -> tuple:
+    """Components of a source's catalogues within the search radius, reading one catalogue at a time.
+    Each catalogue is appended to the csv of all components and reduced to its matches before the
+    next is read, so memory is bounded by the largest catalogue rather than by the whole field.
+    The csv is the same as the one written from 'assemble_catalogues'.
+
+    Args:
+        xml_filelist (list): paths of the catalogue xml files
+        source_ra (float): source right ascension in degrees
+        source_dec (float): source declination in degrees
+        search_radius (float): search radius in arcseconds
+        csv_path (str): path of the csv of all components
+
+    Returns:
+        matches (DataFrame): components within the search radius, indexed by their row in the csv
+        match_seps (NDArray[float64]): separation of each match from the source in arcseconds
+    """
+    match_dfs = []
+    match_seps = []
+    n_rows = 0
+    header = True
+    for filename, catalogue_df in iter_catalogue_blocks(xml_filelist):
+        catalogue_df = catalogue_df.assign(source_filename=filename)
+        catalogue_df.index = pd.RangeIndex(n_rows, n_rows + len(catalogue_df))
+        catalogue_df.to_csv(csv_path, mode='w' if header else 'a', header=header)
+        header = False
+        n_rows += len(catalogue_df)
+
+        seps = angular_separation(source_ra, source_dec, catalogue_df['ra_deg_cont'].to_numpy(dtype=np.float64),
+                                  catalogue_df['dec_deg_cont'].to_numpy(dtype=np.float64)) * 3600 # arcseconds
+        within = seps < search_radius
+        match_dfs.append(catalogue_df[within])
+        match_seps.append(seps[within])
+
+    if not match_dfs:
+        empty_catalogue().to_csv(csv_path)
+        return empty_catalogue(), np.array([], dtype=np.float64)
+
+    matches = pd.concat(match_dfs)
+    matches['source_filename'] = matches['source_filename'].astype('category')
+
+    return matches, np.concatenate(match_seps)
+
+
+def assembled_catalogue_matches(xml_filelist: list, source_ra: float, source_dec: float, search_radius: float,
+                                csv_path: str, debug: bool = False) -> tuple:
+    """Components of a source's catalogues within the search radius, from all catalogues assembled
+    in memory (see 'assemble_catalogues'). The assembled catalogues are saved to a csv.
+
+    Args:
+        xml_filelist (list): paths of the catalogue xml files
+        source_ra (float): source right ascension in degrees
+        source_dec (float): source declination in degrees
+        search_radius (float): search radius in arcseconds
+        csv_path (str): path of the csv of all components
+        debug (bool, optional): log the assembled catalogues and the closest components. Defaults to False.
+
+    Returns:
+        matches (DataFrame): components within the search radius, indexed by their row in the csv
+        match_seps (NDArray[float64]): separation of each match from the source in arcseconds
+    """
+    # components stay in catalogue order, the matching below does not depend on it
+    catalogue_dfs = assemble_catalogues(xml_filelist)
+
+    catalogue_dfs.to_csv(csv_path)
+
+    if debug:
+        logger.info(f"saving catalogue_dfs to filepath: {csv_path}")
+        logger.info(f"catalogue_dfs: \n {catalogue_dfs}")
+
+    catalogue_ra = catalogue_dfs['ra_deg_cont'].to_numpy(dtype=np.float64)
+    catalogue_dec = catalogue_dfs['dec_deg_cont'].to_numpy(dtype=np.float64)
+    seps = angular_separation(source_ra, source_dec, catalogue_ra, catalogue_dec) * 3600 # arcseconds
+
+    if debug:
+        sorted_indices = seps.argsort()
+        logger.info("10 lowest separations (arcsecs) bwtween target source and catalogue source in arcseconds:")
+        for i in range(len(seps)):
+            index = sorted_indices[i]
+            sep = seps[index]
+            logger.info(f"({i + 1:02d}): Separation (arcsecs): {sep:<20}, from catalogue source (ra, dec) in deg: ({catalogue_ra[index]}, {catalogue_dec[index]}), with filename: {catalogue_dfs['source_filename'].iloc[index]}")   
+            if i > 10:
+                break
+
+    matches_indices = np.where(seps < search_radius)[0]
+
+    return catalogue_dfs.iloc[matches_indices], seps[matches_indices]
+
+
 def check_casda_cache() -> bool:
     '''
     Checks if pubdat cache (casda_cache\\pubdat-YYYY-MM-DD.csv) already exists        
@@ -71,6 +244,127 @@ def pandas_to_csv(output_filename: str, download_path: str, dataframe: pd.DataFr
     dataframe.to_csv(output_path, index=False) # NOTE: index=False tells panda to not create row index column
 
 
+def catalogue_complete(xml_path: str) -> bool:
+    """Whether a downloaded catalogue ends like a complete VOTable, a cheap check against downloads
+    that were cut off part way
+
+    Args:
+        xml_path (str): path of the catalogue xml file
+
+    Returns:
+        bool: True if the end of the VOTable is in the last bytes of the file
+    """
+    try:
+        with open(xml_path, 'rb') as f:
+            f.seek(max(os.path.getsize(xml_path) - 1024, 0))
+            return VOTABLE_END in f.read()
+    except OSError:
+        return False
+
+
+def split_cached_catalogues(matching_files, download_path: str):
+    """Split catalogue filenames into those already in the download directory and those to be staged.
+    Incomplete catalogues in the download directory are deleted and staged again.
+
+    Args:
+        matching_files (ArrayLike): catalogue filenames from pubdat
+        download_path (str): directory catalogues are downloaded to
+
+    Returns:
+        cached_xml_files (list): paths of the catalogues already downloaded
+        files_to_stage (list): filenames of the catalogues that still need staging
+    """
+    cached_xml_files = []
+    files_to_stage = []
+    for mfile in matching_files:
+        xml_path = os.path.join(download_path, mfile)
+        if os.path.isfile(xml_path) and not catalogue_complete(xml_path):
+            logger.error(f"Cached catalogue {xml_path} is incomplete, deleting it to download it again")
+            run_metrics.increment('catalogues_unreadable')
+            os.remove(xml_path)
+        if os.path.isfile(xml_path):
+            cached_xml_files.append(xml_path)
+        else:
+            files_to_stage.append(mfile)
+
+    return cached_xml_files, files_to_stage
+
+
+def fetch_catalogues(casda: Casda, catalogues: pd.DataFrame, staging_manager=None, disk_cache=None,
+                     debug: bool = False) -> list:
+    """Stage and download catalogues that are not in the download directory yet, the fetch step of
+    'casda_search' and 'casda_search_closest_catalogue'
+
+    Args:
+        casda (Casda): logged in casda instance
+        catalogues (pd.DataFrame): rows of the public data table with 'filename' and 'access_url'
+        staging_manager (StagingManager, optional): persistent manager of the staging jobs. Defaults to None.
+        disk_cache (DiskCacheManager, optional): size-bounded manager of the xml download directory. Defaults to None.
+        debug (bool, optional): log the cached catalogues and staged urls. Defaults to False.
+
+    Returns:
+        list: paths of the downloaded catalogues, None if the download failed
+    """
+    CASDA_XML_DOWNLOAD_PATH = os.path.join(os.path.dirname(__file__), "casda_xml_downloads\\")
+    # downloads land here and are only moved into the download directory once complete
+    CASDA_XML_PARTIAL_PATH = os.path.join(os.path.dirname(__file__), "casda_xml_partial\\")
+
+    # Catalogues already in the download directory are reused instead of being staged again
+    cached_xml_files, files_to_stage = split_cached_catalogues(catalogues['filename'].unique(), CASDA_XML_DOWNLOAD_PATH)
+
+    if debug:
+        logger.info(f"catalogues already downloaded: \n {cached_xml_files}")
+
+    # This part stages the files you want to download so it sometimes takes a minute
+    url_list = []
+    if staging_manager is not None:
+        # staging jobs are journalled and may already have been submitted in the background
+        url_list = staging_manager.stage(catalogues[catalogues['filename'].isin(files_to_stage)])
+    else:
+        for mfile in files_to_stage:
+            urls = casda.stage_data(Table.from_pandas(catalogues[catalogues['filename'] == mfile]), verbose=debug)
+            url_list.extend(url for url in urls if url not in url_list)
+
+    # filter through checksum files
+    url_list = [url for url in url_list if 'checksum' not in url]
+
+    if debug:
+        logger.info(f"url_list: \n {url_list}")
+        logger.info("Begin XML file download:")
+
+    os.makedirs(CASDA_XML_DOWNLOAD_PATH, exist_ok=True)
+    os.makedirs(CASDA_XML_PARTIAL_PATH, exist_ok=True)
+    try:
+        partial_files = casda.download_files(url_list, savedir=CASDA_XML_PARTIAL_PATH) if url_list else []
+    except Exception as e:
+        logger.error(e)
+        # whatever was written is incomplete
+        delete_directory_contents(CASDA_XML_PARTIAL_PATH)
+        # the staged urls may have expired, so stage these catalogues again next time
+        if staging_manager is not None:
+            staging_manager.invalidate(files_to_stage)
+        return None
+
+    # a completed download is renamed into place, so the download directory never holds a partial file
+    downloaded_files = []
+    for partial_file in partial_files:
+        downloaded_file = os.path.join(CASDA_XML_DOWNLOAD_PATH, os.path.basename(partial_file))
+        os.replace(partial_file, downloaded_file)
+        downloaded_files.append(downloaded_file)
+    xml_filelist = cached_xml_files + downloaded_files
+
+    # staging and download volume, used by run_planner to project the cost of future runs
+    run_metrics.increment('catalogues_staged', len(files_to_stage))
+    run_metrics.increment('download_bytes', sum(os.path.getsize(f) for f in downloaded_files if os.path.isfile(f)))
+
+    # keep the catalogues of this source in the size-bounded download cache
+    if disk_cache is not None:
+        disk_cache.touch(xml_filelist)
+        disk_cache.enforce(pinned=xml_filelist)
+
+    return xml_filelist
+
+
 def delete_directory_contents(directory_path: str) -> None:
     """Helper file to clear files in cache folder
 
@@ -140,12 +434,16 @@ def get_public_data_table(refresh:bool=False) -> Table:
     cache_filenames_path = CACHE_FOLDER + cache_filename + ".txt"
     public_data_df.to_csv(cache_path, index=False)
     public_data_df['filename'].to_csv(cache_filenames_path)
+
+    # the index of the previous snapshot is stale
+    pubdat_index.load_pubdat_index.cache_clear()
     
     return public_data_df
 
 
 def casda_search_closest_catalogue(source_ra: float, source_dec: float, casda: Casda = None, 
-                                   refresh:bool=False, debug:bool=False) -> str:
+                                   refresh:bool=False, debug:bool=False, disk_cache=None,
+                                   staging_manager=None) -> str:
     """
     Finds catalogue file corresponding to closest match to source
 
@@ -154,16 +452,16 @@ def casda_search_closest_catalogue(source_ra: float, source_dec: float, casda: C
         source_dec (float): source declination
         casda (Casda): casda instance
         debug (bool) = False : print debug information
+        disk_cache (DiskCacheManager, optional): size-bounded manager of the xml download directory
+        staging_manager (StagingManager, optional): persistent manager of the staging jobs
     Returns:
         closest_catalogue_filename (str): filename of the closest source match catalogue
     """
     
-    CASDA_XML_DOWNLOAD_PATH = os.path.join(os.path.dirname(__file__), "casda_xml_downloads\\")
-    TARGET_SOURCE_COORDS    = SkyCoord(ra = source_ra * un.deg, dec = source_dec * un.deg)
-    CATALOGUE_SEARCH_RADIUS = 3 * un.deg # based on CASDA uncertainty
+    CATALOGUE_SEARCH_RADIUS = 3 # degrees, based on CASDA uncertainty
 
     if debug:
-        logger.info(f"Target source {TARGET_SOURCE_COORDS}")
+        logger.info(f"Target source (ra, dec) in deg: ({source_ra}, {source_dec})")
 
     '''
     CASDA login and setup
@@ -191,88 +489,49 @@ def casda_search_closest_catalogue(source_ra: float, source_dec: float, casda: C
         logger.info(f"reduced pubdat files retrieved: \n {reduced_pubdat['filename']}")
     
     # Get the centre coordsof all of the continuum catalogues in the table
-    center_coords = SkyCoord(np.array(reduced_pubdat['s_ra']) * un.deg, 
-                             np.array(reduced_pubdat['s_dec']) * un.deg)
+    center_ra = reduced_pubdat['s_ra'].to_numpy(dtype=np.float64)
+    center_dec = reduced_pubdat['s_dec'].to_numpy(dtype=np.float64)
     # find which files in pubdat have center coordinates within catalogue_search_radius of source
-    seps = TARGET_SOURCE_COORDS.separation(center_coords).to('arcsecond') 
-    matches = np.where(seps < CATALOGUE_SEARCH_RADIUS.to('arcsecond') )[0]
+    matches, seps = cone_filter(source_ra, source_dec, center_ra, center_dec, CATALOGUE_SEARCH_RADIUS)
     matching_files = np.array(reduced_pubdat.iloc[matches]['filename'])
 
     if debug:
         logger.info(f"matching indices: {matches}")
         logger.info("matching separations between target source and catalogue center coordinates in deg:")
-        for i in matches:
-            # Access separation, center coordinate, and matching filename
-            sep_deg = seps[i].degree
-            center_coord = center_coords[i]
+        for i, sep_deg in zip(matches, seps):
+            # Access matching filename
             filename = reduced_pubdat.iloc[i]['filename']
             
             # Print information
-            logger.info(f"({i:02d}): sep (deg): {sep_deg:<20}, from catalogue center (ra, dec) in deg: ({center_coord.ra.value}, {center_coord.dec.value}); Matching filename: {filename}")
+            logger.info(f"({i:02d}): sep (deg): {sep_deg:<20}, from catalogue center (ra, dec) in deg: ({center_ra[i]}, {center_dec[i]}); Matching filename: {filename}")
 
         logger.info(f"matching_files: \n {matching_files}")
         logger.info("Starting file download staging")
 
-    # This part stages the files you want to download so it sometimes takes a minute
-    url_list = []
-    for mfile in matching_files:
-        pdata = reduced_pubdat[reduced_pubdat['filename'] == mfile]
-        ptable = Table.from_pandas(pdata)
-        urls = casda.stage_data(ptable, verbose=debug)
-        for url in urls:
-            if url not in url_list:
-                url_list.append(url)
-
-    # filter through checksum files
-    url_list = list(filter(lambda url: 'checksum' not in url, url_list))
-
-    if debug:
-        logger.info(f"url_list: \n {url_list}")
-        logger.info("Begin XML file download:")
-
-    # ensure xml download directory exists
-    if not os.path.exists(CASDA_XML_DOWNLOAD_PATH):
-        os.makedirs(CASDA_XML_DOWNLOAD_PATH)
-
-    # file download
-    try:
-        xml_filelist = casda.download_files(url_list, savedir=CASDA_XML_DOWNLOAD_PATH)
-    except Exception as e:
-        logger.error(e)
-        return None 
+    xml_filelist = fetch_catalogues(casda, reduced_pubdat[reduced_pubdat['filename'].isin(matching_files)],
+                                    staging_manager=staging_manager, disk_cache=disk_cache, debug=debug)
 
     '''
     Searching for planet through xml dataset
     '''
-    catalogue_dfs = pd.DataFrame()
-    for xml_file in xml_filelist:
-        catalogue_df = convert_xml_to_pandas(xml_file)
-        try:
-            filename = xml_file.split("\\")[-1]
-        except IndexError:
-            filename = ""
-        catalogue_df['source_filename'] = filename
-        catalogue_dfs = pd.concat([catalogue_dfs, catalogue_df], ignore_index=True)
-
-    if not url_list:
+    if not xml_filelist:
         return None
 
-    catalogue_dfs = catalogue_dfs.sort_values(by=['ra_deg_cont', 'dec_deg_cont'])
-
-    if debug:
-        logger.info(f"catalogue_dfs: \n {catalogue_dfs}")
-        
-    catalogue_coords = SkyCoord(ra = np.array(catalogue_dfs['ra_deg_cont']) * un.deg,
-                                dec = np.array(catalogue_dfs['dec_deg_cont']) * un.deg)
-    
-    seps = TARGET_SOURCE_COORDS.separation(catalogue_coords).to('arcsecond') 
-
-    # return closest match
+    # only the closest component of each catalogue is needed, so the catalogues are never assembled
     closest_catalogue_filename = None
-    sorted_indices = seps.argsort()
+    closest_sep = np.inf
+    for filename, catalogue_df in iter_catalogue_blocks(xml_filelist):
+        if catalogue_df.empty:
+            continue
+
+        if debug:
+            logger.info(f"catalogue {filename}: \n {catalogue_df}")
 
-    first_index = sorted_indices[0]
-    closest_catalogue_filename = catalogue_dfs['source_filename'][first_index]
+        seps = angular_separation(source_ra, source_dec, catalogue_df['ra_deg_cont'].to_numpy(dtype=np.float64),
+                                  catalogue_df['dec_deg_cont'].to_numpy(dtype=np.float64)) * 3600 # arcseconds
+        if seps.min() < closest_sep:
+            closest_sep = seps.min()
+            closest_catalogue_filename = filename
 
     if debug:
         logger.info(f"closest source match catalogue: {closest_catalogue_filename}")
@@ -290,51 +549,45 @@ def extract_epoch_from_pubdat_catalogue(filename: str) -> float:
         epoch (float): time of matching file from pubdat to be used for proper motion correction 
     or returns None
     """
-    CACHE_FOLDER = os.path.join(os.path.dirname(__file__), "casda_cache\\")
-    pubdat_csv_filepath = None
-
-    for cache_filename in os.listdir(CACHE_FOLDER):
-        if ".csv" in cache_filename:
-            pubdat_csv_filepath = cache_filename
-            break
-
-    if pubdat_csv_filepath:
-        pubdat_df = pd.read_csv(CACHE_FOLDER + "\\" + pubdat_csv_filepath)
-        filtered_rows = pubdat_df[pubdat_df['filename'] == filename]
-        t_max_values = filtered_rows['t_max']
-        epoch = t_max_values.values[0]
-        return epoch
-    
-    return None
+    if not check_casda_cache():
+        return None
+
+    # a dictionary lookup in the index built once per process, rather than reading the table per planet
+    return pubdat_index.load_pubdat_index().epoch(filename)
     
 
 def casda_search(source_ra: float, source_dec: float, search_radius: float =3, output_filename: str='matches',
-                 casda = None, refresh=False, debug=False) -> pd.DataFrame:
+                 casda = None, refresh=False, debug=False, disk_cache=None, staging_manager=None,
+                 streaming=False) -> pd.DataFrame:
     """
     Generate csv of matches of given source with CASDA continuum catalogues
 
     Args:
         source_ra (float): source right ascension
         source_dec (float): source declination
-        search_radius (float): search radius in ARCSECONDS
+        search_radius (float | list): search radius in ARCSECONDS. If a list of radii is given the
+            candidates are found once at the largest radius and the match counts for every radius
+            are saved to <output_filename>_sweep.csv
         casda (Casda): casda instance
         # output_filename (str): filename of output csv [i.e. <output_filename>.csv]
         # debug (booolean) = False : print debug information
+        disk_cache (DiskCacheManager, optional): size-bounded manager of the xml download directory
+        staging_manager (StagingManager, optional): persistent manager of the staging jobs
+        streaming (bool, optional): read the catalogues one at a time instead of assembling them (see 'stream_catalogue_matches')
     """
     
     CASDA_CSV_DOWNLOAD_PATH = os.path.join(os.path.dirname(__file__), "casda_csv_downloads\\")
-    CASDA_XML_DOWNLOAD_PATH = os.path.join(os.path.dirname(__file__), "casda_xml_downloads\\")
     CASDA_MATCHES_PATH      = os.path.join(os.path.dirname(__file__), "casda_matches\\")
-    TARGET_SOURCE_COORDS    = SkyCoord(ra = source_ra * un.deg, dec = source_dec * un.deg)
-    CATALOGUE_SEARCH_RADIUS = 3 * un.deg # based on CASDA uncertainty
-    SEARCH_RADIUS           = search_radius * un.arcsecond
+    CATALOGUE_SEARCH_RADIUS = 3 # degrees, based on CASDA uncertainty
+    SEARCH_RADII            = np.atleast_1d(np.asarray(search_radius, dtype=np.float64)) # arcseconds
+    SEARCH_RADIUS           = SEARCH_RADII.max() # arcseconds
 
     # colored text
     TYELLOW = "\033[1;33m"
     TRESET = "\033[m"
 
     if debug:
-        logger.info(f"Target source {TARGET_SOURCE_COORDS}")
+        logger.info(f"Target source (ra, dec) in deg: ({source_ra}, {source_dec})")
 
     '''
     CASDA login and setup
@@ -362,104 +615,59 @@ def casda_search(source_ra: float, source_dec: float, search_radius: float =3, o
         logger.info(f"reduced pubdat files retrieved: \n {reduced_pubdat['filename']}")
     
     # Get the centre coordsof all of the continuum catalogues in the table
-    center_coords = SkyCoord(np.array(reduced_pubdat['s_ra'])*un.deg, 
-                             np.array(reduced_pubdat['s_dec'])*un.deg)
+    center_ra = reduced_pubdat['s_ra'].to_numpy(dtype=np.float64)
+    center_dec = reduced_pubdat['s_dec'].to_numpy(dtype=np.float64)
     # find which files in pubdat have center coordinates within catalogue_search_radius of source
-    seps = TARGET_SOURCE_COORDS.separation(center_coords).to('arcsecond') 
-    matches = np.where(seps < CATALOGUE_SEARCH_RADIUS.to('arcsecond') )[0]
+    matches, seps = cone_filter(source_ra, source_dec, center_ra, center_dec, CATALOGUE_SEARCH_RADIUS)
     matching_files = np.array(reduced_pubdat.iloc[matches]['filename'])
 
 
     if debug:
         logger.info(f"matching indices: {matches}")
         logger.info("matching separations between target source and catalogue center coordinates in deg:")
-        for i in matches:
-            # Access separation, center coordinate, and matching filename
-            sep_deg = seps[i].degree
-            center_coord = center_coords[i]
+        for i, sep_deg in zip(matches, seps):
+            # Access matching filename
             filename = reduced_pubdat.iloc[i]['filename']
             
             # Print information
-            logger.info(f"({i:02d}): sep (deg): {sep_deg:<20}, from catalogue center (ra, dec) in deg: ({center_coord.ra.value}, {center_coord.dec.value}); Matching filename: {filename}")
+            logger.info(f"({i:02d}): sep (deg): {sep_deg:<20}, from catalogue center (ra, dec) in deg: ({center_ra[i]}, {center_dec[i]}); Matching filename: {filename}")
 
         logger.info(f"matching_files: \n {matching_files}")
         logger.info("Starting file download staging")
 
-    # This part stages the files you want to download so it sometimes takes a minute
-    url_list = []
-    for mfile in matching_files:
-        pdata = reduced_pubdat[reduced_pubdat['filename'] == mfile]
-        ptable = Table.from_pandas(pdata)
-        urls = casda.stage_data(ptable, verbose=debug)
-        for url in urls:
-            if url not in url_list:
-                url_list.append(url)
-
-    # filter through checksum files
-    url_list = list(filter(lambda url: 'checksum' not in url, url_list))
-
-    if debug:
-        logger.info(f"url_list: \n {url_list}")
-
-    # ensure xml download directory exists
-    if not os.path.exists(CASDA_XML_DOWNLOAD_PATH):
-        os.makedirs(CASDA_XML_DOWNLOAD_PATH)
-    
-    if debug:
-        logger.info("Begin XML file download:")
-
-    # file download
-    try:
-        xml_filelist = casda.download_files(url_list, savedir=CASDA_XML_DOWNLOAD_PATH)
-    except Exception as e:
-        logger.error(e)
-        return None
+    xml_filelist = fetch_catalogues(casda, reduced_pubdat[reduced_pubdat['filename'].isin(matching_files)],
+                                    staging_manager=staging_manager, disk_cache=disk_cache, debug=debug)
     
     '''
     Searching for planet through xml dataset
     '''
-    catalogue_dfs = pd.DataFrame()
-    for xml_file in xml_filelist:
-        catalogue_df = convert_xml_to_pandas(xml_file)
-        try:
-            filename = xml_file.split("\\")[-1]
-        except IndexError:
-            filename = ""
-        catalogue_df['source_filename'] = filename
-        catalogue_dfs = pd.concat([catalogue_dfs, catalogue_df], ignore_index=True)
-
     # ensure csv download directory exists
     if not os.path.exists(CASDA_CSV_DOWNLOAD_PATH):
         os.makedirs(CASDA_CSV_DOWNLOAD_PATH)
 
-    if not url_list:
+    if not xml_filelist:
         return None
-    
-    catalogue_dfs = catalogue_dfs.sort_values(by=['ra_deg_cont', 'dec_deg_cont'])
 
-    catalogue_dfs.to_csv(CASDA_CSV_DOWNLOAD_PATH + output_filename + ".csv")
+    if streaming:
+        matches, match_seps = stream_catalogue_matches(xml_filelist, source_ra, source_dec, SEARCH_RADIUS,
+                                                       CASDA_CSV_DOWNLOAD_PATH + output_filename + ".csv")
+        if debug:
+            logger.info(f"streamed {len(xml_filelist)} catalogues to filepath: {CASDA_CSV_DOWNLOAD_PATH + output_filename}.csv")
+    else:
+        matches, match_seps = assembled_catalogue_matches(xml_filelist, source_ra, source_dec, SEARCH_RADIUS,
+                                                          CASDA_CSV_DOWNLOAD_PATH + output_filename + ".csv", debug)
 
-    if debug:
-        logger.info(f"saving catalogue_dfs to filepath: {CASDA_CSV_DOWNLOAD_PATH + output_filename}"+".csv")
-        logger.info(f"catalogue_dfs: \n {catalogue_dfs}")
-        
-    catalogue_coords = SkyCoord(ra = np.array(catalogue_dfs['ra_deg_cont']) * un.deg,
-                                dec = np.array(catalogue_dfs['dec_deg_cont']) * un.deg)
-    seps = TARGET_SOURCE_COORDS.separation(catalogue_coords).to('arcsecond') 
+    # radius sweep: matches at every radius from the single search at the largest radius
+    if len(SEARCH_RADII) > 1:
+        sweep_order, sweep_counts = sweep_radii(match_seps, SEARCH_RADII)
+        matches = matches.iloc[sweep_order].assign(separation_arcsec=match_seps[sweep_order])
+        sweep_summary = pd.DataFrame({'search_radius': SEARCH_RADII, 'n_matches': sweep_counts})
 
-    if debug:
-        sorted_indices = seps.argsort()
-        logger.info("10 lowest separations (arcsecs) bwtween target source and catalogue source in arcseconds:")
-        for i in range(len(seps)):
-            index = sorted_indices[i]
-            sep = seps[index]
-            catalogue_coord = catalogue_coords[index]
-            logger.info(f"({i + 1:02d}): Separation (arcsecs): {sep.arcsecond:<20}, from catalogue source (ra, dec) in deg: ({catalogue_coord.ra.value}, {catalogue_coord.dec.value}), with filename: {catalogue_dfs['source_filename'][index]}")   
-            if i > 10:
-                break
+        if debug:
+            logger.info(f"radius sweep match counts: \n {sweep_summary}")
 
-    matches_indices = np.where(seps < SEARCH_RADIUS)[0]
-    matches = catalogue_dfs.iloc[matches_indices]
+        os.makedirs(CASDA_MATCHES_PATH, exist_ok=True)
+        sweep_summary.to_csv(CASDA_MATCHES_PATH + output_filename + "_sweep.csv", index=False)
 
     if debug:
         logger.info(f"final matches with all casda ({type(matches)}): \n {matches}")
@@ -477,6 +685,8 @@ def casda_search(source_ra: float, source_dec: float, search_radius: float =3, o
     return matches
 
 if __name__ == "__main__":
+    from logger_config import setup_logger
+    setup_logger()
     
     # username = input("Enter CASDA username:")
     # casda = Casda()
@@ -0,0 +1,213 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import run_metrics
+
+# Import the centralized logger
+from logger_config import logger
+
+
+# Default memory budget of the catalogue cache (1 GB)
+DEFAULT_MAX_BYTES = 1024 ** 3
+
+
+class CatalogueCache:
+    """In-process cache of parsed CASDA catalogues, keyed by catalogue filename.
+
+    Catalogues are held as DataFrames of column arrays. When the total size of the
+    cached catalogues exceeds the memory budget the least recently used catalogues
+    are evicted.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        Args:
+            max_bytes (int, optional): memory budget of the cache in bytes. Defaults to DEFAULT_MAX_BYTES.
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._catalogues = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._catalogues)
+
+    def __contains__(self, xml_file: str) -> bool:
+        return os.path.basename(xml_file) in self._catalogues
+
+    def get(self, xml_file: str, loader=None) -> pd.DataFrame:
+        """Return the parsed catalogue for an xml file, parsing it on a cache miss
+
+        Args:
+            xml_file (str): path of the catalogue xml file
+            loader (Callable, optional): function converting the xml file to a DataFrame.
+                Defaults to casda_util.load_catalogue.
+
+        Returns:
+            DataFrame: parsed catalogue. This is shared with the cache so must not be modified in place.
+        """
+        key = os.path.basename(xml_file)
+
+        if key in self._catalogues:
+            self._catalogues.move_to_end(key)
+            self.hits += 1
+            run_metrics.increment('catalogue_cache_hits')
+            return self._catalogues[key][0]
+
+        self.misses += 1
+        run_metrics.increment('catalogue_cache_misses')
+
+        if loader is None:
+            # imported here as casda_util imports this module
+            from casda_util import load_catalogue
+            loader = load_catalogue
+
+        catalogue_df = loader(xml_file)
+        self.put(key, catalogue_df)
+        return catalogue_df
+
+    def get_many(self, xml_files: list, parse_many=None) -> list:
+        """Return the parsed catalogues for several xml files, parsing all cache misses in one batch
+
+        Args:
+            xml_files (list): paths of the catalogue xml files
+            parse_many (Callable, optional): function converting a list of xml files to a list of
+                DataFrames in the same order. Defaults to catalogue_parser.catalogue_parser.parse.
+
+        Returns:
+            list: parsed catalogues in the order of 'xml_files', None for catalogues that could not be
+            parsed. These are shared with the cache so must not be modified in place.
+        """
+        catalogue_dfs = {}
+        missing = []
+        for xml_file in xml_files:
+            key = os.path.basename(xml_file)
+            if key in self._catalogues:
+                self._catalogues.move_to_end(key)
+                self.hits += 1
+                run_metrics.increment('catalogue_cache_hits')
+                catalogue_dfs[key] = self._catalogues[key][0]
+            elif key not in catalogue_dfs and xml_file not in missing:
+                missing.append(xml_file)
+
+        self.misses += len(missing)
+        run_metrics.increment('catalogue_cache_misses', len(missing))
+
+        if missing:
+            if parse_many is None:
+                from catalogue_parser import catalogue_parser
+                parse_many = catalogue_parser.parse
+
+            for xml_file, catalogue_df in zip(missing, parse_many(missing)):
+                key = os.path.basename(xml_file)
+                if catalogue_df is not None:
+                    self.put(key, catalogue_df)
+                catalogue_dfs[key] = catalogue_df
+
+        return [catalogue_dfs[os.path.basename(xml_file)] for xml_file in xml_files]
+
+    def put(self, key: str, catalogue_df: pd.DataFrame) -> None:
+        """Add a parsed catalogue to the cache and evict catalogues until the cache is within budget
+
+        Args:
+            key (str): catalogue filename
+            catalogue_df (pd.DataFrame): parsed catalogue
+        """
+        if key in self._catalogues:
+            self.current_bytes -= self._catalogues.pop(key)[1]
+
+        nbytes = int(catalogue_df.memory_usage(index=True, deep=True).sum())
+
+        # A catalogue larger than the whole budget is never cached
+        if nbytes > self.max_bytes:
+            logger.info(f"Catalogue {key} ({nbytes} bytes) exceeds the catalogue cache budget, not cached")
+            return
+
+        self._catalogues[key] = (catalogue_df, nbytes)
+        self.current_bytes += nbytes
+
+        while self.current_bytes > self.max_bytes:
+            evicted_key, (_, evicted_bytes) = self._catalogues.popitem(last=False)
+            self.current_bytes -= evicted_bytes
+            self.evictions += 1
+            run_metrics.increment('catalogue_cache_evictions')
+            logger.info(f"Evicted catalogue {evicted_key} from catalogue cache")
+
+        run_metrics.record('catalogue_cache_bytes', self.current_bytes)
+
+    def clear(self) -> None:
+        """Remove all catalogues from the cache, keeping the counters"""
+        self._catalogues.clear()
+        self.current_bytes = 0
+
+    def stats(self) -> dict:
+        """Return the cache counters
+
+        Returns:
+            dict: hits, misses, evictions, number of cached catalogues and cached bytes
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'catalogues': len(self._catalogues),
+                'bytes': self.current_bytes}
+
+
+# Shared cache used by casda_util
+catalogue_cache = CatalogueCache()
+
+
+def hilbert_index(ra, dec, order: int = 16) -> np.ndarray:
+    """Position of sky coordinates along a Hilbert curve over the (ra, dec) plane
+
+    Args:
+        ra (ArrayLike): right ascension in degrees
+        dec (ArrayLike): declination in degrees
+        order (int, optional): number of bits per axis of the curve. Defaults to 16.
+
+    Returns:
+        NDArray[int64]: Hilbert curve index of each coordinate
+    """
+    n = 1 << order
+    x = np.clip((np.mod(np.asarray(ra, dtype=np.float64), 360) / 360 * n).astype(np.int64), 0, n - 1)
+    y = np.clip(((np.asarray(dec, dtype=np.float64) + 90) / 180 * n).astype(np.int64), 0, n - 1)
+    d = np.zeros(x.shape, dtype=np.int64)
+
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+
+        # rotate the quadrant so the curve stays continuous
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        swap = ~ry
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s >>= 1
+
+    return d
+
+
+def sort_by_sky_curve(source_list: pd.DataFrame, ra_column: str = 'ra', dec_column: str = 'dec',
+                      order: int = 16) -> pd.DataFrame:
+    """Order a planet list along a Hilbert curve over the sky so that planets in the same
+    CASDA fields are processed one after the other, raising the catalogue cache hit rate
+
+    Args:
+        source_list (pd.DataFrame): list of planets
+        ra_column (str, optional): name of the right ascension column. Defaults to 'ra'.
+        dec_column (str, optional): name of the declination column. Defaults to 'dec'.
+        order (int, optional): number of bits per axis of the curve. Defaults to 16.
+
+    Returns:
+        DataFrame: the planet list reordered along the curve
+    """
+    curve_index = hilbert_index(source_list[ra_column].values, source_list[dec_column].values, order)
+    return source_list.iloc[np.argsort(curve_index, kind='stable')]
@@ -0,0 +1,223 @@
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
+from xml.parsers.expat import ExpatError
+
+import numpy as np
+import pandas as pd
+
+import run_metrics
+
+# Import the centralized logger
+from logger_config import logger
+
+
+# Numeric columns are laid out in the shared memory block on this boundary
+COLUMN_ALIGNMENT = 8
+
+# Errors of a catalogue that is not a readable VOTable, astropy raises its VOTable errors as ValueError
+PARSE_ERRORS = (ValueError, ExpatError)
+
+# Windows frees a shared memory block as soon as the worker closes its handle, before the
+# main process could attach to it, so there the columns are returned pickled instead
+USE_SHARED_MEMORY = os.name != 'nt'
+
+
+def parse_to_shared_memory(xml_file: str) -> dict:
+    """Parse a catalogue in a worker process and publish its numeric columns in a shared memory block.
+    String and categorical columns are small once compacted and are returned pickled.
+
+    Args:
+        xml_file (str): path of the catalogue xml file
+
+    Returns:
+        dict: 'n_rows', 'columns' (name, kind, payload) in catalogue order, and 'block', the name of
+        the shared memory block that the main process reads and unlinks (None if there is none)
+    """
+    # imported here so the heavy VOTable parsing stack is only loaded in the workers that use it
+    from casda_util import load_catalogue
+
+    catalogue_df = load_catalogue(xml_file)
+    numeric = [column for column in catalogue_df.columns
+               if isinstance(catalogue_df[column].dtype, np.dtype) and catalogue_df[column].dtype.kind in 'biuf']
+
+    if not USE_SHARED_MEMORY or not numeric or catalogue_df.empty:
+        return {'n_rows': len(catalogue_df), 'block': None,
+                'columns': [(column, 'pickled', pickle.dumps(catalogue_df[column].reset_index(drop=True), protocol=pickle.HIGHEST_PROTOCOL))
+                            for column in catalogue_df.columns]}
+
+    layout = {}
+    offset = 0
+    for column in numeric:
+        array = catalogue_df[column].to_numpy()
+        layout[column] = (array.dtype.str, offset)
+        offset += -(-array.nbytes // COLUMN_ALIGNMENT) * COLUMN_ALIGNMENT
+
+    block = shared_memory.SharedMemory(create=True, size=offset)
+    try:
+        for column in numeric:
+            dtype, start = layout[column]
+            array = catalogue_df[column].to_numpy()
+            np.ndarray(array.shape, dtype=dtype, buffer=block.buf, offset=start)[:] = array
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+
+    # the main process unlinks the block, so the worker's resource tracker must not remove it first
+    resource_tracker.unregister(block._name, 'shared_memory')
+    block.close()
+
+    columns = [(column, 'shared', layout[column]) if column in layout
+               else (column, 'pickled', pickle.dumps(catalogue_df[column].reset_index(drop=True), protocol=pickle.HIGHEST_PROTOCOL))
+               for column in catalogue_df.columns]
+
+    return {'n_rows': len(catalogue_df), 'block': block.name, 'columns': columns}
+
+
+def discard_unreadable(xml_file: str, error: Exception) -> None:
+    """Delete a catalogue that cannot be parsed, e.g. a download that was cut off, so the next
+    fetch stages and downloads it again instead of failing on it in every run
+
+    Args:
+        xml_file (str): path of the catalogue xml file
+        error (Exception): parse error
+    """
+    logger.error(f"Catalogue {xml_file} could not be parsed and is deleted, it is downloaded again when next needed. Reason: {error}")
+    run_metrics.increment('catalogues_unreadable')
+    try:
+        os.remove(xml_file)
+    except OSError as e:
+        logger.error(f"Failed to delete {xml_file}. Reason: {e}")
+
+
+def read_shared_catalogue(parsed: dict) -> pd.DataFrame:
+    """Rebuild a catalogue published by 'parse_to_shared_memory' and release its shared memory block
+
+    Args:
+        parsed (dict): result of 'parse_to_shared_memory'
+
+    Returns:
+        DataFrame: the parsed catalogue
+    """
+    block = shared_memory.SharedMemory(name=parsed['block']) if parsed['block'] is not None else None
+    try:
+        columns = {}
+        for column, kind, payload in parsed['columns']:
+            if kind == 'shared':
+                dtype, start = payload
+                columns[column] = np.ndarray(parsed['n_rows'], dtype=dtype, buffer=block.buf, offset=start).copy()
+            else:
+                columns[column] = pickle.loads(payload)
+    finally:
+        if block is not None:
+            block.close()
+            block.unlink()
+
+    return pd.DataFrame(columns)
+
+
+class CatalogueParser:
+    """Process pool parsing CASDA catalogues in parallel.
+
+    The pool is started on first use and kept for the whole run, so the worker start-up and the
+    import of the parsing stack in each worker are only paid once. Catalogues are returned in the
+    order they were requested, whichever worker finishes first.
+    """
+
+    def __init__(self, max_workers: int = None):
+        """
+        Args:
+            max_workers (int, optional): number of worker processes, 0 or 1 parses in this process.
+                Defaults to the number of cores available to this process.
+        """
+        if max_workers is None:
+            max_workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        self.max_workers = max_workers
+        self.executor = None
+
+    def parse(self, xml_files: list) -> list:
+        """Parse catalogues, in parallel when there is more than one
+
+        Args:
+            xml_files (list): paths of the catalogue xml files
+
+        Returns:
+            list: parsed catalogues in the order of 'xml_files', None for catalogues that could not be
+            parsed (these are deleted, see 'discard_unreadable')
+        """
+        if len(xml_files) <= 1 or self.max_workers <= 1:
+            return [self.parse_in_process(xml_file) for xml_file in xml_files]
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            logger.info(f"Started catalogue parser pool with {self.max_workers} workers")
+
+        # results are read in submission order, and every block is read (and so released) even if another parse failed
+        catalogue_dfs = []
+        crashed = []
+        try:
+            futures = [self.executor.submit(parse_to_shared_memory, xml_file) for xml_file in xml_files]
+        except BrokenProcessPool:
+            futures = []
+            crashed = list(range(len(xml_files)))
+            catalogue_dfs = [None] * len(xml_files)
+        for position, (xml_file, future) in enumerate(zip(xml_files, futures)):
+            try:
+                catalogue_dfs.append(read_shared_catalogue(future.result()))
+            except BrokenProcessPool:
+                # a worker died (e.g. killed for memory), the catalogues are fine and are parsed again
+                crashed.append(position)
+                catalogue_dfs.append(None)
+            except PARSE_ERRORS as e:
+                discard_unreadable(xml_file, e)
+                catalogue_dfs.append(None)
+            except OSError as e:
+                logger.error(f"Catalogue {xml_file} could not be read. Reason: {e}")
+                catalogue_dfs.append(None)
+
+        run_metrics.increment('catalogues_parsed_in_pool', sum(catalogue_df is not None for catalogue_df in catalogue_dfs))
+
+        if crashed:
+            # the broken pool is dropped, the next parse starts a new one
+            logger.error(f"Catalogue parser pool broke, parsing {len(crashed)} catalogues in this process instead")
+            run_metrics.increment('catalogue_parser_pool_restarts')
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+            for position in crashed:
+                catalogue_dfs[position] = self.parse_in_process(xml_files[position])
+
+        return catalogue_dfs
+
+    def parse_in_process(self, xml_file: str) -> pd.DataFrame:
+        """Parse a catalogue in this process
+
+        Args:
+            xml_file (str): path of the catalogue xml file
+
+        Returns:
+            DataFrame: the parsed catalogue, None if it could not be parsed (it is then deleted,
+            see 'discard_unreadable') or read
+        """
+        from casda_util import load_catalogue
+
+        try:
+            return load_catalogue(xml_file)
+        except PARSE_ERRORS as e:
+            discard_unreadable(xml_file, e)
+        except OSError as e:
+            logger.error(f"Catalogue {xml_file} could not be read. Reason: {e}")
+
+        return None
+
+    def close(self) -> None:
+        """Shut the pool down, it is started again on the next parse"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+
+# Shared parser used by casda_util, sized by main
+catalogue_parser = CatalogueParser()
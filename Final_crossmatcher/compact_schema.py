@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+
+
+# Selavy component columns used by the pipeline, with the narrowest dtype that keeps their precision.
+# Positions stay float64 (float32 only resolves ~0.1 arcsec at RA 360 deg), uncertainties, fluxes and
+# beam sizes are measured to a few significant figures so float32 is enough. Filenames repeat on every
+# component of a catalogue and are stored as categoricals. Component and island identifiers are unique
+# per row, where a dictionary gains nothing, so they stay strings.
+CATALOGUE_COLUMNS = {
+    'island_id': object,
+    'component_id': object,
+    'component_name': object,
+    'ra_deg_cont': np.float64,
+    'dec_deg_cont': np.float64,
+    'ra_err': np.float32,
+    'dec_err': np.float32,
+    'flux_peak': np.float32,
+    'flux_peak_err': np.float32,
+    'flux_int': np.float32,
+    'flux_int_err': np.float32,
+    'maj_axis': np.float32,
+    'min_axis': np.float32,
+    'pos_ang': np.float32,
+    'rms_image': np.float32,
+    'spectral_index': np.float32,
+    'has_siblings': np.int8,
+    'source_filename': 'category',
+}
+
+# NASA Exoplanet Archive columns narrowed once the sample is selected. Positions stay float64 as above,
+# proper motions in mas/yr and the planet parameters are quoted to far fewer digits than float32 holds.
+SOURCE_COLUMNS = {
+    'hostname': 'category',
+    'sy_pmra': np.float32,
+    'sy_pmraerr1': np.float32,
+    'sy_pmdec': np.float32,
+    'sy_pmdecerr1': np.float32,
+    'sy_dist': np.float32,
+    'pl_orbper': np.float32,
+    'pl_massj': np.float32,
+}
+
+# Only needed to select the sample (see sample_selection.GAIA_DR2_CRITERIA), the HTML references are
+# the widest strings of the source table
+SELECTION_ONLY_COLUMNS = ['sy_refname']
+
+
+def compact_catalogue(catalogue_df: pd.DataFrame) -> pd.DataFrame:
+    """Keep the used selavy columns of a catalogue with the dtypes of CATALOGUE_COLUMNS
+
+    Args:
+        catalogue_df (pd.DataFrame): parsed selavy components
+
+    Returns:
+        DataFrame: the columns of CATALOGUE_COLUMNS present in the catalogue, in their compact dtypes
+    """
+    columns = [column for column in CATALOGUE_COLUMNS if column in catalogue_df]
+    dtypes = {column: CATALOGUE_COLUMNS[column] for column in columns}
+    if 'has_siblings' in dtypes and catalogue_df['has_siblings'].isna().any():
+        # missing flags cannot be held by an integer column
+        dtypes['has_siblings'] = np.float32
+
+    return catalogue_df[columns].astype(dtypes)
+
+
+def read_catalogue_csv(filename: str) -> pd.DataFrame:
+    """Read the used columns of a saved catalogue csv straight into their compact dtypes
+
+    Args:
+        filename (str): csv written by casda_util.casda_search or casda_tap.planet_matches
+
+    Returns:
+        DataFrame: the columns of CATALOGUE_COLUMNS present in the csv
+    """
+    header = pd.read_csv(filename, nrows=0).columns
+    dtypes = {column: dtype for column, dtype in CATALOGUE_COLUMNS.items() if column in header}
+    # has_siblings is read as a float so missing flags do not fail the read
+    if 'has_siblings' in dtypes:
+        dtypes['has_siblings'] = np.float32
+
+    return pd.read_csv(filename, usecols=list(dtypes), dtype=dtypes)[list(dtypes)]
+
+
+def compact_sources(source_list: pd.DataFrame) -> pd.DataFrame:
+    """Narrow the dtypes of a selected source list and drop the columns only used for selecting it
+
+    Args:
+        source_list (pd.DataFrame): planets from nasa_ingest.load_source_table after sample selection
+
+    Returns:
+        DataFrame: the source list with the dtypes of SOURCE_COLUMNS
+    """
+    source_list = source_list.drop(columns=[column for column in SELECTION_ONLY_COLUMNS if column in source_list])
+
+    return source_list.astype({column: dtype for column, dtype in SOURCE_COLUMNS.items() if column in source_list})
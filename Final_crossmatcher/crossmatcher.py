@@ -1,14 +1,22 @@
+import numpy as np
 import pandas as pd
-from astropy.coordinates import SkyCoord 
-from astropy import units as u 
-from astropy.coordinates import search_around_sky
+from astropy.time import Time
 
-import logging
-from logging.handlers import RotatingFileHandler
+import nasa_ingest
+import result_store
+from compact_schema import read_catalogue_csv
+from sky_separation import search_around, sweep_radii
 
 # Import the centralized logger
 from logger_config import logger
 
+# Gaia DR2 reference epoch J2015.5 as MJD, the epoch the NASA proper motions are propagated from
+GAIA_DR2_EPOCH_MJD = 57205.875
+
+# Per-axis positional uncertainty in arcseconds of a faint component (5 sigma in a 15 arcsec beam, with the
+# 0.5 arcsec catalogue systematic), the largest a candidate can have before its catalogue is read
+FAINT_COMPONENT_SIGMA = float(np.hypot(0.5 * 15 / 5, 0.5))
+
 def find_planets_in_source(source: str):
     """Find all planets in a source file (i.e. remove duplicate planets from the source list)
 
@@ -20,25 +28,21 @@ def find_planets_in_source(source: str):
         source_list_sorted (DataFrame): filtered version of 'source' which contains 
         only one instance of each planet, the one with the most recent row update
     """
-    # Read the source list and filter for unique planets
-    source_list = pd.read_csv(source).drop_duplicates(subset = ['ra'])
-    
-    # Ensure 'rowupdate' is a datetime type
-    source_list['rowupdate'] = pd.to_datetime(source_list['rowupdate'], format = "%d/%m/%Y")
-    
-    # proxima cen b test
-    # source_list['rowupdate'] = pd.to_datetime(source_list['rowupdate'], format = "%Y-%m-%d")
+    # Read the pipeline columns of the source list (cached after the first run)
+    source_list = nasa_ingest.load_source_table(source)
 
     # Sort by 'rowupdate' in descending order
     data_sorted = source_list.sort_values('rowupdate', ascending = False)
 
-    # Drop duplicates keeping the first entry which is the newest
-    source_list_sorted = data_sorted.drop_duplicates(subset = ['ra'])
+    # Drop duplicates keeping the first entry which is the newest. Planets of one host share its
+    # coordinates, so they are told apart by name and grouped again by host_groups
+    source_list_sorted = data_sorted.drop_duplicates(subset = ['pl_name'])
 
     return source_list_sorted
 
 
-def crossmatch(filename: str, source_list:str, search_radius:float, planet_name:str=None):
+def crossmatch(filename: str, source_list:str, search_radius:float, planet_name:str=None,
+               casda_catalogue: pd.DataFrame = None):
     """Compare coordinates from a CASDA sourcelist against the NASA database 
     to see if any files with the same position match. 
     
@@ -49,16 +53,18 @@ def crossmatch(filename: str, source_list:str, search_radius:float, planet_name:
         source_list (str): filename of the NASA list of sources to be crossmatched
         search_radius (float): search radius around each source (will be converted to arcseconds)
         planet_name (str, optional): Name of the planet to be matched. Defaults to None.
+        casda_catalogue (pd.DataFrame, optional): the CASDA catalogue if already read from 'filename'. Defaults to None.
 
     Returns:
         _type_: _description_
         idx (NDArray[Any]): indexes that match in the Source Catalog
         idx_to_crossmatch (NDArray[Any]): Indices in Catalog to crossmatch that 
             correspond with the same element of 'idx'
-        d2d1 (Angle | Any): on-sky separation between the coordinates.
+        d2d1 (NDArray[float64]): on-sky separation between the coordinates in arcseconds.
     """
     # Load catalogue data for the planet
-    casda_catalogue = pd.read_csv(filename)
+    if casda_catalogue is None:
+        casda_catalogue = read_catalogue_csv(filename)
     # print(casda_catalogue.head()[["ra_deg_cont", "dec_deg_cont"]])
 
     source_list_sorted = pd.read_csv(source_list)
@@ -66,45 +72,304 @@ def crossmatch(filename: str, source_list:str, search_radius:float, planet_name:
     if planet_name is not None:
         source_list_sorted = source_list_sorted[source_list_sorted['pl_name'] == planet_name]
     
-    # SkyCoord objects for CASDA catalogue and sourcelist
-    casda_catalog_coords = SkyCoord(ra = casda_catalogue['ra_deg_cont'].values,
-                                    dec = casda_catalogue['dec_deg_cont'].values, 
-                                    unit = "deg")
-    
-    sources_catalog_coords = SkyCoord(ra = source_list_sorted['ra_corrected'], 
-                                      dec = source_list_sorted['dec_corrected'], 
-                                      unit = "deg")
-
-    # Search radius for crossmatching in arcseconds
-    search_radius_arcsecond = search_radius * u.arcsecond
+    # Search radius for crossmatching in degrees
+    search_radius_degree = search_radius / 3600
 
-    # Perform crossmatching
-    idx, idx_to_crossmatch, d2d1, _ = search_around_sky(casda_catalog_coords, sources_catalog_coords, seplimit = search_radius_arcsecond)
+    # Perform crossmatching on plain ICRS coordinates
+    idx, idx_to_crossmatch, d2d1 = search_around(casda_catalogue['ra_deg_cont'].values,
+                                                 casda_catalogue['dec_deg_cont'].values,
+                                                 source_list_sorted['ra_corrected'].values,
+                                                 source_list_sorted['dec_corrected'].values,
+                                                 seplimit = search_radius_degree)
+    # Separations in arcseconds
+    d2d1 = d2d1 * 3600
     
     return idx, idx_to_crossmatch, d2d1
 
 
-def crossmatch_planet(filename: str, source_list:str, search_radius:float, planet_name:str) -> None:
-    """Crossmatch NASA database with CASDA database for a planet using the 'crossmatching' function
+def crossmatch_sweep(filename: str, source_list: str, radii: list, planet_name: str = None,
+                     casda_catalogue: pd.DataFrame = None):
+    """Crossmatch at several search radii in a single pass. Candidates are found once at the
+    largest radius and the pairs within each smaller radius are taken from the sorted separations.
 
     Args:
         filename (str): filename of CASDA catalogue
         source_list (str): filename of the NASA list of sources to be crossmatched
-        search_radius (float): search radius around each source (will be converted to arcseconds)
+        radii (list): search radii in arcseconds
+        planet_name (str, optional): Name of the planet to be matched. Defaults to None.
+        casda_catalogue (pd.DataFrame, optional): the CASDA catalogue if already read from 'filename'. Defaults to None.
+
+    Returns:
+        sweep_summary (DataFrame): number of matches and of matched sources for every radius
+        sweep_matches (dict): radius to the (idx, idx_to_crossmatch, d2d1) of the pairs within it,
+            as returned by 'crossmatch'
+    """
+    radii = np.sort(np.asarray(radii, dtype=np.float64))
+    idx, idx_to_crossmatch, d2d1 = crossmatch(filename, source_list, radii[-1], planet_name, casda_catalogue)
+
+    order, counts = sweep_radii(d2d1, radii)
+    idx, idx_to_crossmatch, d2d1 = idx[order], idx_to_crossmatch[order], d2d1[order]
+
+    sweep_matches = {}
+    n_sources_matched = []
+    for radius, count in zip(radii, counts):
+        sweep_matches[radius] = (idx[:count], idx_to_crossmatch[:count], d2d1[:count])
+        n_sources_matched.append(len(np.unique(idx_to_crossmatch[:count])))
+
+    sweep_summary = pd.DataFrame({'search_radius': radii,
+                                  'n_matches': counts,
+                                  'n_sources_matched': n_sources_matched})
+
+    return sweep_summary, sweep_matches
+
+
+def positional_uncertainties(casda_catalogue: pd.DataFrame, sources: pd.DataFrame, pm_err: float = 0.1,
+                             systematic_err: float = 0.5):
+    """Per-axis 1-sigma positional uncertainties of CASDA components and proper motion corrected planets
+
+    Args:
+        casda_catalogue (pd.DataFrame): selavy components with 'ra_err', 'dec_err', 'maj_axis', 'min_axis',
+            'flux_peak' and 'rms_image' columns
+        sources (pd.DataFrame): planets with 'epoch' (MJD) and, if available, 'sy_pmraerr1'/'sy_pmdecerr1' columns
+        pm_err (float, optional): proper motion uncertainty in mas/yr used where the planet has none. Defaults to 0.1.
+        systematic_err (float, optional): per-axis astrometric systematic of the CASDA catalogues in arcseconds. Defaults to 0.5.
+
+    Returns:
+        catalogue_sigma_ra (NDArray[float64]): RA uncertainty of each component in arcseconds
+        catalogue_sigma_dec (NDArray[float64]): Dec uncertainty of each component in arcseconds
+        source_sigma_ra (NDArray[float64]): RA uncertainty of each planet in arcseconds
+        source_sigma_dec (NDArray[float64]): Dec uncertainty of each planet in arcseconds
+    """
+    # Condon (1997) fit uncertainty from the beam size and signal to noise, used where selavy
+    # reports no positional error (e.g. fits that are only estimates)
+    snr = casda_catalogue['flux_peak'].to_numpy(dtype=np.float64) / casda_catalogue['rms_image'].to_numpy(dtype=np.float64)
+    beam_sigma = 0.5 * np.sqrt(casda_catalogue['maj_axis'].to_numpy(dtype=np.float64)
+                               * casda_catalogue['min_axis'].to_numpy(dtype=np.float64)) / snr
+
+    ra_err = casda_catalogue['ra_err'].to_numpy(dtype=np.float64)
+    dec_err = casda_catalogue['dec_err'].to_numpy(dtype=np.float64)
+    ra_err = np.where(np.isfinite(ra_err) & (ra_err > 0), ra_err, beam_sigma)
+    dec_err = np.where(np.isfinite(dec_err) & (dec_err > 0), dec_err, beam_sigma)
+
+    catalogue_sigma_ra = np.hypot(ra_err, systematic_err)
+    catalogue_sigma_dec = np.hypot(dec_err, systematic_err)
+
+    source_sigma_ra, source_sigma_dec = source_uncertainties(sources, pm_err=pm_err)
+
+    return catalogue_sigma_ra, catalogue_sigma_dec, source_sigma_ra, source_sigma_dec
+
+
+def source_uncertainties(sources: pd.DataFrame, pm_err: float = 0.1):
+    """Per-axis 1-sigma positional uncertainties of proper motion corrected planets, accumulated by
+    propagating the proper motion from the Gaia epoch to the catalogue epoch
+
+    Args:
+        sources (pd.DataFrame): planets with 'epoch' (MJD) and, if available, 'sy_pmraerr1'/'sy_pmdecerr1' columns
+        pm_err (float, optional): proper motion uncertainty in mas/yr used where the planet has none. Defaults to 0.1.
+
+    Returns:
+        source_sigma_ra (NDArray[float64]): RA uncertainty of each planet in arcseconds
+        source_sigma_dec (NDArray[float64]): Dec uncertainty of each planet in arcseconds
+    """
+    years = np.abs(sources['epoch'].to_numpy(dtype=np.float64) - GAIA_DR2_EPOCH_MJD) / 365.25
+    pmra_err = sources['sy_pmraerr1'].to_numpy(dtype=np.float64) if 'sy_pmraerr1' in sources else np.full(len(sources), np.nan)
+    pmdec_err = sources['sy_pmdecerr1'].to_numpy(dtype=np.float64) if 'sy_pmdecerr1' in sources else np.full(len(sources), np.nan)
+    source_sigma_ra = years * np.where(np.isfinite(pmra_err), np.abs(pmra_err), pm_err) / 1000
+    source_sigma_dec = years * np.where(np.isfinite(pmdec_err), np.abs(pmdec_err), pm_err) / 1000
+
+    return source_sigma_ra, source_sigma_dec
+
+
+def probabilistic_search_radius(sources: pd.DataFrame, search_radius: float = 3, max_normalised_separation: float = 5,
+                                component_sigma: float = FAINT_COMPONENT_SIGMA, pm_err: float = 0.1) -> float:
+    """Radius of the candidate search of 'probabilistic_match', so the candidates are fetched before any
+    flat radius cut: the largest normalised separation kept at the combined uncertainty of the least
+    certain planet and a faint component, and never less than the flat search radius
+
+    Args:
+        sources (pd.DataFrame): planets with proper motion errors and, if already known, 'epoch' (MJD).
+            Without epochs the planets are propagated to today, the largest uncertainty of any epoch.
+        search_radius (float | list, optional): flat search radius in arcseconds, or radii of a sweep. Defaults to 3.
+        max_normalised_separation (float, optional): as in 'probabilistic_match'. Defaults to 5.
+        component_sigma (float, optional): per-axis uncertainty of a component in arcseconds. Defaults to FAINT_COMPONENT_SIGMA.
+        pm_err (float, optional): proper motion uncertainty in mas/yr used where the planet has none. Defaults to 0.1.
+
+    Returns:
+        float: candidate search radius in arcseconds
+    """
+    if 'epoch' not in sources or sources['epoch'].isna().any():
+        sources = sources.assign(epoch=Time.now().mjd)
+
+    source_sigma_ra, source_sigma_dec = source_uncertainties(sources, pm_err=pm_err)
+    source_sigma = np.max(np.maximum(source_sigma_ra, source_sigma_dec), initial=0)
+
+    return max(float(np.max(search_radius)), max_normalised_separation * float(np.hypot(component_sigma, source_sigma)))
+
+
+def probabilistic_match(casda_catalogue: pd.DataFrame, sources: pd.DataFrame, search_radius: float = 30,
+                        max_normalised_separation: float = 5, prior: float = 0.5, density_radius: float = 300,
+                        pm_err: float = 0.1, systematic_err: float = 0.5) -> pd.DataFrame:
+    """Rank every candidate pair between CASDA components and planets by match probability,
+    using the positional uncertainties of both rather than a flat search radius.
+
+    For each pair the normalised separation r is the offset divided by the combined per-axis
+    uncertainty, and the likelihood ratio is the Rayleigh probability density of the offset over
+    the local density of unrelated components. Match probabilities are normalised over the
+    candidates of each planet in each catalogue.
+
+    Args:
+        casda_catalogue (pd.DataFrame): selavy components with positions, errors, beam sizes and 'source_filename'
+        sources (pd.DataFrame): proper motion corrected planets with 'pl_name', 'ra_corrected', 'dec_corrected' and 'epoch'
+        search_radius (float, optional): radius in arcseconds of the initial candidate search. Defaults to 30.
+        max_normalised_separation (float, optional): candidates with a larger normalised separation are dropped. Defaults to 5.
+        prior (float, optional): prior probability that a planet has a counterpart in a catalogue. Defaults to 0.5.
+        density_radius (float, optional): radius in arcseconds used to estimate the local component density. Defaults to 300.
+        pm_err (float, optional): proper motion uncertainty in mas/yr used where the planet has none. Defaults to 0.1.
+        systematic_err (float, optional): per-axis astrometric systematic in arcseconds. Defaults to 0.5.
+
+    Returns:
+        DataFrame: one row per candidate pair, sorted by descending match probability
+    """
+    catalogue_ra = casda_catalogue['ra_deg_cont'].to_numpy(dtype=np.float64)
+    catalogue_dec = casda_catalogue['dec_deg_cont'].to_numpy(dtype=np.float64)
+    source_ra = sources['ra_corrected'].to_numpy(dtype=np.float64)
+    source_dec = sources['dec_corrected'].to_numpy(dtype=np.float64)
+
+    # Local density of components per square arcsecond per catalogue around each planet
+    density_idx, density_source_idx, _ = search_around(catalogue_ra, catalogue_dec, source_ra, source_dec,
+                                                       seplimit=density_radius / 3600)
+    n_catalogues = max(casda_catalogue['source_filename'].nunique(), 1)
+    source_density = np.bincount(density_source_idx, minlength=len(sources)) / (np.pi * density_radius ** 2 * n_catalogues)
+    # at least one component in the density area, so the likelihood ratio stays finite
+    source_density = np.maximum(source_density, 1 / (np.pi * density_radius ** 2))
+
+    idx, idx_to_crossmatch, separation = search_around(catalogue_ra, catalogue_dec, source_ra, source_dec,
+                                                       seplimit=search_radius / 3600)
+
+    catalogue_sigma_ra, catalogue_sigma_dec, source_sigma_ra, source_sigma_dec = positional_uncertainties(
+        casda_catalogue, sources, pm_err=pm_err, systematic_err=systematic_err)
+    sigma_ra = np.hypot(catalogue_sigma_ra[idx], source_sigma_ra[idx_to_crossmatch])
+    sigma_dec = np.hypot(catalogue_sigma_dec[idx], source_sigma_dec[idx_to_crossmatch])
+
+    # Offsets on the tangent plane in arcseconds
+    delta_ra = (catalogue_ra[idx] - source_ra[idx_to_crossmatch] + 180) % 360 - 180
+    delta_ra = delta_ra * np.cos(np.radians(source_dec[idx_to_crossmatch])) * 3600
+    delta_dec = (catalogue_dec[idx] - source_dec[idx_to_crossmatch]) * 3600
+
+    normalised_separation = np.hypot(delta_ra / sigma_ra, delta_dec / sigma_dec)
+    likelihood_ratio = (np.exp(-0.5 * normalised_separation ** 2) / (2 * np.pi * sigma_ra * sigma_dec)
+                        / source_density[idx_to_crossmatch])
+
+    pairs = pd.DataFrame({'catalogue_index': idx,
+                          'source_index': idx_to_crossmatch,
+                          'pl_name': sources['pl_name'].to_numpy()[idx_to_crossmatch],
+                          'component_name': casda_catalogue['component_name'].to_numpy()[idx],
+                          'source_filename': casda_catalogue['source_filename'].to_numpy()[idx],
+                          'separation_arcsec': separation * 3600,
+                          'sigma_ra_arcsec': sigma_ra,
+                          'sigma_dec_arcsec': sigma_dec,
+                          'normalised_separation': normalised_separation,
+                          'likelihood_ratio': likelihood_ratio})
+
+    # Shrink the candidate set before normalising
+    pairs = pairs[pairs['normalised_separation'] <= max_normalised_separation]
+
+    total_likelihood_ratio = pairs.groupby(['source_index', 'source_filename'])['likelihood_ratio'].transform('sum')
+    pairs = pairs.assign(match_probability=pairs['likelihood_ratio'] / (total_likelihood_ratio + (1 - prior) / prior))
+
+    return pairs.sort_values('match_probability', ascending=False, ignore_index=True)
+
+
+def crossmatch_probabilistic(filename: str, source_list: str, search_radius: float = 30, planet_name: str = None,
+                             casda_catalogue: pd.DataFrame = None, **kwargs) -> pd.DataFrame:
+    """Uncertainty-aware version of 'crossmatch' reading the same files, see 'probabilistic_match'
+
+    Args:
+        filename (str): filename of CASDA catalogue
+        source_list (str): filename of the NASA list of sources to be crossmatched
+        search_radius (float, optional): radius of the initial candidate search in arcseconds. Defaults to 30.
+        planet_name (str, optional): Name of the planet to be matched. Defaults to None.
+        casda_catalogue (pd.DataFrame, optional): the CASDA catalogue if already read from 'filename'. Defaults to None.
+        **kwargs: passed on to 'probabilistic_match'
+
+    Returns:
+        DataFrame: candidate pairs ranked by match probability
+    """
+    if casda_catalogue is None:
+        casda_catalogue = read_catalogue_csv(filename)
+    source_list_sorted = pd.read_csv(source_list)
+
+    if planet_name is not None:
+        source_list_sorted = source_list_sorted[source_list_sorted['pl_name'] == planet_name]
+
+    return probabilistic_match(casda_catalogue, source_list_sorted, search_radius=search_radius, **kwargs)
+
+
+def crossmatch_planet(filename: str, source_list:str, search_radius:float, planet_name:str,
+                      probabilistic: bool = False, host_planets: list = None) -> None:
+    """Crossmatch NASA database with CASDA database for a planet using the 'crossmatching' function.
+    The matched components are appended to the result store (see result_store) under the current run.
+
+    Planets of one host star share their position, so the crossmatch of one of them is stored for
+    all of them (see host_groups) instead of reading and matching the catalogue once per planet.
+
+    Args:
+        filename (str): filename of CASDA catalogue
+        source_list (str): filename of the NASA list of sources to be crossmatched
+        search_radius (float | list): search radius around each source (will be converted to arcseconds).
+            A list of radii runs a radius sweep with 'crossmatch_sweep'.
         planet_name (str): Name of the planet to be matched. Defaults to None.
+        probabilistic (bool, optional): rank candidates by match probability using the positional
+            uncertainties instead of using a flat search radius, 'search_radius' is then the radius of the
+            candidate search (see 'probabilistic_search_radius'). Defaults to False.
+        host_planets (list, optional): names of the planets sharing the host and position of 'planet_name',
+            the matches are stored for each of them. Defaults to [planet_name].
     """
+    planet_names = host_planets if host_planets else [planet_name]
+
     # print initial statements indicating which file and sourcelist will be examined
     logger.info(f"Loading CASDA data from: {filename}")
     logger.info(f"Loading Proper Motion Corrected Data from: {source_list}")
  
     try:
+        # Read the used columns of the catalogue once for crossmatching and for storing the matched components
+        casda_catalogue = read_catalogue_csv(filename)
+
+        if probabilistic:
+            # Rank all candidates of the planet by match probability
+            ranked_matches = crossmatch_probabilistic(filename, source_list, search_radius=float(np.max(search_radius)),
+                                                      planet_name=planet_name, casda_catalogue=casda_catalogue)
+            logger.info(f"Ranked crossmatch results for {planet_name}:")
+            logger.info(f"{ranked_matches[['component_name', 'source_filename', 'separation_arcsec', 'normalised_separation', 'match_probability']]}")
+            for matched_planet in planet_names:
+                result_store.append_matches(matched_planet, casda_catalogue.iloc[ranked_matches['catalogue_index']],
+                                            ranked_matches['separation_arcsec'],
+                                            match_probability=ranked_matches['match_probability'].to_numpy())
+            return
+
+        if np.ndim(search_radius) > 0:
+            # Report the matches for every radius of the sweep
+            sweep_summary, sweep_matches = crossmatch_sweep(filename, source_list, search_radius, planet_name,
+                                                            casda_catalogue)
+            logger.info(f"Radius sweep crossmatch results for {planet_name}:")
+            logger.info(f"{sweep_summary}")
+            for radius, (idx, idx_to_crossmatch, d2d1) in sweep_matches.items():
+                logger.info(f"Radius {radius} arcsec: matches in Source Catalog: {idx}, separation distances: {d2d1}")
+            # the pairs of the largest radius include those of every other radius
+            idx, _, d2d1 = sweep_matches[max(sweep_matches)]
+            for matched_planet in planet_names:
+                result_store.append_matches(matched_planet, casda_catalogue.iloc[idx], d2d1, search_radius=max(sweep_matches))
+            return
+
         # Perform crossmatching for the planet
-        idx, idx_to_crossmatch, d2d1 = crossmatch(filename, source_list, search_radius, planet_name)
+        idx, idx_to_crossmatch, d2d1 = crossmatch(filename, source_list, search_radius, planet_name, casda_catalogue)
         # Print performance of crossmatching
         logger.info(f"Crossmatch results for {planet_name}:")
         logger.info(f"Matches in Source Catalog: {idx}")
         logger.info(f"Indices in Catalog to crossmatch: {idx_to_crossmatch}")
         logger.info(f"Separation distances: {d2d1}")
+        for matched_planet in planet_names:
+            result_store.append_matches(matched_planet, casda_catalogue.iloc[idx], d2d1, search_radius=search_radius)
     except FileNotFoundError as e:
         # Raise an error if the planet name is undefined or crossmatch raises an error
         logger.info(f"Catalogue file for {planet_name} not found.")
@@ -0,0 +1,178 @@
+import numpy as np
+import pandas as pd
+
+import casda_util
+import proper_motion
+import result_store
+import run_metrics
+from light_curves import CASDA_MATCHES_PATH, append_planet_matches, catalogue_basename
+from sky_separation import search_around
+
+# Import the centralized logger
+from logger_config import logger
+
+
+# Only the catalogues casda_util.casda_search downloads
+CATALOGUE_FILENAME_PATTERN = r'.*.cont.taylor.0.restored.conv.components.xml$'
+
+# Catalogues whose centres are within this many degrees of a planet cover it, as in casda_util.casda_search
+CATALOGUE_SEARCH_RADIUS = 3
+
+# Number of new catalogues fetched and matched at a time, each batch is recorded once it is stored
+DEFAULT_BATCH_SIZE = 20
+
+
+def new_pairs(planets: pd.DataFrame, pubdat: pd.DataFrame, sample: str,
+              store_path: str = result_store.RESULT_STORE_PATH) -> tuple:
+    """Planet and catalogue pairs of the public data table that have not been matched yet. A pair is
+    a catalogue whose centre is within CATALOGUE_SEARCH_RADIUS of a planet, so catalogues released
+    since the last run pair with every planet they cover, and planets added to the sample pair with
+    every catalogue covering them.
+
+    Args:
+        planets (pd.DataFrame): planets of the sample with 'pl_name', 'ra' and 'dec'
+        pubdat (pd.DataFrame): current CASDA public data table
+        sample (str): name of the planet sample
+        store_path (str, optional): path of the result store holding the ledger. Defaults to RESULT_STORE_PATH.
+
+    Returns:
+        catalogues (DataFrame): catalogues with at least one new pair
+        pairs (DataFrame): 'planet' and 'catalogue', positions of each new pair in 'planets' and 'catalogues'
+    """
+    catalogues = pubdat[pubdat['filename'].str.contains(CATALOGUE_FILENAME_PATTERN, regex=True)]
+    catalogues = catalogues.drop_duplicates('filename').reset_index(drop=True)
+
+    planet_index, catalogue_index, _ = search_around(planets['ra'].to_numpy(dtype=np.float64),
+                                                     planets['dec'].to_numpy(dtype=np.float64),
+                                                     catalogues['s_ra'].to_numpy(dtype=np.float64),
+                                                     catalogues['s_dec'].to_numpy(dtype=np.float64),
+                                                     CATALOGUE_SEARCH_RADIUS)
+
+    processed = result_store.processed_pairs(sample, store_path)
+    planet_names = planets['pl_name'].to_numpy()
+    filenames = catalogues['filename'].to_numpy()
+    new = np.array([(filename, planet) not in processed
+                    for filename, planet in zip(filenames[catalogue_index], planet_names[planet_index])], dtype=bool)
+    planet_index, catalogue_index = planet_index[new], catalogue_index[new]
+
+    # catalogues are renumbered to the ones with new pairs
+    covering, catalogue_index = np.unique(catalogue_index, return_inverse=True)
+
+    return (catalogues.iloc[covering].reset_index(drop=True),
+            pd.DataFrame({'planet': planet_index, 'catalogue': catalogue_index.reshape(-1)}))
+
+
+def match_catalogues(planets: pd.DataFrame, catalogues: pd.DataFrame, pairs: pd.DataFrame, xml_filelist: list,
+                     search_radius: float = 3, epochs: pd.Series = None,
+                     store_path: str = result_store.RESULT_STORE_PATH,
+                     matches_path: str = CASDA_MATCHES_PATH) -> pd.DataFrame:
+    """Match planet and catalogue pairs of a batch of catalogues and append the matches to the result
+    store and to the match file of each planet, which the light curves are built from
+
+    Unlike the planet by planet loop of main, which corrects a planet to the epoch of its closest
+    catalogue, each planet is proper motion corrected to the epoch of every catalogue it pairs
+    with, all in a single call.
+
+    Args:
+        planets (pd.DataFrame): planets with 'pl_name', 'ra', 'dec', 'sy_pmra', 'sy_pmdec' and 'sy_dist'
+        catalogues (pd.DataFrame): rows of the public data table of the batch, with 'filename' and 't_max'
+        pairs (pd.DataFrame): 'planet' and 'catalogue', positions in 'planets' and 'catalogues' of the pairs to match
+        xml_filelist (list): paths of the downloaded catalogues of the batch
+        search_radius (float, optional): crossmatch radius in arcseconds. Defaults to 3.
+        epochs (pd.Series, optional): catalogue filename to epoch stored with the matches. Defaults to the cached pubdat epochs.
+        store_path (str, optional): path of the result store. Defaults to RESULT_STORE_PATH.
+        matches_path (str, optional): directory of the per-planet match files. Defaults to casda_matches.
+
+    Returns:
+        DataFrame: 'catalogue', 'n_planets' and 'n_matches' of each matched catalogue
+    """
+    planet_index = pairs['planet'].to_numpy()
+    catalogue_index = pairs['catalogue'].to_numpy()
+    ra_corrected, dec_corrected = proper_motion.proper_correct_positions(
+        planets.iloc[planet_index], catalogues['t_max'].to_numpy(dtype=np.float64)[catalogue_index])
+    planet_names = planets['pl_name'].to_numpy()[planet_index]
+
+    catalogue_positions = pd.Series(np.arange(len(catalogues)), index=catalogues['filename'].to_numpy())
+
+    summary = []
+    for filename, catalogue_df in casda_util.iter_catalogue_blocks(xml_filelist):
+        catalogue_pairs = np.flatnonzero(catalogue_index == catalogue_positions[filename])
+        pair_index, component_index, separation = search_around(ra_corrected[catalogue_pairs], dec_corrected[catalogue_pairs],
+                                                                catalogue_df['ra_deg_cont'].to_numpy(dtype=np.float64),
+                                                                catalogue_df['dec_deg_cont'].to_numpy(dtype=np.float64),
+                                                                search_radius / 3600)
+        matches = catalogue_df.iloc[component_index].assign(source_filename=filename)
+        matched_planets = planet_names[catalogue_pairs][pair_index]
+
+        n_matches = 0
+        for planet in pd.unique(matched_planets):
+            is_planet = matched_planets == planet
+            n_matches += result_store.append_matches(planet, matches[is_planet], separation[is_planet] * 3600,
+                                                     search_radius=search_radius, epochs=epochs,
+                                                     store_path=store_path)
+            append_planet_matches(planet, matches[is_planet], matches_path)
+
+        summary.append({'catalogue': filename, 'n_planets': len(catalogue_pairs), 'n_matches': n_matches})
+
+    return pd.DataFrame(summary, columns=['catalogue', 'n_planets', 'n_matches'])
+
+
+def run_delta(casda, planets: pd.DataFrame, sample: str, search_radius: float = 3, staging_manager=None,
+              disk_cache=None, batch_size: int = DEFAULT_BATCH_SIZE, refresh_pubdat: bool = True,
+              store_path: str = result_store.RESULT_STORE_PATH, matches_path: str = CASDA_MATCHES_PATH) -> pd.DataFrame:
+    """Match only the planet and catalogue pairs not matched before, i.e. catalogues released since
+    the last run and planets added to the sample since, appending to the existing results. The
+    first run over a sample processes every catalogue.
+
+    Pairs are recorded in the ledger of the result store once their matches are stored, so an
+    interrupted run picks up from the first batch it did not finish.
+
+    Args:
+        casda (Casda): logged in casda instance
+        planets (pd.DataFrame): planets of the sample, from proper_motion.filter_for_gaia
+        sample (str): name of the planet sample, the ledger is kept per sample
+        search_radius (float | list): crossmatch radius in arcseconds, the largest is used for a sweep. Defaults to 3.
+        staging_manager (StagingManager, optional): persistent manager of the staging jobs. Defaults to None.
+        disk_cache (DiskCacheManager, optional): size-bounded manager of the xml download directory. Defaults to None.
+        batch_size (int, optional): catalogues fetched at a time. Defaults to DEFAULT_BATCH_SIZE.
+        refresh_pubdat (bool, optional): query a new snapshot of the public data table. Defaults to True.
+        store_path (str, optional): path of the result store. Defaults to RESULT_STORE_PATH.
+        matches_path (str, optional): directory of the per-planet match files. Defaults to casda_matches.
+
+    Returns:
+        DataFrame: 'catalogue', 'n_planets' and 'n_matches' of each catalogue processed
+    """
+    search_radius = float(np.max(search_radius))
+    pubdat = casda_util.get_public_data_table(refresh=refresh_pubdat)
+    epochs = pd.Series(pubdat['t_max'].to_numpy(), index=catalogue_basename(pubdat['filename'])).groupby(level=0).first()
+
+    catalogues, pairs = new_pairs(planets, pubdat, sample, store_path)
+    logger.info(f"Delta crossmatch of {sample}: {len(pairs)} new planet-catalogue pairs in {len(catalogues)} catalogues")
+
+    planet_names = planets['pl_name'].to_numpy()
+    summaries = []
+    for start in range(0, len(catalogues), batch_size):
+        batch = catalogues.iloc[start:start + batch_size].reset_index(drop=True)
+        batch_pairs = pairs[(pairs['catalogue'] >= start) & (pairs['catalogue'] < start + len(batch))]
+        batch_pairs = batch_pairs.assign(catalogue=batch_pairs['catalogue'] - start)
+        xml_filelist = casda_util.fetch_catalogues(casda, batch, staging_manager=staging_manager, disk_cache=disk_cache)
+        if xml_filelist is None:
+            # left out of the ledger, so the next run fetches them again
+            logger.error(f"Delta crossmatch: fetching catalogues {start + 1}-{start + len(batch)} failed, skipping them")
+            continue
+
+        summary = match_catalogues(planets, batch, batch_pairs, xml_filelist, search_radius, epochs, store_path,
+                                   matches_path)
+        # only the pairs of catalogues that were read are recorded, unreadable ones are matched next run
+        matched = batch_pairs[batch['filename'].iloc[batch_pairs['catalogue']].isin(summary['catalogue']).to_numpy()]
+        result_store.mark_processed(zip(batch['filename'].to_numpy()[matched['catalogue']],
+                                        planet_names[matched['planet']]), sample, store_path)
+        run_metrics.increment('delta_catalogues', len(summary))
+        run_metrics.increment('delta_matches', int(summary['n_matches'].sum()))
+        summaries.append(summary)
+        logger.info(f"Delta crossmatch: {start + len(batch)} of {len(catalogues)} catalogues matched")
+
+    if not summaries:
+        return pd.DataFrame(columns=['catalogue', 'n_planets', 'n_matches'])
+
+    return pd.concat(summaries, ignore_index=True)
@@ -0,0 +1,173 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import run_metrics
+from sky_separation import search_around
+
+# Import the centralized logger
+from logger_config import logger
+
+
+class DiskCacheManager:
+    """Keeps a download directory (e.g. casda_xml_downloads) within a size cap.
+
+    Files are evicted either least recently used first ('lru') or least valuable first
+    ('value'), where the value of a file is supplied by the caller, for example the number
+    of sample planets covered by a catalogue tile. Pinned files are never evicted.
+    """
+
+    POLICIES = ('lru', 'value')
+
+    def __init__(self, directory: str, max_bytes: int, policy: str = 'lru'):
+        """
+        Args:
+            directory (str): directory managed by the cache
+            max_bytes (int): size cap of the directory in bytes
+            policy (str, optional): eviction policy, 'lru' or 'value'. Defaults to 'lru'.
+        """
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown eviction policy '{policy}', expected one of {self.POLICIES}")
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.pinned = set()
+        self.values = {}
+
+    def scan(self) -> pd.DataFrame:
+        """List the files in the cache directory
+
+        Returns:
+            DataFrame: filename, path, size in bytes and last use time of every file
+        """
+        rows = []
+        if os.path.isdir(self.directory):
+            for entry in os.scandir(self.directory):
+                if entry.is_file():
+                    stat = entry.stat()
+                    # mtime is refreshed by touch() so it records the last use of the file
+                    rows.append((entry.name, entry.path, stat.st_size, stat.st_mtime))
+
+        return pd.DataFrame(rows, columns=['filename', 'path', 'bytes', 'last_used'])
+
+    def touch(self, paths: list) -> None:
+        """Mark files as just used
+
+        Args:
+            paths (list): paths or filenames of the used files
+        """
+        now = time.time()
+        for path in paths:
+            filepath = os.path.join(self.directory, os.path.basename(path))
+            if os.path.isfile(filepath):
+                os.utime(filepath, (now, now))
+
+    def pin(self, paths: list) -> None:
+        """Protect files from eviction until they are unpinned
+
+        Args:
+            paths (list): paths or filenames of the files to pin
+        """
+        self.pinned.update(os.path.basename(path) for path in paths)
+
+    def unpin(self, paths: list = None) -> None:
+        """Allow pinned files to be evicted again
+
+        Args:
+            paths (list, optional): paths or filenames of the files to unpin. Defaults to all pinned files.
+        """
+        if paths is None:
+            self.pinned.clear()
+        else:
+            self.pinned.difference_update(os.path.basename(path) for path in paths)
+
+    def set_values(self, values: dict) -> None:
+        """Set the value of files used by the 'value' eviction policy. Files without a value are worth 0.
+
+        Args:
+            values (dict): filename to value
+        """
+        self.values = dict(values)
+
+    def enforce(self, pinned: list = ()) -> list:
+        """Evict files until the directory is within the size cap
+
+        Args:
+            pinned (list, optional): extra files to protect during this call only,
+                e.g. the catalogues of the planet being processed.
+
+        Returns:
+            list: filenames of the evicted files
+        """
+        files = self.scan()
+        total_bytes = int(files['bytes'].sum())
+        if total_bytes <= self.max_bytes:
+            return []
+
+        protected = self.pinned | {os.path.basename(path) for path in pinned}
+        candidates = files[~files['filename'].isin(protected)]
+
+        if self.policy == 'value':
+            candidates = candidates.assign(value=candidates['filename'].map(self.values).fillna(0))
+            candidates = candidates.sort_values(['value', 'last_used'])
+        else:
+            candidates = candidates.sort_values('last_used')
+
+        evicted = []
+        for filename, filepath, nbytes in zip(candidates['filename'], candidates['path'], candidates['bytes']):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.unlink(filepath)
+            except OSError as e:
+                logger.error(f"Failed to evict {filepath} from cache. Reason: {e}")
+                continue
+            total_bytes -= nbytes
+            evicted.append(filename)
+
+        if total_bytes > self.max_bytes:
+            logger.info(f"Cache {self.directory} still exceeds its cap after eviction, remaining files are pinned")
+
+        run_metrics.increment('disk_cache_evictions', len(evicted))
+        logger.info(f"Evicted {len(evicted)} files from {self.directory}")
+        return evicted
+
+    def usage_report(self) -> dict:
+        """Summarise the disk usage of the cache
+
+        Returns:
+            dict: number of files, bytes used, size cap, fraction of the cap used and pinned files/bytes
+        """
+        files = self.scan()
+        pinned_files = files[files['filename'].isin(self.pinned)]
+        used_bytes = int(files['bytes'].sum())
+
+        return {'directory': self.directory,
+                'files': len(files),
+                'bytes': used_bytes,
+                'max_bytes': self.max_bytes,
+                'fraction_used': used_bytes / self.max_bytes if self.max_bytes else np.inf,
+                'pinned_files': len(pinned_files),
+                'pinned_bytes': int(pinned_files['bytes'].sum())}
+
+
+def tile_planet_coverage(pubdat: pd.DataFrame, source_list: pd.DataFrame, radius: float = 3) -> dict:
+    """Count how many sample planets each catalogue tile covers, for use as the
+    value of the tiles in the 'value' eviction policy
+
+    Args:
+        pubdat (pd.DataFrame): CASDA public data table with 'filename', 's_ra' and 's_dec' columns
+        source_list (pd.DataFrame): planets with 'ra' and 'dec' columns
+        radius (float, optional): radius around the tile centre in degrees. Defaults to 3.
+
+    Returns:
+        dict: catalogue filename to number of planets within radius of the tile centre
+    """
+    tile_idx, _, _ = search_around(pubdat['s_ra'].values, pubdat['s_dec'].values,
+                                   source_list['ra'].values, source_list['dec'].values, seplimit=radius)
+    counts = np.bincount(tile_idx, minlength=len(pubdat))
+
+    return dict(zip(pubdat['filename'], counts.tolist()))
@@ -0,0 +1,192 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from sky_separation import radec_to_unit_vectors
+
+# Import the centralized logger
+from logger_config import logger
+
+
+def chord_length(radius: float) -> float:
+    """Convert an angular radius to the straight line distance between unit vectors
+
+    Args:
+        radius (float): angular radius in degrees
+
+    Returns:
+        float: chord length on the unit sphere
+    """
+    return 2 * np.sin(np.radians(radius) / 2)
+
+
+class FieldIndex:
+    """Spatial index of the components of one catalogue field, built once and
+    queried for every offset realisation of every planet"""
+
+    def __init__(self, ra, dec):
+        """
+        Args:
+            ra (ArrayLike): right ascension of the components in degrees
+            dec (ArrayLike): declination of the components in degrees
+        """
+        self.n_components = len(ra)
+        self.tree = cKDTree(radec_to_unit_vectors(ra, dec))
+
+    def count_within(self, ra, dec, radius: float) -> np.ndarray:
+        """Count the components within a radius of each position
+
+        Args:
+            ra (ArrayLike): right ascension of the positions in degrees, any shape
+            dec (ArrayLike): declination of the positions in degrees, same shape as ra
+            radius (float): radius in degrees
+
+        Returns:
+            NDArray[int64]: number of components within radius, same shape as ra
+        """
+        ra = np.asarray(ra, dtype=np.float64)
+        points = radec_to_unit_vectors(ra.ravel(), np.asarray(dec, dtype=np.float64).ravel())
+        counts = self.tree.query_ball_point(points, chord_length(radius), return_length=True)
+
+        return np.asarray(counts, dtype=np.int64).reshape(ra.shape)
+
+    def nearest(self, ra, dec, k: int = 1, max_distance: float = 180):
+        """Find the k nearest components of each position in one batched query
+
+        Args:
+            ra (ArrayLike): right ascension of the positions in degrees
+            dec (ArrayLike): declination of the positions in degrees
+            k (int, optional): number of neighbours. Defaults to 1.
+            max_distance (float, optional): neighbours further than this many degrees are not returned. Defaults to 180.
+
+        Returns:
+            separations (NDArray[float64]): (N, k) separations in degrees, inf where there is no neighbour
+            indices (NDArray[int64]): (N, k) component indices, n_components where there is no neighbour
+        """
+        points = radec_to_unit_vectors(np.atleast_1d(ra), np.atleast_1d(dec))
+        chords, indices = self.tree.query(points, k=[i + 1 for i in range(k)],
+                                          distance_upper_bound=chord_length(max_distance) if max_distance < 180 else np.inf)
+        separations = np.degrees(2 * np.arcsin(np.clip(chords / 2, 0, 1)))
+        separations[~np.isfinite(chords)] = np.inf
+
+        return separations, indices
+
+
+def build_field_indices(catalogue_df: pd.DataFrame, field_column: str = 'source_filename') -> dict:
+    """Build one spatial index per catalogue field from already loaded catalogue arrays
+
+    Args:
+        catalogue_df (pd.DataFrame): components with 'ra_deg_cont' and 'dec_deg_cont' columns
+        field_column (str, optional): column identifying the field of each component. Defaults to 'source_filename'.
+
+    Returns:
+        dict: field name to FieldIndex
+    """
+    field_indices = {}
+    for field, field_df in catalogue_df.groupby(field_column, observed=True, sort=True):
+        field_indices[field] = FieldIndex(field_df['ra_deg_cont'].to_numpy(dtype=np.float64),
+                                          field_df['dec_deg_cont'].to_numpy(dtype=np.float64))
+
+    return field_indices
+
+
+def random_offsets(ra, dec, n_realisations: int, min_offset: float, max_offset: float, rng=None):
+    """Randomly offset copies of positions, uniform in area within an annulus around each position
+
+    Args:
+        ra (ArrayLike): right ascension of the positions in degrees
+        dec (ArrayLike): declination of the positions in degrees
+        n_realisations (int): number of offset copies of each position
+        min_offset (float): inner radius of the annulus in degrees
+        max_offset (float): outer radius of the annulus in degrees
+        rng (np.random.Generator, optional): random number generator. Defaults to a new unseeded generator.
+
+    Returns:
+        offset_ra (NDArray[float64]): right ascension of the copies, shape (N, n_realisations)
+        offset_dec (NDArray[float64]): declination of the copies, shape (N, n_realisations)
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    ra = np.radians(np.asarray(ra, dtype=np.float64))[:, None]
+    dec = np.radians(np.asarray(dec, dtype=np.float64))[:, None]
+    shape = (ra.shape[0], n_realisations)
+
+    # uniform in area on the sphere between the two radii
+    cos_min, cos_max = np.cos(np.radians(min_offset)), np.cos(np.radians(max_offset))
+    distance = np.arccos(rng.uniform(cos_max, cos_min, size=shape))
+    position_angle = rng.uniform(0, 2 * np.pi, size=shape)
+
+    # destination point given distance and position angle (east of north)
+    offset_dec = np.arcsin(np.sin(dec) * np.cos(distance) + np.cos(dec) * np.sin(distance) * np.cos(position_angle))
+    offset_ra = ra + np.arctan2(np.sin(position_angle) * np.sin(distance) * np.cos(dec),
+                                np.cos(distance) - np.sin(dec) * np.sin(offset_dec))
+
+    return np.degrees(offset_ra) % 360, np.degrees(offset_dec)
+
+
+def false_association_rate(catalogue_df: pd.DataFrame, sources: pd.DataFrame, search_radius: float = 3,
+                           n_realisations: int = 1000, min_offset: float = 30, max_offset: float = 300,
+                           field_indices: dict = None, seed: int = None) -> pd.DataFrame:
+    """Estimate the chance-alignment rate of each planet with CASDA components by re-matching many
+    randomly offset copies of its position against the same catalogues
+
+    Args:
+        catalogue_df (pd.DataFrame): loaded catalogue components with 'ra_deg_cont', 'dec_deg_cont'
+            and 'source_filename' columns
+        sources (pd.DataFrame): planets with 'pl_name' and 'ra_corrected'/'dec_corrected' (or 'ra'/'dec') columns
+        search_radius (float, optional): matching radius in arcseconds. Defaults to 3.
+        n_realisations (int, optional): number of offset copies of each planet. Defaults to 1000.
+        min_offset (float, optional): minimum offset in arcseconds, so the planet itself is never matched. Defaults to 30.
+        max_offset (float, optional): maximum offset in arcseconds, keeping copies in the local field. Defaults to 300.
+        field_indices (dict, optional): prebuilt indices from 'build_field_indices', reused between calls. Defaults to None.
+        seed (int, optional): seed of the random offsets. Defaults to None.
+
+    Returns:
+        DataFrame: per planet the number of fields covering it, the local component density per square
+        arcsecond per field, the expected number of chance matches per field, the chance match probability
+        per field and the probability of a chance match in any of the fields
+    """
+    if field_indices is None:
+        field_indices = build_field_indices(catalogue_df)
+
+    ra_column, dec_column = ('ra_corrected', 'dec_corrected') if 'ra_corrected' in sources else ('ra', 'dec')
+    source_ra = sources[ra_column].to_numpy(dtype=np.float64)
+    source_dec = sources[dec_column].to_numpy(dtype=np.float64)
+
+    rng = np.random.default_rng(seed)
+    offset_ra, offset_dec = random_offsets(source_ra, source_dec, n_realisations,
+                                           min_offset / 3600, max_offset / 3600, rng)
+
+    n_sources = len(sources)
+    n_fields = np.zeros(n_sources, dtype=np.int64)
+    density_sum = np.zeros(n_sources)
+    chance_matches = np.zeros(n_sources)
+    any_match = np.zeros((n_sources, n_realisations), dtype=bool)
+
+    for field, field_index in field_indices.items():
+        # only fields with components around the planet count as covering it
+        local_counts = field_index.count_within(source_ra, source_dec, max_offset / 3600)
+        covered = local_counts > 0
+        if not covered.any():
+            continue
+
+        matched = field_index.count_within(offset_ra[covered], offset_dec[covered], search_radius / 3600) > 0
+
+        n_fields[covered] += 1
+        density_sum[covered] += local_counts[covered] / (np.pi * max_offset ** 2)
+        chance_matches[covered] += matched.mean(axis=1)
+        any_match[covered] |= matched
+
+    logger.info(f"False association rate estimated from {n_realisations} realisations over {len(field_indices)} fields")
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        local_density = density_sum / n_fields
+        chance_match_probability = chance_matches / n_fields
+
+    return pd.DataFrame({'pl_name': sources['pl_name'].to_numpy(),
+                         'n_fields': n_fields,
+                         'local_density': local_density,
+                         'expected_chance_matches': local_density * np.pi * search_radius ** 2,
+                         'chance_match_probability': chance_match_probability,
+                         'chance_match_probability_any_field': any_match.mean(axis=1)})
@@ -0,0 +1,336 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from astropy.wcs import WCS
+
+# Import the centralized logger
+from logger_config import logger
+
+
+# Gaussian FWHM to standard deviation
+FWHM_TO_SIGMA = 1 / np.sqrt(8 * np.log(2))
+
+CASDA_IMAGE_DOWNLOAD_PATH = os.path.join(os.path.dirname(__file__), "casda_image_downloads")
+CASDA_MATCHES_PATH = os.path.join(os.path.dirname(__file__), "casda_matches")
+
+# Catalogues whose centres are within this many degrees of a planet may cover it, as in casda_util.casda_search
+CATALOGUE_SEARCH_RADIUS = 3
+
+# Selavy catalogue suffix and the suffix of the image it was extracted from
+CATALOGUE_SUFFIX = '.components.xml'
+IMAGE_SUFFIX = '.fits'
+
+
+class MappedImage:
+    """A FITS image (cutout or full tile) opened through memory mapping. Only the pixels
+    of the regions that are read are ever loaded from disk."""
+
+    def __init__(self, image_path: str):
+        """
+        Args:
+            image_path (str): path of the FITS image
+        """
+        self.image_path = image_path
+        self.hdul = fits.open(image_path, memmap=True)
+        self.hdu = self.hdul[0]
+        self.header = self.hdu.header
+        self.wcs = WCS(self.header).celestial
+        self.shape = self.hdu.shape[-2:]
+
+        # ASKAP images are in Jy/beam while selavy catalogues report mJy/beam
+        self.flux_scale = 1000 if self.header.get('BUNIT', '').strip().lower() == 'jy/beam' else 1
+
+        pixel_scales = np.abs(np.diag(self.wcs.pixel_scale_matrix))
+        self.pixel_scale = float(np.sqrt(pixel_scales[0] * pixel_scales[1])) # degrees per pixel
+        # +x points east when the RA increment is positive, west otherwise
+        self.east_sign = 1 if self.wcs.pixel_scale_matrix[0, 0] > 0 else -1
+
+        self.beam_major = self.header['BMAJ'] / self.pixel_scale # pixels (FWHM)
+        self.beam_minor = self.header['BMIN'] / self.pixel_scale # pixels (FWHM)
+        self.beam_position_angle = np.radians(self.header['BPA'])
+
+    def close(self) -> None:
+        self.hdul.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def world_to_pixel(self, ra, dec):
+        """Pixel coordinates of sky positions
+
+        Args:
+            ra (ArrayLike): right ascension in degrees
+            dec (ArrayLike): declination in degrees
+
+        Returns:
+            x (NDArray[float64]): pixel x coordinates
+            y (NDArray[float64]): pixel y coordinates
+        """
+        return self.wcs.world_to_pixel_values(ra, dec)
+
+    def read_region(self, x0: int, x1: int, y0: int, y1: int) -> np.ndarray:
+        """Read a rectangular pixel region, clipped to the image, through the memory mapped section
+
+        Args:
+            x0 (int): first x pixel
+            x1 (int): last x pixel (exclusive)
+            y0 (int): first y pixel
+            y1 (int): last y pixel (exclusive)
+
+        Returns:
+            NDArray[float64]: region scaled to mJy/beam, indexed [y, x]
+        """
+        leading = (0,) * (len(self.hdu.shape) - 2)
+        region = self.hdu.section[leading + (slice(max(y0, 0), min(y1, self.shape[0])),
+                                             slice(max(x0, 0), min(x1, self.shape[1])))]
+
+        return np.asarray(region, dtype=np.float64) * self.flux_scale
+
+    def beam(self, dx: np.ndarray, dy: np.ndarray) -> np.ndarray:
+        """Restoring beam with unit peak evaluated at pixel offsets from its centre
+
+        Args:
+            dx (NDArray): x offsets in pixels
+            dy (NDArray): y offsets in pixels
+
+        Returns:
+            NDArray[float64]: beam response
+        """
+        # major axis direction in pixel coordinates, the position angle is measured east of north
+        sin_pa, cos_pa = np.sin(self.beam_position_angle), np.cos(self.beam_position_angle)
+        along_major = self.east_sign * sin_pa * dx + cos_pa * dy
+        along_minor = self.east_sign * cos_pa * dx - sin_pa * dy
+
+        sigma_major = self.beam_major * FWHM_TO_SIGMA
+        sigma_minor = self.beam_minor * FWHM_TO_SIGMA
+
+        return np.exp(-0.5 * ((along_major / sigma_major) ** 2 + (along_minor / sigma_minor) ** 2))
+
+
+def measure(image: MappedImage, x: float, y: float, box_beams: float = 2, noise_beams: float = 10,
+            rms_image: MappedImage = None) -> dict:
+    """Forced flux measurement at one pixel position, fitting the restoring beam to the pixels around it
+
+    Args:
+        image (MappedImage): image to measure
+        x (float): pixel x coordinate
+        y (float): pixel y coordinate
+        box_beams (float, optional): half-size of the fitted box in beam major axes. Defaults to 2.
+        noise_beams (float, optional): half-size of the box used to estimate the local noise in beam
+            major axes, when there is no rms map. Defaults to 10.
+        rms_image (MappedImage, optional): selavy noise map of the same field. Defaults to None.
+
+    Returns:
+        dict: flux (mJy/beam), its uncertainty, the local rms and the signal to noise
+    """
+    nan_result = {'forced_flux': np.nan, 'forced_flux_err': np.nan, 'local_rms': np.nan, 'snr': np.nan}
+    if not (0 <= x < image.shape[1] and 0 <= y < image.shape[0]):
+        return nan_result
+
+    half_box = int(np.ceil(box_beams * image.beam_major))
+    xc, yc = int(round(x)), int(round(y))
+    x0, y0 = max(xc - half_box, 0), max(yc - half_box, 0)
+    data = image.read_region(xc - half_box, xc + half_box + 1, yc - half_box, yc + half_box + 1)
+
+    yy, xx = np.mgrid[y0:y0 + data.shape[0], x0:x0 + data.shape[1]]
+    kernel = image.beam(xx - x, yy - y)
+
+    if rms_image is not None:
+        noise = rms_image.read_region(xc - half_box, xc + half_box + 1, yc - half_box, yc + half_box + 1)
+    else:
+        # robust standard deviation of the pixels outside the central beams
+        half_noise_box = int(np.ceil(noise_beams * image.beam_major))
+        noise_x0, noise_y0 = max(xc - half_noise_box, 0), max(yc - half_noise_box, 0)
+        noise_data = image.read_region(xc - half_noise_box, xc + half_noise_box + 1,
+                                       yc - half_noise_box, yc + half_noise_box + 1)
+        noise_yy, noise_xx = np.mgrid[noise_y0:noise_y0 + noise_data.shape[0], noise_x0:noise_x0 + noise_data.shape[1]]
+        outside = np.hypot(noise_xx - x, noise_yy - y) > box_beams * image.beam_major
+        background = noise_data[outside & np.isfinite(noise_data)]
+        if background.size == 0:
+            return nan_result
+        noise = np.full(data.shape, 1.4826 * np.median(np.abs(background - np.median(background))))
+
+    valid = np.isfinite(data) & np.isfinite(noise) & (noise > 0)
+    if not valid.any():
+        return nan_result
+
+    # weighted least squares amplitude of the beam, as in VAST forced photometry
+    weights = kernel[valid] ** 2 / noise[valid] ** 2
+    flux = np.sum(kernel[valid] * data[valid] / noise[valid] ** 2) / np.sum(weights)
+    flux_err = 1 / np.sqrt(np.sum(weights))
+    local_rms = float(np.median(noise[valid]))
+
+    return {'forced_flux': flux, 'forced_flux_err': flux_err, 'local_rms': local_rms, 'snr': flux / flux_err}
+
+
+def forced_photometry_image(image_path: str, positions: pd.DataFrame, rms_path: str = None, **kwargs) -> pd.DataFrame:
+    """Forced photometry of many positions in one image, opening the image once
+
+    Args:
+        image_path (str): path of the FITS image
+        positions (pd.DataFrame): positions with 'ra' and 'dec' columns in degrees
+        rms_path (str, optional): path of the matching noise map. Defaults to None.
+        **kwargs: passed on to 'measure'
+
+    Returns:
+        DataFrame: positions with the pixel coordinates and the forced photometry columns added
+    """
+    rms_image = MappedImage(rms_path) if rms_path else None
+    try:
+        with MappedImage(image_path) as image:
+            x, y = image.world_to_pixel(positions['ra'].to_numpy(dtype=np.float64),
+                                        positions['dec'].to_numpy(dtype=np.float64))
+            measurements = [measure(image, xi, yi, rms_image=rms_image, **kwargs) for xi, yi in zip(np.atleast_1d(x), np.atleast_1d(y))]
+    finally:
+        if rms_image is not None:
+            rms_image.close()
+
+    return positions.assign(image=os.path.basename(image_path), x=x, y=y).reset_index(drop=True).join(pd.DataFrame(measurements))
+
+
+def forced_photometry(tasks: pd.DataFrame, max_workers: int = 8, **kwargs) -> pd.DataFrame:
+    """Forced photometry of every planet and epoch, batched per image over a thread pool
+
+    Args:
+        tasks (pd.DataFrame): one row per planet and epoch with 'image_path', 'ra' and 'dec' (the proper
+            motion corrected position at that epoch) and optionally 'rms_path' and identifying columns
+            such as 'pl_name' and 'epoch', which are passed through
+        max_workers (int, optional): number of threads. Defaults to 8.
+        **kwargs: passed on to 'measure'
+
+    Returns:
+        DataFrame: the tasks with the forced photometry columns added
+    """
+    if 'rms_path' not in tasks:
+        tasks = tasks.assign(rms_path=None)
+
+    def run_image(group):
+        (image_path, rms_path), positions = group
+        try:
+            return forced_photometry_image(image_path, positions, rms_path=rms_path, **kwargs)
+        except (OSError, KeyError, ValueError) as e:
+            logger.error(f"Forced photometry failed for {image_path}. Reason: {e}")
+            return positions.assign(image=os.path.basename(image_path), forced_flux=np.nan, forced_flux_err=np.nan)
+
+    groups = tasks.groupby(['image_path', tasks['rms_path'].fillna('')], sort=False)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(run_image, groups))
+
+    logger.info(f"Forced photometry measured {len(tasks)} positions in {len(results)} images")
+
+    if not results:
+        return tasks.assign(forced_flux=[], forced_flux_err=[])
+
+    return pd.concat(results, ignore_index=True)
+
+
+def catalogue_images(filenames: pd.Series, image_path: str = CASDA_IMAGE_DOWNLOAD_PATH) -> pd.DataFrame:
+    """Paths of the image and noise map each selavy catalogue was extracted from, e.g.
+    selavy-image.i.VAST_1453-62.SB50301.cont.taylor.0.restored.conv.components.xml comes from
+    image.i.VAST_1453-62.SB50301.cont.taylor.0.restored.conv.fits with the noise map
+    noiseMap.image.i.VAST_1453-62.SB50301.cont.taylor.0.restored.conv.fits
+
+    Args:
+        filenames (pd.Series): catalogue filenames
+        image_path (str, optional): directory of the downloaded images. Defaults to casda_image_downloads.
+
+    Returns:
+        DataFrame: 'image_path' and 'rms_path' of each catalogue, missing where the file is not downloaded
+    """
+    stems = filenames.astype(str).str.removeprefix('selavy-').str.removesuffix(CATALOGUE_SUFFIX)
+    image_paths = [os.path.join(image_path, stem + IMAGE_SUFFIX) for stem in stems]
+    rms_paths = [os.path.join(image_path, 'noiseMap.' + stem + IMAGE_SUFFIX) for stem in stems]
+
+    return pd.DataFrame({'image_path': [path if os.path.isfile(path) else None for path in image_paths],
+                         'rms_path': [path if os.path.isfile(path) else None for path in rms_paths]},
+                        index=filenames.index)
+
+
+def planet_epoch_tasks(planets: pd.DataFrame, pubdat: pd.DataFrame, image_path: str = CASDA_IMAGE_DOWNLOAD_PATH,
+                       detections: pd.DataFrame = None) -> pd.DataFrame:
+    """One task per planet and epoch whose image is downloaded, with the planet proper motion
+    corrected to that epoch, the input of 'forced_photometry' and stacking.stack_planets
+
+    Args:
+        planets (pd.DataFrame): planets with 'pl_name', 'ra', 'dec', 'sy_pmra', 'sy_pmdec' and 'sy_dist'
+        pubdat (pd.DataFrame): CASDA public data table
+        image_path (str, optional): directory of the downloaded images. Defaults to casda_image_downloads.
+        detections (pd.DataFrame, optional): matches with 'planet' (name without spaces) and
+            'source_filename', whose planet-epochs are left out. Defaults to None.
+
+    Returns:
+        DataFrame: 'pl_name', 'source_filename', 'epoch', corrected 'ra'/'dec', 'image_path' and 'rms_path'
+    """
+    # imported here so the photometry of given tasks needs no CASDA modules
+    import proper_motion
+    from light_curves import catalogue_basename
+    from sky_separation import search_around
+
+    task_columns = ['pl_name', 'source_filename', 'epoch', 'ra', 'dec', 'image_path', 'rms_path']
+
+    # the same continuum catalogues casda_search downloads, with the images they come from
+    catalogues = pubdat[pubdat['filename'].str.contains(r'.*.cont.taylor.0.restored.conv.components.xml$', regex=True)]
+    catalogues = catalogues.assign(basename=catalogue_basename(catalogues['filename'])).drop_duplicates('basename')
+    catalogues = catalogues.join(catalogue_images(catalogues['basename'], image_path))
+    catalogues = catalogues[catalogues['image_path'].notna()]
+
+    planet_index, catalogue_index, _ = search_around(planets['ra'].to_numpy(dtype=np.float64),
+                                                     planets['dec'].to_numpy(dtype=np.float64),
+                                                     catalogues['s_ra'].to_numpy(dtype=np.float64),
+                                                     catalogues['s_dec'].to_numpy(dtype=np.float64),
+                                                     CATALOGUE_SEARCH_RADIUS)
+    tasks = pd.DataFrame({'pl_name': planets['pl_name'].to_numpy()[planet_index],
+                          'source_filename': catalogues['basename'].to_numpy()[catalogue_index],
+                          'epoch': catalogues['t_max'].to_numpy(dtype=np.float64)[catalogue_index],
+                          'image_path': catalogues['image_path'].to_numpy()[catalogue_index],
+                          'rms_path': catalogues['rms_path'].to_numpy()[catalogue_index]})
+
+    if detections is not None and not detections.empty:
+        detected = pd.MultiIndex.from_arrays([detections['planet'], catalogue_basename(detections['source_filename'])])
+        keys = pd.MultiIndex.from_arrays([tasks['pl_name'].str.replace(' ', ''), tasks['source_filename']])
+        keep = ~keys.isin(detected)
+        tasks, planet_index = tasks[keep].reset_index(drop=True), planet_index[keep]
+
+    if tasks.empty:
+        return pd.DataFrame(columns=task_columns)
+
+    # every planet is corrected to the epoch of each image rather than to the one epoch of its crossmatch
+    tasks['ra'], tasks['dec'] = proper_motion.proper_correct_positions(planets.iloc[planet_index], tasks['epoch'])
+
+    return tasks.sort_values(['pl_name', 'epoch'], ignore_index=True)[task_columns]
+
+
+def build_forced_photometry(planets: pd.DataFrame, pubdat: pd.DataFrame = None, image_path: str = CASDA_IMAGE_DOWNLOAD_PATH,
+                            matches_path: str = CASDA_MATCHES_PATH, **kwargs) -> pd.DataFrame:
+    """Pipeline stage measuring every planet in every downloaded image covering it, saved as
+    forced_photometry.csv next to the matches
+
+    Args:
+        planets (pd.DataFrame): planets with 'pl_name', their positions and proper motions
+        pubdat (pd.DataFrame, optional): CASDA public data table. Defaults to the cached pubdat.
+        image_path (str, optional): directory of the downloaded images. Defaults to casda_image_downloads.
+        matches_path (str, optional): directory of the match files. Defaults to casda_matches.
+        **kwargs: passed on to 'forced_photometry'
+
+    Returns:
+        DataFrame: measurements from 'forced_photometry'
+    """
+    if pubdat is None:
+        from casda_util import get_public_data_table
+        pubdat = get_public_data_table()
+
+    tasks = planet_epoch_tasks(planets, pubdat, image_path=image_path)
+    if tasks.empty:
+        logger.info(f"Forced photometry: no downloaded images in {image_path} cover the planets")
+    photometry = forced_photometry(tasks, **kwargs)
+
+    os.makedirs(matches_path, exist_ok=True)
+    photometry.to_csv(os.path.join(matches_path, "forced_photometry.csv"), index=False)
+
+    return photometry
@@ -0,0 +1,77 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+# Import the centralized logger
+from logger_config import logger
+
+
+# Columns every planet of a host shares, the proper motion correction and the CASDA searches only depend on them
+HOST_POSITION_COLUMNS = ['ra', 'dec', 'sy_pmra', 'sy_pmdec', 'sy_dist']
+
+CASDA_MATCHES_PATH = os.path.join(os.path.dirname(__file__), "casda_matches\\")
+
+
+def host_key(planets: pd.DataFrame) -> pd.Series:
+    """Host star of each planet: its Gaia id, the host name where there is none, and the planet
+    name where neither is known
+
+    Args:
+        planets (pd.DataFrame): planets with 'pl_name' and optionally 'gaia_id' and 'hostname'
+
+    Returns:
+        Series: host key of each planet
+    """
+    key = planets['pl_name'].astype(object)
+    for column in ['hostname', 'gaia_id']:
+        if column in planets:
+            host = planets[column].astype(object)
+            key = host.where(host.notna(), key)
+
+    return key
+
+
+def group_by_host(planets: pd.DataFrame) -> list:
+    """Planets grouped by host star, so multi-planet systems are searched once per star
+
+    Planets of one host are only grouped when their positions, proper motions and distances are
+    identical too, planets whose parameters come from different references stay apart.
+
+    Args:
+        planets (pd.DataFrame): planets with 'pl_name' and HOST_POSITION_COLUMNS
+
+    Returns:
+        list: index labels of the planets of each host, hosts and planets in the order of the table
+    """
+    keys = [host_key(planets)] + [planets[column].to_numpy(dtype=np.float64) for column in HOST_POSITION_COLUMNS]
+    codes = pd.DataFrame(dict(enumerate(keys)), index=planets.index).groupby(list(range(len(keys))), sort=False,
+                                                                             dropna=False).ngroup().to_numpy()
+
+    order = np.argsort(codes, kind='stable')
+    boundaries = np.flatnonzero(np.diff(codes[order])) + 1
+    groups = [planets.index[positions] for positions in np.split(order, boundaries)] if len(planets) else []
+
+    logger.info(f"{len(planets)} planets around {len(groups)} host stars, "
+                f"{sum(len(group) > 1 for group in groups)} with several planets")
+
+    return groups
+
+
+def fan_out_matches(output_filename: str, planet_output_filenames: list, matches_path: str = CASDA_MATCHES_PATH) -> None:
+    """Copy the matches of a host, saved under one of its planets, to the match file of each other
+    planet of the host, which light_curves and upper_limits read planet by planet
+
+    Args:
+        output_filename (str): name of the match file of the host
+        planet_output_filenames (list): names of the match files of the other planets
+        matches_path (str, optional): directory of the match files. Defaults to CASDA_MATCHES_PATH.
+    """
+    host_matches = matches_path + output_filename + ".csv"
+    if not os.path.isfile(host_matches):
+        return
+
+    for planet_output_filename in planet_output_filenames:
+        if planet_output_filename != output_filename:
+            shutil.copyfile(host_matches, matches_path + planet_output_filename + ".csv")
@@ -0,0 +1,111 @@
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+
+# Modules whose import must stay cheap, with the heavy dependencies they must not pull in
+LIGHT_MODULES = {
+    'main': ['pandas', 'numpy', 'scipy', 'astropy', 'astroquery', 'matplotlib'],
+    'logger_config': ['pandas', 'numpy', 'scipy', 'astropy', 'astroquery'],
+    'run_metrics': ['pandas', 'numpy', 'scipy', 'astropy', 'astroquery'],
+    'sky_separation': ['pandas', 'scipy', 'astropy', 'astroquery'],
+    'light_curves': ['scipy', 'astropy', 'astroquery'],
+    'casda_tap': ['scipy', 'astropy', 'astroquery'],
+    'upper_limits': ['astropy', 'astroquery'],
+}
+
+# Wall time budgets in seconds, including interpreter startup
+MAX_IMPORT_SECONDS = 0.5
+MAX_HELP_SECONDS = 0.5
+
+PIPELINE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_python(code: str, cwd: str) -> float:
+    """Time a fresh interpreter running a snippet with the pipeline directory on the path
+
+    Args:
+        code (str): python code to run
+        cwd (str): working directory of the interpreter
+
+    Returns:
+        float: wall time in seconds
+    """
+    environment = {**os.environ, 'PYTHONPATH': PIPELINE_DIRECTORY}
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], cwd=cwd, env=environment, check=True, stdout=subprocess.DEVNULL)
+
+    return time.perf_counter() - start
+
+
+def loaded_heavy_modules(module: str, heavy_modules: list, cwd: str) -> list:
+    """Heavy dependencies loaded as a side effect of importing a module
+
+    Args:
+        module (str): module to import
+        heavy_modules (list): top-level names of the heavy dependencies
+        cwd (str): working directory of the interpreter
+
+    Returns:
+        list: heavy dependencies that were imported
+    """
+    code = (f"import sys, json, {module}; "
+            f"print(json.dumps(sorted({{name.split('.')[0] for name in sys.modules}} & set({heavy_modules!r}))))")
+    environment = {**os.environ, 'PYTHONPATH': PIPELINE_DIRECTORY}
+    result = subprocess.run([sys.executable, '-c', code], cwd=cwd, env=environment, check=True,
+                            capture_output=True, text=True)
+
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(repeats: int = 5) -> int:
+    """Benchmark the import time of the entry point and check that light modules stay light
+
+    Args:
+        repeats (int, optional): number of timed runs, the median is reported. Defaults to 5.
+
+    Returns:
+        int: 0 if every check passes, 1 otherwise
+    """
+    failures = []
+
+    # run from an empty directory so nothing can be written next to the pipeline
+    with tempfile.TemporaryDirectory() as cwd:
+        baseline = statistics.median(run_python("pass", cwd) for _ in range(repeats))
+        import_time = statistics.median(run_python("import main", cwd) for _ in range(repeats))
+        help_time = statistics.median(run_python("import sys, main; sys.argv = ['main.py', '--help']\n"
+                                                 "try:\n    main.parse_args()\nexcept SystemExit:\n    pass", cwd)
+                                      for _ in range(repeats))
+
+        print(f"interpreter startup: {baseline:.3f} s")
+        print(f"import main:         {import_time:.3f} s")
+        print(f"main.py --help:      {help_time:.3f} s")
+
+        if import_time > MAX_IMPORT_SECONDS:
+            failures.append(f"import main took {import_time:.3f} s, budget {MAX_IMPORT_SECONDS} s")
+        if help_time > MAX_HELP_SECONDS:
+            failures.append(f"main.py --help took {help_time:.3f} s, budget {MAX_HELP_SECONDS} s")
+
+        for module, heavy_modules in LIGHT_MODULES.items():
+            loaded = loaded_heavy_modules(module, heavy_modules, cwd)
+            if loaded:
+                failures.append(f"import {module} loads {', '.join(loaded)}")
+
+        if os.listdir(cwd):
+            failures.append(f"importing wrote files to the working directory: {os.listdir(cwd)}")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import-time benchmark of the pipeline entry point")
+    parser.add_argument('--repeats', type=int, default=5)
+    sys.exit(main(parser.parse_args().repeats))
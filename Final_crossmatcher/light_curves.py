@@ -0,0 +1,156 @@
+import os
+import glob
+
+import numpy as np
+import pandas as pd
+
+# Import the centralized logger
+from logger_config import logger
+
+
+CASDA_MATCHES_PATH = os.path.join(os.path.dirname(__file__), "casda_matches")
+
+# Columns of the matched selavy components kept in the light curves
+LIGHT_CURVE_COLUMNS = ['component_name', 'ra_deg_cont', 'dec_deg_cont', 'flux_peak', 'flux_peak_err',
+                       'flux_int', 'flux_int_err', 'rms_image', 'source_filename']
+
+
+def catalogue_basename(filenames: pd.Series) -> pd.Series:
+    """Strip the directory from catalogue filenames, whether saved with Windows or POSIX separators
+
+    Args:
+        filenames (pd.Series): catalogue filenames or paths
+
+    Returns:
+        Series: bare catalogue filenames
+    """
+    return filenames.astype(str).str.replace('\\', '/', regex=False).str.rsplit('/', n=1).str[-1]
+
+
+def load_matches(matches_path: str = CASDA_MATCHES_PATH) -> pd.DataFrame:
+    """Read all per-planet match files (<planet>_catalogues.csv) into a single DataFrame
+
+    Args:
+        matches_path (str, optional): directory of the match files. Defaults to casda_matches.
+
+    Returns:
+        DataFrame: all matches with a 'planet' column taken from the match filename
+    """
+    match_dfs = []
+    for match_file in sorted(glob.glob(os.path.join(matches_path, "*_catalogues.csv"))):
+        match_df = pd.read_csv(match_file, usecols=lambda column: column in LIGHT_CURVE_COLUMNS)
+        if match_df.empty:
+            continue
+        planet = os.path.basename(match_file)[:-len("_catalogues.csv")]
+        match_dfs.append(match_df.assign(planet=planet))
+
+    if not match_dfs:
+        return pd.DataFrame(columns=['planet'] + LIGHT_CURVE_COLUMNS)
+
+    return pd.concat(match_dfs, ignore_index=True)
+
+
+def append_planet_matches(planet: str, matches: pd.DataFrame, matches_path: str = CASDA_MATCHES_PATH) -> None:
+    """Add matches of a planet to its match file (<planet>_catalogues.csv), e.g. those of an
+    incremental crossmatch, so the light curves include them. Components already in the file are
+    not added again.
+
+    Args:
+        planet (str): planet name, spaces are removed for the filename as in main
+        matches (pd.DataFrame): matched components with 'component_name' and 'source_filename'
+        matches_path (str, optional): directory of the match files. Defaults to casda_matches.
+    """
+    match_file = os.path.join(matches_path, f"{planet.replace(' ', '')}_catalogues.csv")
+    if os.path.isfile(match_file):
+        matches = pd.concat([pd.read_csv(match_file), matches], ignore_index=True)
+
+    duplicated = pd.DataFrame({'catalogue': catalogue_basename(matches['source_filename']).to_numpy(),
+                               'component': matches['component_name'].to_numpy()}).duplicated().to_numpy()
+
+    os.makedirs(matches_path, exist_ok=True)
+    matches[~duplicated].to_csv(match_file, index=False)
+
+
+def light_curves(matches: pd.DataFrame, pubdat: pd.DataFrame) -> pd.DataFrame:
+    """Flux series of every matched planet, one row per planet and catalogue epoch
+
+    Where several components of one catalogue match a planet the brightest is kept.
+
+    Args:
+        matches (pd.DataFrame): matches with 'planet', 'source_filename' and flux columns
+        pubdat (pd.DataFrame): CASDA public data table with 'filename' and 't_max' columns
+
+    Returns:
+        DataFrame: planet, epoch (MJD, t_max of the catalogue) and fluxes, sorted by planet and epoch
+    """
+    epochs = pd.Series(pubdat['t_max'].to_numpy(), index=catalogue_basename(pubdat['filename'])).groupby(level=0).first()
+    matches = matches.assign(epoch=catalogue_basename(matches['source_filename']).map(epochs))
+
+    missing_epochs = matches['epoch'].isna()
+    if missing_epochs.any():
+        logger.info(f"{missing_epochs.sum()} matches have catalogues missing from pubdat and are left out of the light curves")
+        matches = matches[~missing_epochs]
+
+    brightest = matches.sort_values('flux_peak', ascending=False).drop_duplicates(['planet', 'epoch'])
+
+    return brightest.sort_values(['planet', 'epoch'], ignore_index=True)
+
+
+def light_curve_statistics(curves: pd.DataFrame) -> pd.DataFrame:
+    """Variability statistics of every light curve, computed with group-bys over all planets at once
+
+    Args:
+        curves (pd.DataFrame): light curves from 'light_curves'
+
+    Returns:
+        DataFrame: per planet the number of detections, first and last epoch, mean/max/std of the
+        peak flux, mean integrated flux, modulation index V = std / mean of the peak flux and the
+        eta statistic (weighted reduced chi-squared about the weighted mean peak flux)
+    """
+    weights = 1 / curves['flux_peak_err'].to_numpy(dtype=np.float64) ** 2
+    flux = curves['flux_peak'].to_numpy(dtype=np.float64)
+    weighted = curves[['planet']].assign(w=weights, wf=weights * flux, wf2=weights * flux ** 2)
+
+    grouped = curves.groupby('planet', sort=True)
+    statistics = pd.DataFrame({'n_detections': grouped['epoch'].count(),
+                               'first_epoch': grouped['epoch'].min(),
+                               'last_epoch': grouped['epoch'].max(),
+                               'flux_peak_mean': grouped['flux_peak'].mean(),
+                               'flux_peak_max': grouped['flux_peak'].max(),
+                               'flux_peak_std': grouped['flux_peak'].std(),
+                               'flux_int_mean': grouped['flux_int'].mean()})
+
+    weighted_sums = weighted.groupby('planet', sort=True).sum()
+    n = statistics['n_detections']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        statistics['modulation_index'] = statistics['flux_peak_std'] / statistics['flux_peak_mean']
+        statistics['eta'] = n / (n - 1).where(n > 1) * (weighted_sums['wf2'] / n - (weighted_sums['wf'] / n) ** 2 / (weighted_sums['w'] / n))
+
+    return statistics.reset_index()
+
+
+def build_light_curves(pubdat: pd.DataFrame = None, matches_path: str = CASDA_MATCHES_PATH):
+    """Pipeline stage aggregating all CASDA matches into light curves and their statistics,
+    saved as light_curves.csv and light_curve_statistics.csv next to the matches
+
+    Args:
+        pubdat (pd.DataFrame, optional): CASDA public data table. Defaults to the cached pubdat.
+        matches_path (str, optional): directory of the match files. Defaults to casda_matches.
+
+    Returns:
+        curves (DataFrame): light curves from 'light_curves'
+        statistics (DataFrame): statistics from 'light_curve_statistics'
+    """
+    if pubdat is None:
+        # imported here so the light curves can be rebuilt without a CASDA session
+        from casda_util import get_public_data_table
+        pubdat = get_public_data_table()
+
+    curves = light_curves(load_matches(matches_path), pubdat)
+    statistics = light_curve_statistics(curves)
+
+    curves.to_csv(os.path.join(matches_path, "light_curves.csv"), index=False)
+    statistics.to_csv(os.path.join(matches_path, "light_curve_statistics.csv"), index=False)
+    logger.info(f"Light curves built for {len(statistics)} planets over {curves['epoch'].nunique()} epochs")
+
+    return curves, statistics
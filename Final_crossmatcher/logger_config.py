@@ -1,21 +1,37 @@
 import logging
 
 
-def setup_logger():
+LOGGER_NAME = 'ExoplanetLogger'
+
+
+def setup_logger(log_path: str = 'out_exoplanets.txt', mode: str = 'w'):
     """Configure logger which will pipe all output from all files into a single text file.
     Note this system is also compatible with multithreading.
 
+    Nothing is written until an entry point calls this, so importing the pipeline modules
+    has no side effects. Calling it again does not add a second file handler.
+
+    Args:
+        log_path (str, optional): path of the log file. Defaults to 'out_exoplanets.txt'.
+        mode (str, optional): 'w' overwrites the log file, 'a' appends to it. Defaults to 'w'.
+
     Returns:
-        logger (Logger): logging variable to be called in all dependent files 
+        logger (Logger): logging variable to be called in all dependent files
         which need their output recorded
     """
-    logger = logging.getLogger('ExoplanetLogger')
-    logger.setLevel(logging.INFO)
-    handler = logging.FileHandler('out_exoplanets.txt', mode='w')  # Overwrite the file
+    logger = logging.getLogger(LOGGER_NAME)
+    if any(isinstance(handler, logging.FileHandler) for handler in logger.handlers):
+        return logger
+
+    handler = logging.FileHandler(log_path, mode=mode)
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     handler.setFormatter(formatter)
     logger.addHandler(handler)
-    logger.propagate = False
     return logger
 
-logger = setup_logger()
\ No newline at end of file
+
+# Shared by all modules, messages are discarded until setup_logger is called
+logger = logging.getLogger(LOGGER_NAME)
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
@@ -1,35 +1,60 @@
-import casda_util
-import proper_motion
-import crossmatcher
-import scipy
-import pandas as pd
-import numpy as np
 import os
-import getpass
+import gc
 import time
-from astroquery.casda import Casda
-
+import argparse
 
 # Import the centralized logger
-from logger_config import logger
+from logger_config import logger, setup_logger
+
+
+# Default memory budget of the catalogue cache (1 GB), as catalogue_cache.DEFAULT_MAX_BYTES
+DEFAULT_CATALOGUE_CACHE_BYTES = 1024 ** 3
 
 
-def main(debug: bool = False, verbose: bool = False):
+def main(debug: bool = False, verbose: bool = False, sky_order: bool = False,
+         catalogue_cache_bytes: int = DEFAULT_CATALOGUE_CACHE_BYTES,
+         download_cache_bytes: int = None, download_cache_policy: str = 'value',
+         probabilistic_matching: bool = False, sweep_radii: list = None,
+         fetch_mode: str = 'download', tap_client=None, persistent_staging: bool = False,
+         dry_run: bool = False, parse_workers: int = None, incremental: bool = False,
+         stage_cache: bool = True, resume: bool = True, memory_ceiling: int = None, trace_memory: bool = False,
+         forced_photometry: bool = False, stack: str = None):
     # Set current file as path
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    setup_logger()
+
+    # The pipeline stages pull in pandas, astropy and astroquery, so they are only
+    # imported once a run actually starts rather than when this module is loaded
+    import casda_util
+    import proper_motion
+    import crossmatcher
+    import catalogue_cache
+    import catalogue_parser
+    import disk_cache
+    import run_metrics
+    import light_curves
+    import result_store
+    import stage_cache as stage_cache_module
+    import memory_monitor
+    import host_groups
+    from astroquery.casda import Casda
+
+    # the memory ceiling is enforced on resident memory, a ceiling that cannot be measured would never apply
+    if memory_ceiling is not None and memory_monitor.current_rss() is None:
+        logger.error("--memory-ceiling needs the resident memory of the run, which cannot be measured here. "
+                     "Install psutil or run without a memory ceiling.")
+        return None
 
-    # Login to CASDA
-    username = input('Enter your CASDA username: ')
-    casda = Casda()
-    casda.login(username=username)
-    logger.info("Logged in successfully using interactive username input.")
-    
     if debug:
         logger.info("INITIAL HOT JUPITERS \\ NASA CATALOGUE FILTERING")
 
     # Search radius for crossmatching
     search_radius = 3
 
+    # A list of radii sweeps all of them in one run instead of one run per radius
+    if sweep_radii is not None:
+        search_radius = list(sweep_radii)
+
     # How many planets to sample and therefore which source file to use
     source = None
     sample_paths = {'10': ".\\Hot_Jupiters\\Hot_Jupiters_10_Samples.csv",
@@ -62,26 +87,192 @@ def main(debug: bool = False, verbose: bool = False):
     # List of planets with GAIA 2 ID
     source_list_filtered = proper_motion.filter_for_gaia(source_list_sorted)
 
+    # Plan the run from the cached pubdat and catalogues only, without logging in to CASDA
+    if dry_run:
+        import run_planner
+        if not casda_util.check_casda_cache():
+            logger.info("DRY RUN NEEDS A CACHED PUBDAT, run once without --dry-run first")
+            return None
+        plan = run_planner.plan_run(source_list_filtered, casda_util.get_public_data_table())
+        run_planner.log_plan(plan)
+        return plan
+
+    # Login to CASDA
+    username = input('Enter your CASDA username: ')
+    casda = Casda()
+    casda.login(username=username)
+    logger.info("Logged in successfully using interactive username input.")
+    
+    # Stage outputs are cached under a hash of their inputs, and a run that died part way resumes
+    # from its journal if the parameters, pubdat snapshot and code are unchanged
+    run_parameters = {'source': source, 'search_radius': search_radius, 'fetch_mode': fetch_mode,
+                      'probabilistic_matching': probabilistic_matching}
+    casda_util.get_public_data_table()
+    stage_outputs = stage_cache_module.StageCache(enabled=stage_cache)
+
+    # All crossmatch results of this run are appended to the result store under one run id,
+    # a resumed run keeps appending under the id of the run it resumes. Incremental runs keep
+    # their own ledger (see delta_crossmatch) and leave the journal of planet by planet runs alone.
+    resumed = False
+    if incremental:
+        result_store.start_run({**run_parameters, 'incremental': True})
+    else:
+        run_journal = stage_cache_module.RunJournal(stage_cache_module.stage_key('run', pubdat=stage_cache_module.pubdat_version(),
+                                                                                 **run_parameters),
+                                                    resume=resume)
+        if run_journal.run_id is not None:
+            resumed = True
+            result_store.resume_run(run_journal.run_id)
+        else:
+            run_journal.start(result_store.start_run(run_parameters))
+
     if debug:
         logger.info(f"GAIA2-filtered no-duplicate source list sorted by latest update: {source_list_filtered}")
 
     # Make csv of gaia only planets
     source_list_filtered.to_csv('.\\Hot_Jupiters\\Filtered_NASA_only_GAIA.csv')
 
+    # Memory budget of the parsed catalogue cache shared between planets
+    catalogue_cache.catalogue_cache.max_bytes = catalogue_cache_bytes
+
+    # With a memory ceiling the run streams: catalogues are read one at a time, the catalogue cache
+    # gets a quarter of the ceiling and is emptied whenever resident memory goes above the ceiling
+    streaming = memory_ceiling is not None
+    if streaming:
+        catalogue_cache.catalogue_cache.max_bytes = min(catalogue_cache_bytes, memory_ceiling // 4)
+
+    # Catalogues are parsed by a process pool kept for the whole run, None uses every core
+    if parse_workers is not None:
+        catalogue_parser.catalogue_parser.max_workers = parse_workers
+
+    # Order planets along a curve over the sky so planets sharing CASDA fields are
+    # processed consecutively and reuse the cached catalogues
+    if sky_order:
+        source_list_filtered = catalogue_cache.sort_by_sky_curve(source_list_filtered)
+
+    # Keep the download directories within a fixed quota, if one is set. Catalogue tiles
+    # covering the fewest planets of this sample are evicted first under the 'value' policy.
+    xml_disk_cache = None
+    csv_disk_cache = None
+    if download_cache_bytes is not None:
+        xml_disk_cache = disk_cache.DiskCacheManager(os.path.join(os.path.dirname(__file__), "casda_xml_downloads\\"),
+                                                     download_cache_bytes, policy=download_cache_policy)
+        csv_disk_cache = disk_cache.DiskCacheManager(os.path.join(os.path.dirname(__file__), "casda_csv_downloads\\"),
+                                                     download_cache_bytes, policy='lru')
+        pubdat = casda_util.get_public_data_table()
+        coverage = disk_cache.tile_planet_coverage(pubdat, source_list_filtered)
+        if download_cache_policy == 'value':
+            xml_disk_cache.set_values(coverage)
+        # tiles covering this run's planets are never evicted before the run finishes, the cap is kept
+        # by evicting the tiles of other samples
+        xml_disk_cache.pin([filename for filename, count in coverage.items() if count > 0])
+
+        logger.info(f"Download cache usage: {xml_disk_cache.usage_report()}")
+
+    # Incremental mode only fetches the catalogues released since the last run over this sample
+    # and matches them against every planet at once, instead of looping over the planets
+    if incremental:
+        import delta_crossmatch
+        run_start = time.time()
+        casda_staging = None
+        if persistent_staging:
+            import staging_manager
+            casda_staging = staging_manager.StagingManager(casda)
+        try:
+            delta_summary = delta_crossmatch.run_delta(casda, source_list_filtered, source, search_radius,
+                                                       staging_manager=casda_staging, disk_cache=xml_disk_cache)
+        finally:
+            if casda_staging is not None:
+                casda_staging.close()
+            catalogue_parser.catalogue_parser.close()
+
+        # delta matches are appended to the result store and to the per-planet match files
+        logger.info(f"Delta crossmatch stored {int(delta_summary['n_matches'].sum())} matches "
+                    f"from {len(delta_summary)} catalogues")
+
+        # the light curves and upper limits are rebuilt from all matches so far, including this update
+        light_curves.build_light_curves()
+        import upper_limits
+        upper_limits.build_upper_limits(source_list_filtered)
+        if forced_photometry:
+            import forced_photometry as forced_photometry_module
+            forced_photometry_module.build_forced_photometry(source_list_filtered)
+        if stack is not None:
+            import stacking
+            stacking.build_stacks(source_list_filtered, population=stack == 'population')
+        if xml_disk_cache is not None:
+            # the run is finished, its tiles are evicted like any other once the cap is exceeded
+            xml_disk_cache.unpin()
+            xml_disk_cache.enforce()
+        run_metrics.record('run_seconds', time.time() - run_start)
+        run_metrics.log_metrics()
+        run_metrics.write_metrics()
+        return delta_summary
+
+    # Planets of one host star share their position and proper motion, so every positional stage
+    # (closest catalogue, proper motion, CASDA search) runs once per star and the results fan out
+    planet_hosts = host_groups.group_by_host(source_list_filtered)
+    run_metrics.record('n_hosts', len(planet_hosts))
+
+    # In 'tap' mode only the components near each planet are fetched, with batched server-side
+    # cone queries for all planets, instead of downloading whole catalogues planet by planet
+    tap_components = None
+    if fetch_mode == 'tap':
+        import casda_tap
+        tap_hosts = source_list_filtered.loc[[host[0] for host in planet_hosts]]
+        # probabilistic matching needs every candidate within its uncertainty-scaled radius
+        tap_radius = (crossmatcher.probabilistic_search_radius(tap_hosts, search_radius) if probabilistic_matching
+                      else search_radius)
+        tap_components = casda_tap.cone_search_planets(tap_hosts, tap_radius, client=tap_client)
+        # planets without nearby components take their epoch from the closest catalogue centre
+        tap_pubdat = casda_util.get_public_data_table()
+
+    # Stage the catalogues of all planets in the background while earlier planets are crossmatched.
+    # Staging jobs are journalled, so a restarted run reuses the jobs that are still valid.
+    casda_staging = None
+    if persistent_staging and fetch_mode == 'download':
+        import staging_manager
+        casda_staging = staging_manager.StagingManager(casda)
+        pubdat = casda_util.get_public_data_table()
+        reduced_pubdat = pubdat[pubdat['filename'].str.contains(r'.*.cont.taylor.0.restored.conv.components.xml$', regex=True)]
+        coverage = disk_cache.tile_planet_coverage(reduced_pubdat, source_list_filtered)
+        _, files_to_stage = casda_util.split_cached_catalogues([filename for filename, count in coverage.items() if count > 0],
+                                                               os.path.join(os.path.dirname(__file__), "casda_xml_downloads\\"))
+        casda_staging.submit(reduced_pubdat[reduced_pubdat['filename'].isin(files_to_stage)])
+
     ##################################
     # Source by source crossmatching #
     ##################################
     # Set index of the loop to 0, this is used for counting when to add pauses to data retrieval. 
     # This time delay is needed to reduce the chance of CASDA erroring due to lack of access.
     i = 0
+    run_start = time.time()
+
+    # Peak and per-stage memory of the run, reported in the run metrics
+    memory = memory_monitor.MemoryMonitor(ceiling_bytes=memory_ceiling, trace=trace_memory)
+    memory.start()
+
+    # Planets whose catalogues were searched, each of their epochs without a detection gets an upper limit
+    searched_planets = []
+
+    # loop through each host star of the sourcelist, with one or more planets
+    for host_planets in planet_hosts:
 
-    # loop through each row of the sourcelist which corresponds with a planet
-    for index, row_source in source_list_filtered.iterrows():
+        # release the parsed catalogues before going over the memory ceiling any further
+        if memory.over_ceiling():
+            logger.info(f"Resident memory above the ceiling of {memory_ceiling} bytes, emptying the catalogue cache")
+            catalogue_cache.catalogue_cache.clear()
+            gc.collect()
+            run_metrics.increment('memory_ceiling_exceeded')
 
         ##########################################
         ## GETTING CURRENT EXAMINED SOURCE INFO ##
         ##########################################
 
+        # the first planet of the host stands for the star in the positional stages
+        index = host_planets[0]
+        row_source = source_list_filtered.loc[index]
+
         # ra and dec of planet
         source_ra = row_source['ra']
         source_dec = row_source['dec']
@@ -91,9 +282,26 @@ def main(debug: bool = False, verbose: bool = False):
         # Remove spaces from planet name 
         planet_name = row_source['pl_name'].replace(' ', '')
 
-        # make name of matches file
+        # planets finished before a resumed run stopped are not processed again
+        host_planet_names = source_list_filtered.loc[host_planets, 'pl_name'].tolist()
+        pending_planet_names = []
+        for host_planet_name in host_planet_names:
+            if host_planet_name not in run_journal.planets:
+                pending_planet_names.append(host_planet_name)
+                continue
+            # their epoch and corrected position are restored for the corrected list and the upper limits
+            run_journal.restore(host_planet_name, source_list_filtered)
+            if run_journal.searched(host_planet_name):
+                searched_planets.append(host_planet_name)
+        if not pending_planet_names:
+            continue
+
+        # make name of matches file, the matches of the host are saved under its first planet
         output_filename = f"{planet_name}_catalogues"
 
+        if debug and len(host_planet_names) > 1:
+            logger.info(f"HOST STAR OF PLANETS {host_planet_names}, SEARCHED ONCE")
+
         if debug:
             logger.info(f"EXAMINING SOURCE [planet name, ra, dec]: [{planet_name, source_ra, source_dec}]")
             logger.info(f"BEGINNING CASDA DOWNLOAD FOR SOURCE")
@@ -106,16 +314,26 @@ def main(debug: bool = False, verbose: bool = False):
             logger.info("BEGIN SOURCE PROPER MOTION CORRECTION")
 
         # catalogue file with epoch to proper motion correct to
-        pm_catalogue_filename = casda_util.casda_search_closest_catalogue(source_ra=source_ra, 
-                                                                          source_dec=source_dec, 
-                                                                          casda=casda,
-                                                                          debug=debug)
+        if tap_components is not None:
+            pm_catalogue_filename = casda_tap.closest_catalogue(tap_components, raw_planet_name, source_ra, source_dec,
+                                                                pubdat=tap_pubdat)
+        else:
+            with memory.stage('closest_catalogue'):
+                pm_catalogue_filename = stage_outputs.memoise(
+                    'closest_catalogue', {'pubdat': stage_cache_module.pubdat_version(), 'ra': source_ra, 'dec': source_dec},
+                    lambda: casda_util.casda_search_closest_catalogue(source_ra=source_ra, 
+                                                                      source_dec=source_dec, 
+                                                                      casda=casda,
+                                                                      disk_cache=xml_disk_cache,
+                                                                      staging_manager=casda_staging,
+                                                                      debug=debug))
         # pm_catalogue_filename = "selavy-image.i.VAST_1453-62.SB50301.cont.taylor.0.restored.conv.components.xml"
     
         # if no sources within 3 degrees, then just skip to next source
         if not pm_catalogue_filename:
             logger.info(f"NO CATALOGUES WITHIN 3 DEGREES OF SOURCE [planet name, ra, dec]: [{planet_name, source_ra, source_dec}]")
-
+            for host_planet_name in pending_planet_names:
+                run_journal.complete(host_planet_name, searched=False)
             continue
 
         if debug:
@@ -124,15 +342,29 @@ def main(debug: bool = False, verbose: bool = False):
         # extract epoch to proper motion correct to from pubdat
         pm_epoch = casda_util.extract_epoch_from_pubdat_catalogue(pm_catalogue_filename)
 
-        # add pm_epoch only to the row of row_source
-        source_list_filtered.at[index, 'epoch'] = pm_epoch
+        # add pm_epoch only to the rows of the planets of this host
+        source_list_filtered.loc[host_planets, 'epoch'] = pm_epoch
 
         if debug:
             logger.info(f"Modified source list (with added epoch): ")
             logger.info(source_list_filtered.head())
 
-        # perform proper motion correction for current planet
-        source_list_filtered = proper_motion.proper_correct_planet(source_list_filtered, raw_planet_name)
+        # perform proper motion correction once for the host, every planet of it moves alike
+        planet_rows = source_list_filtered.index.isin(host_planets)
+        pm_inputs = {column: row_source[column] for column in host_groups.HOST_POSITION_COLUMNS}
+        with memory.stage('proper_motion'):
+            ra_corrected, dec_corrected = stage_outputs.memoise(
+                'proper_motion', {**pm_inputs, 'epoch': pm_epoch},
+                lambda: proper_motion.proper_correct_positions(source_list_filtered.loc[[index]], [pm_epoch]))
+        source_list_filtered.loc[planet_rows, 'ra_corrected'] = ra_corrected[0]
+        source_list_filtered.loc[planet_rows, 'dec_corrected'] = dec_corrected[0]
+        host_position = {'epoch': pm_epoch, 'ra_corrected': ra_corrected[0], 'dec_corrected': dec_corrected[0]}
+
+        # probabilistic matching ranks every candidate within the uncertainty-scaled radius, so those are
+        # fetched by the search and reach the crossmatch instead of stopping at the flat radius below
+        host_search_radius = search_radius
+        if probabilistic_matching:
+            host_search_radius = crossmatcher.probabilistic_search_radius(source_list_filtered.loc[[index]], search_radius)
         
         if debug:
             logger.info(f"Modified source list (with added ra_corrected, dec_corrected): ")
@@ -144,8 +376,10 @@ def main(debug: bool = False, verbose: bool = False):
         proper_motion_downloads_path = os.path.join(os.path.dirname(__file__), "NASA_with_Proper_Motion\\")
         proper_motion_filename = f'{source_filename}_proper_corrected_NASA'
         
-        # Convert DataFrame of matches into a csv
-        casda_util.pandas_to_csv(proper_motion_filename, proper_motion_downloads_path, source_list_filtered)
+        # Convert DataFrame of matches into a csv. Streaming runs only write the current planet, which is all
+        # the crossmatching reads, and write the whole corrected list once at the end
+        casda_util.pandas_to_csv(proper_motion_filename, proper_motion_downloads_path,
+                                 source_list_filtered[planet_rows] if streaming else source_list_filtered)
 
         #############################
         ## SEARCH CASDA FOR SOURCE ##
@@ -156,22 +390,55 @@ def main(debug: bool = False, verbose: bool = False):
 
         # perform CASDA search on current planet
         # Unnamed: 0.1 stores the original index values, so its a bit of a 'hack' to use 
-        pm_corrected_source_ra = source_list_filtered.loc[source_list_filtered['pl_name'] == raw_planet_name, 'ra_corrected'].values[0]
-        pm_corrected_source_dec = source_list_filtered.loc[source_list_filtered['pl_name'] == raw_planet_name, 'dec_corrected'].values[0]
-        planet_matches = casda_util.casda_search(source_ra=pm_corrected_source_ra,
-                                                 source_dec=pm_corrected_source_dec,
-                                                 casda=casda,
-                                                 output_filename=output_filename,
-                                                 debug=debug)
+        pm_corrected_source_ra = source_list_filtered.at[index, 'ra_corrected']
+        pm_corrected_source_dec = source_list_filtered.at[index, 'dec_corrected']
+        if tap_components is not None:
+            planet_matches = casda_tap.planet_matches(tap_components, raw_planet_name,
+                                                      pm_corrected_source_ra, pm_corrected_source_dec,
+                                                      search_radius=host_search_radius,
+                                                      output_filename=output_filename)
+        else:
+            # a cached search is only reused while the csv files it wrote are still there
+            with memory.stage('casda_search'):
+                planet_matches = stage_outputs.memoise(
+                    'casda_search', {'pubdat': stage_cache_module.pubdat_version(), 'ra': pm_corrected_source_ra,
+                                     'dec': pm_corrected_source_dec, 'search_radius': host_search_radius,
+                                     'output_filename': output_filename},
+                    lambda: casda_util.casda_search(source_ra=pm_corrected_source_ra,
+                                                    source_dec=pm_corrected_source_dec,
+                                                    search_radius=host_search_radius,
+                                                    casda=casda,
+                                                    disk_cache=xml_disk_cache,
+                                                    staging_manager=casda_staging,
+                                                    output_filename=output_filename,
+                                                    debug=debug,
+                                                    streaming=streaming),
+                    valid=lambda _: all(os.path.isfile(path) for path in [f'.\\casda_csv_downloads\\{output_filename}.csv',
+                                                                          f'.\\casda_matches\\{output_filename}.csv']))
         # planet_matches = pd.read_csv(".\casda_matches\ProximaCenb_catalogues.csv")
 
+        # searched planets without a detection are only skipped here, their upper limits are computed at the end
+        searched_planets.extend(pending_planet_names)
+
+        # every planet of the host gets its own match file, for the light curves and upper limits
+        host_groups.fan_out_matches(output_filename, [f"{host_planet_name.replace(' ', '')}_catalogues"
+                                                      for host_planet_name in pending_planet_names])
+
+        # Keep the csv downloads within quota, keeping this planet's catalogues for crossmatching
+        if csv_disk_cache is not None:
+            csv_disk_cache.enforce(pinned=[f"{output_filename}.csv"])
+
         # If no matches, skip to next source
         if planet_matches is None:
-            logger.info(f"NO CASDA MATCHES WITHIN 3 ARCSECS OF SOURCE [planet name, ra, dec]: [{planet_name, source_ra, source_dec}]")
+            logger.info(f"NO CASDA MATCHES WITHIN {host_search_radius} ARCSECS OF SOURCE [planet name, ra, dec]: [{planet_name, source_ra, source_dec}]")
+            for host_planet_name in pending_planet_names:
+                run_journal.complete(host_planet_name, searched=True, position=host_position)
             continue
 
         if planet_matches.empty:
-            logger.info(f"NO CASDA MATCHES WITHIN 3 ARCSECS OF SOURCE [planet name, ra, dec]: [{planet_name, source_ra, source_dec}]")
+            logger.info(f"NO CASDA MATCHES WITHIN {host_search_radius} ARCSECS OF SOURCE [planet name, ra, dec]: [{planet_name, source_ra, source_dec}]")
+            for host_planet_name in pending_planet_names:
+                run_journal.complete(host_planet_name, searched=True, position=host_position)
             continue
 
         ###################
@@ -185,8 +452,21 @@ def main(debug: bool = False, verbose: bool = False):
         # retrieve CSV with proper motion corrected NASA data for the planet
         proper_motion_csv = f".\\NASA_with_Proper_Motion\\{source_filename}_proper_corrected_NASA.csv"
 
-        # Crossmatch between the proper motion corrected NASA file and the CASDA downloads
-        crossmatcher.crossmatch_planet(casda_csv,proper_motion_csv, search_radius, raw_planet_name)
+        # A resumed run may have stored this host's matches before it stopped, short of journalling the
+        # host as done, those are deleted so matching it again stores them once
+        if resumed:
+            n_deleted = result_store.delete_matches(pending_planet_names)
+            if n_deleted:
+                logger.info(f"Deleted {n_deleted} matches of {pending_planet_names} stored before the run stopped")
+
+        # Crossmatch between the proper motion corrected NASA file and the CASDA downloads, once for
+        # the host and stored for each of its planets
+        with memory.stage('crossmatch'):
+            crossmatcher.crossmatch_planet(casda_csv,proper_motion_csv, host_search_radius, raw_planet_name,
+                                           probabilistic=probabilistic_matching, host_planets=pending_planet_names)
+
+        for host_planet_name in pending_planet_names:
+            run_journal.complete(host_planet_name, searched=True, position=host_position)
 
         if debug:
             logger.info(f"CROSSMATCH SUCCESS FOR SOURCE [planet name, ra, dec]: [{planet_name, source_ra, source_dec}]")
@@ -199,7 +479,98 @@ def main(debug: bool = False, verbose: bool = False):
         
         i += 1
 
+    if casda_staging is not None:
+        casda_staging.close()
+    catalogue_parser.catalogue_parser.close()
+
+    if streaming:
+        casda_util.pandas_to_csv(f'{os.path.splitext(os.path.basename(source))[0]}_proper_corrected_NASA',
+                                 os.path.join(os.path.dirname(__file__), "NASA_with_Proper_Motion\\"), source_list_filtered)
+
+    # Aggregate all matches into multi-epoch light curves
+    light_curves.build_light_curves()
+
+    # Upper limits from the local noise for every searched planet and epoch without a detection
+    import upper_limits
+    upper_limits.build_upper_limits(source_list_filtered[source_list_filtered['pl_name'].isin(searched_planets)])
+
+    # Forced photometry of every searched planet in every downloaded image, at its position at each epoch
+    if forced_photometry:
+        import forced_photometry as forced_photometry_module
+        forced_photometry_module.build_forced_photometry(source_list_filtered[source_list_filtered['pl_name'].isin(searched_planets)])
+
+    # Image-plane stacks of the non-detections of every searched planet, and of the whole sample
+    if stack is not None:
+        import stacking
+        stacking.build_stacks(source_list_filtered[source_list_filtered['pl_name'].isin(searched_planets)],
+                              population=stack == 'population')
+
+    logger.info(f"Catalogue cache: {catalogue_cache.catalogue_cache.stats()}")
+    if xml_disk_cache is not None:
+        # the run is finished, its tiles are evicted like any other once the cap is exceeded
+        xml_disk_cache.unpin()
+        xml_disk_cache.enforce()
+        run_metrics.record('xml_download_cache', xml_disk_cache.usage_report())
+        run_metrics.record('csv_download_cache', csv_disk_cache.usage_report())
+    run_metrics.record('run_seconds', time.time() - run_start)
+    run_metrics.record('n_planets', len(source_list_filtered))
+    memory.stop()
+    run_metrics.log_metrics()
+    run_metrics.write_metrics()
+    run_journal.finish()
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    """Command line options of 'main'
+
+    Args:
+        argv (list, optional): command line arguments. Defaults to sys.argv[1:].
+
+    Returns:
+        Namespace: keyword arguments of 'main'
+    """
+    parser = argparse.ArgumentParser(description="Crossmatch exoplanets with CASDA continuum catalogues")
+    parser.add_argument('--debug', action=argparse.BooleanOptionalAction, default=True,
+                        help="log debug information (default: on)")
+    parser.add_argument('--verbose', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--sky-order', action='store_true',
+                        help="process planets along a curve over the sky so neighbouring planets reuse cached catalogues")
+    parser.add_argument('--catalogue-cache-bytes', type=int, default=DEFAULT_CATALOGUE_CACHE_BYTES,
+                        help="memory budget of the parsed catalogue cache")
+    parser.add_argument('--download-cache-bytes', type=int, default=None,
+                        help="size cap of each download directory (default: unbounded)")
+    parser.add_argument('--download-cache-policy', choices=['lru', 'value'], default='value')
+    parser.add_argument('--probabilistic-matching', action='store_true',
+                        help="rank candidates by match probability instead of using a flat radius")
+    parser.add_argument('--sweep-radii', type=float, nargs='+', default=None, metavar='ARCSEC',
+                        help="crossmatch at several radii in one run")
+    parser.add_argument('--fetch-mode', choices=['download', 'tap'], default='download',
+                        help="download whole catalogues or fetch only nearby components with TAP cone queries")
+    parser.add_argument('--persistent-staging', action='store_true',
+                        help="stage catalogues in the background with a journal that survives restarts")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="estimate the catalogues, bytes and wall time of the run from the local caches and stop")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only match the catalogues released since the last incremental run against every planet")
+    parser.add_argument('--stage-cache', action=argparse.BooleanOptionalAction, default=True,
+                        help="reuse stage outputs cached under a hash of their inputs")
+    parser.add_argument('--resume', action=argparse.BooleanOptionalAction, default=True,
+                        help="resume an unfinished run with the same parameters from its journal")
+    parser.add_argument('--memory-ceiling', type=int, default=None, metavar='BYTES',
+                        help="stream catalogues one at a time and keep resident memory within this many bytes")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="attribute memory to pipeline stages with tracemalloc (slower)")
+    parser.add_argument('--parse-workers', type=int, default=None,
+                        help="processes parsing catalogues, 1 parses in the main process (default: every core)")
+    parser.add_argument('--forced-photometry', action='store_true',
+                        help="measure every planet in the downloaded images (casda_image_downloads) at every epoch")
+    parser.add_argument('--stack', choices=['planets', 'population'], default=None,
+                        help="stack the non-detections of each planet across the downloaded images, "
+                             "'population' also stacks the whole sample (e.g. all hot Jupiters) together")
+
+    return parser.parse_args(argv)
+
 
 if __name__ == "__main__":
-    main(debug=True, verbose=True)
+    main(**vars(parse_args()))
   
\ No newline at end of file
@@ -0,0 +1,179 @@
+import os
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+import run_metrics
+
+# Import the centralized logger
+from logger_config import logger
+
+
+# Seconds between samples of the resident set size
+DEFAULT_SAMPLE_INTERVAL = 0.5
+
+
+def windows_rss() -> int:
+    """Working set of this process from the Windows process status API
+
+    Returns:
+        int: resident memory in bytes, None if the API is not available
+    """
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+    try:
+        kernel32, psapi = ctypes.WinDLL('kernel32'), ctypes.WinDLL('psapi')
+    except (AttributeError, OSError):
+        return None
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    psapi.GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters), wintypes.DWORD]
+    psapi.GetProcessMemoryInfo.restype = wintypes.BOOL
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    if not psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+        return None
+
+    return counters.WorkingSetSize
+
+
+def current_rss() -> int:
+    """Resident set size of this process, from psutil when it is installed, otherwise from the
+    Windows process status API or /proc
+
+    Returns:
+        int: resident memory in bytes, None where none of them is available
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+
+    if os.name == 'nt':
+        return windows_rss()
+
+    try:
+        with open("/proc/self/statm", 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class MemoryMonitor:
+    """Samples the resident memory of the run in a background thread and measures the memory of
+    each pipeline stage. Peak resident memory, and with tracing on the peak python allocations of
+    each stage, are recorded in the run metrics.
+    """
+
+    def __init__(self, ceiling_bytes: int = None, sample_interval: float = DEFAULT_SAMPLE_INTERVAL,
+                 trace: bool = False):
+        """
+        Args:
+            ceiling_bytes (int, optional): memory the run should stay within. Defaults to None (no ceiling).
+            sample_interval (float, optional): seconds between samples. Defaults to DEFAULT_SAMPLE_INTERVAL.
+            trace (bool, optional): trace python allocations with tracemalloc, which slows the run down
+                but attributes memory to stages. Defaults to False.
+        """
+        self.ceiling_bytes = ceiling_bytes
+        self.sample_interval = sample_interval
+        self.trace = trace
+        self.peak_rss = 0
+        self.peak_traced = 0
+        self.stage_peaks = {}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self) -> int:
+        """Take one sample of the resident memory
+
+        Returns:
+            int: resident memory in bytes, None if it cannot be measured
+        """
+        rss = current_rss()
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss, rss)
+
+        return rss
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.sample_interval):
+            self.sample()
+
+    def start(self) -> None:
+        """Start sampling and, if enabled, tracing"""
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.sample()
+        self.thread = threading.Thread(target=self.run, name="memory-monitor", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stop sampling and record the peaks in the run metrics"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.sample()
+
+        # where resident memory cannot be measured no peak is reported, rather than a peak of 0
+        if current_rss() is not None:
+            run_metrics.record('memory_peak_rss', self.peak_rss)
+        if self.ceiling_bytes is not None:
+            run_metrics.record('memory_ceiling', self.ceiling_bytes)
+        if tracemalloc.is_tracing():
+            self.peak_traced = max(self.peak_traced, tracemalloc.get_traced_memory()[1])
+            run_metrics.record('memory_peak_traced', self.peak_traced)
+            tracemalloc.stop()
+
+        logger.info(f"Peak resident memory: {self.peak_rss / 1024 ** 2:.1f} MB, per stage: {self.stage_peaks}")
+
+    @contextmanager
+    def stage(self, name: str):
+        """Measure the memory of a pipeline stage. The largest value over all calls of a stage is
+        kept, as 'memory_stage_<name>' in the run metrics: the peak traced allocations above the
+        start of the stage when tracing, otherwise the growth of resident memory over the stage.
+
+        Args:
+            name (str): name of the stage
+        """
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            # the peak is reset for the stage, so the run peak so far is kept first
+            start_traced, peak_traced = tracemalloc.get_traced_memory()
+            self.peak_traced = max(self.peak_traced, peak_traced)
+            tracemalloc.reset_peak()
+        start_rss = self.sample()
+
+        try:
+            yield
+        finally:
+            end_rss = self.sample()
+            if tracing:
+                stage_bytes = tracemalloc.get_traced_memory()[1] - start_traced
+            elif start_rss is not None and end_rss is not None:
+                stage_bytes = end_rss - start_rss
+            else:
+                stage_bytes = 0
+
+            self.stage_peaks[name] = max(self.stage_peaks.get(name, 0), stage_bytes)
+            run_metrics.record(f'memory_stage_{name}', self.stage_peaks[name])
+
+    def over_ceiling(self) -> bool:
+        """Whether resident memory is above the ceiling
+
+        Returns:
+            bool: True if a ceiling is set and the current resident memory exceeds it
+        """
+        if self.ceiling_bytes is None:
+            return False
+        rss = self.sample()
+
+        return rss is not None and rss > self.ceiling_bytes
@@ -0,0 +1,205 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+# Import the centralized logger
+from logger_config import logger
+
+
+# Bump when the columns, dtypes or parsing below change so old cached tables are not reused
+INGEST_VERSION = 1
+
+# Columns of the NASA Exoplanet Archive used by the pipeline, with explicit dtypes.
+# Identifiers and references are kept as python strings so str.contains filters work unchanged.
+PIPELINE_COLUMNS = {
+    'pl_name': object,
+    'hostname': object,
+    'gaia_id': object,
+    'sy_refname': object,
+    'rowupdate': object,
+    'ra': np.float64,
+    'dec': np.float64,
+    'sy_pmra': np.float64,
+    'sy_pmraerr1': np.float64,
+    'sy_pmdec': np.float64,
+    'sy_pmdecerr1': np.float64,
+    'sy_dist': np.float64,
+    'pl_orbper': np.float64,
+    'pl_massj': np.float64,
+}
+
+# Date formats of 'rowupdate': the hand-made samples use day first, the archive export uses ISO dates
+ROWUPDATE_FORMATS = ("%d/%m/%Y", "%Y-%m-%d")
+
+NASA_CACHE_FOLDER = os.path.join(os.path.dirname(__file__), "nasa_cache")
+
+# Content hashes of the source files with the size and modification time they were computed at
+HASH_INDEX_PATH = os.path.join(NASA_CACHE_FOLDER, "file_hashes.json")
+
+
+def file_hash(filepath: str, block_size: int = 1 << 20) -> str:
+    """SHA-1 hash of the contents of a file, read in blocks
+
+    Args:
+        filepath (str): path of the file
+        block_size (int, optional): number of bytes read at a time. Defaults to 1 MB.
+
+    Returns:
+        str: hexadecimal digest
+    """
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+
+def source_hash(filepath: str) -> str:
+    """Content hash of a source file, only recomputed when its size or modification time changed,
+    so unchanged files are recognised from a stat instead of reading them again
+
+    Args:
+        filepath (str): path of the file
+
+    Returns:
+        str: hexadecimal digest, as from 'file_hash'
+    """
+    stat = os.stat(filepath)
+    key = os.path.abspath(filepath)
+
+    hash_index = {}
+    if os.path.exists(HASH_INDEX_PATH):
+        try:
+            with open(HASH_INDEX_PATH, 'r') as f:
+                hash_index = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"Hash index {HASH_INDEX_PATH} could not be read, starting a new one. Reason: {e}")
+
+    entry = hash_index.get(key)
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['hash']
+
+    digest = file_hash(filepath)
+    hash_index[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest}
+
+    # write to a temporary file first so an interrupted run never leaves a partial index
+    os.makedirs(NASA_CACHE_FOLDER, exist_ok=True)
+    temporary_path = HASH_INDEX_PATH + ".tmp"
+    with open(temporary_path, 'w') as f:
+        json.dump(hash_index, f, indent=1)
+    os.replace(temporary_path, HASH_INDEX_PATH)
+
+    return digest
+
+
+def count_comment_lines(filepath: str) -> int:
+    """Count the '#' header lines at the top of an archive export (the full archive has 47 of them)
+
+    Args:
+        filepath (str): path of the csv file
+
+    Returns:
+        int: number of leading comment lines
+    """
+    n_lines = 0
+    with open(filepath, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            n_lines += 1
+
+    return n_lines
+
+
+def parse_rowupdate(rowupdate: pd.Series) -> pd.Series:
+    """Parse the 'rowupdate' dates using the first format in ROWUPDATE_FORMATS that fits all rows
+
+    Args:
+        rowupdate (pd.Series): dates as strings
+
+    Returns:
+        Series: dates as datetime64
+    """
+    for date_format in ROWUPDATE_FORMATS:
+        try:
+            return pd.to_datetime(rowupdate, format=date_format)
+        except (ValueError, TypeError):
+            continue
+
+    raise ValueError(f"'rowupdate' does not match any of the formats {ROWUPDATE_FORMATS}")
+
+
+def read_source_csv(source: str) -> pd.DataFrame:
+    """Read only the pipeline columns of a NASA Exoplanet Archive csv with explicit dtypes
+
+    Args:
+        source (str): csv filename of the archive export or of a sample taken from it
+
+    Returns:
+        DataFrame: the pipeline columns present in the file, with 'rowupdate' parsed to datetimes
+    """
+    source_table = pd.read_csv(source,
+                               skiprows=count_comment_lines(source),
+                               usecols=lambda column: column in PIPELINE_COLUMNS,
+                               dtype=PIPELINE_COLUMNS,
+                               low_memory=False)
+
+    if 'rowupdate' in source_table:
+        source_table['rowupdate'] = parse_rowupdate(source_table['rowupdate'])
+
+    return source_table
+
+
+def cache_format() -> str:
+    """Columnar parquet when pyarrow is installed, otherwise pickle
+
+    Returns:
+        str: file extension of the cached tables
+    """
+    try:
+        import pyarrow  # noqa: F401
+        return 'parquet'
+    except ImportError:
+        return 'pkl'
+
+
+def load_source_table(source: str, refresh: bool = False) -> pd.DataFrame:
+    """Load a NASA Exoplanet Archive csv through a cache of converted tables keyed by the hash
+    of the csv, so only the first run over a file pays for parsing it. The hash is only recomputed
+    when the size or modification time of the csv changed (see 'source_hash').
+
+    Args:
+        source (str): csv filename of the archive export or of a sample taken from it
+        refresh (bool, optional): re-read the csv even if a cached table exists. Defaults to False.
+
+    Returns:
+        DataFrame: the pipeline columns of the source file
+    """
+    extension = cache_format()
+    stem = os.path.splitext(os.path.basename(source))[0]
+    cache_key = f"{source_hash(source)[:16]}-v{INGEST_VERSION}"
+    cache_path = os.path.join(NASA_CACHE_FOLDER, f"{stem}-{cache_key}.{extension}")
+
+    if os.path.exists(cache_path) and not refresh:
+        if extension == 'parquet':
+            return pd.read_parquet(cache_path)
+        return pd.read_pickle(cache_path)
+
+    source_table = read_source_csv(source)
+
+    # write to a temporary file first so an interrupted run never leaves a partial table
+    os.makedirs(NASA_CACHE_FOLDER, exist_ok=True)
+    temporary_path = cache_path + ".tmp"
+    if extension == 'parquet':
+        source_table.to_parquet(temporary_path, index=False)
+    else:
+        source_table.to_pickle(temporary_path)
+    os.replace(temporary_path, cache_path)
+
+    logger.info(f"Cached source table {source} as {cache_path}")
+
+    return source_table
@@ -5,21 +5,20 @@ import astropy.units as un
 from astropy.time import Time, TimeDelta
 from astropy.coordinates import Angle, Latitude, Longitude
 
+import sample_selection
+from compact_schema import compact_sources
+
 # Intialise logger 
 from logger_config import logger  # Import the centralized logger
 
 def filter_for_gaia(source_list_sorted):
-    # Dropping rows from source_list_sorted with missing `gaia_id`
-    source_list_sorted = source_list_sorted.dropna(subset=['gaia_id'])
-
-    # Filtering out planet systems that don't have Gaia DR2 numbers, so that the same J2015.5 reference epoch can be used for all proper motion corrections below. 
-    source_list_filtered = source_list_sorted.loc[source_list_sorted["gaia_id"].str.contains('Gaia DR2')]
-
-    # Dropping rows from source_list_filtered with missing 'sy_refname' (system parameter reference). 
-    source_list_sorted_2 = source_list_filtered.dropna(subset=['sy_refname'])
+    # Keeping only planet systems with Gaia DR2 numbers and TICv8 (TESS Input Catalogue revised for Gaia DR2) 
+    # system parameter reference numbers, so that the same J2015.5 reference epoch can be used for all proper motion corrections below.
+    # Rows with a missing `gaia_id` or `sy_refname` are dropped by the same mask.
+    source_list_filtered_2 = sample_selection.select(source_list_sorted, sample_selection.GAIA_DR2_CRITERIA)
 
-    #Filtering out planet systems that don't have TICv8 (TESS Input Catalogue revised for Gaia DR2) system parameter reference numbers, so that J2015.5 reference epoch can be used. 
-    source_list_filtered_2 = source_list_sorted_2.loc[source_list_sorted_2['sy_refname'].str.contains('TICv8')]
+    # The references are not needed after the selection, the rest of the run carries the compact source list
+    source_list_filtered_2 = compact_sources(source_list_filtered_2)
 
     return source_list_filtered_2
 
@@ -63,4 +62,25 @@ def proper_correct_planet(hot_jupiter_source_df: pd.DataFrame, planet_name_to_co
         return hot_jupiter_source_df
     else:
         logger.info("Source list could not be initialized.")
-        return None
\ No newline at end of file
+        return None
+
+def proper_correct_positions(planets: pd.DataFrame, epochs):
+    """Proper motion correct many planets at once, each to its own epoch
+
+    Args:
+        planets (pd.DataFrame): planets with 'ra', 'dec', 'sy_pmra', 'sy_pmdec' and 'sy_dist' columns
+        epochs (ArrayLike): epoch (MJD) to correct each planet to, one per row of planets
+
+    Returns:
+        ra_corrected (NDArray[float64]): corrected right ascension in degrees
+        dec_corrected (NDArray[float64]): corrected declination in degrees
+    """
+    initial_coords = SkyCoord(planets["ra"].to_numpy() * un.deg, planets["dec"].to_numpy() * un.deg,
+                              pm_ra_cosdec=planets["sy_pmra"].to_numpy() * un.mas / un.yr,
+                              pm_dec=planets["sy_pmdec"].to_numpy() * un.mas / un.yr,
+                              frame='icrs', obstime=Time('J2015.5'),
+                              distance=planets["sy_dist"].to_numpy() * un.pc)
+
+    propermotion_coords = initial_coords.apply_space_motion(Time(np.asarray(epochs, dtype=np.float64), format='mjd'))
+
+    return propermotion_coords.ra.deg, propermotion_coords.dec.deg
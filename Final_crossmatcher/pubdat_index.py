@@ -0,0 +1,190 @@
+import functools
+
+import numpy as np
+import pandas as pd
+
+# Import the centralized logger
+from logger_config import logger
+
+
+# Survey, field and scheduling block id of a selavy catalogue filename,
+# e.g. selavy-image.i.VAST_1453-62.SB50301.cont.taylor.0.restored.conv.components.xml
+SELAVY_FILENAME_PATTERN = r'^selavy-image\.[^.]+\.(?P<survey>[A-Za-z]+)_(?P<field>[^.]+)\.SB(?P<sbid>\d+)\.'
+
+# Spacing of the fields on the combined (field, time) sort key, in days. MJDs stay far below it and
+# float64 still resolves well under a second at the largest keys.
+FIELD_KEY_STRIDE = 1e6
+
+
+def parse_selavy_filename(filenames: pd.Series) -> pd.DataFrame:
+    """Decode the survey, field and scheduling block id of selavy catalogue filenames
+
+    Args:
+        filenames (pd.Series): catalogue filenames
+
+    Returns:
+        DataFrame: 'survey' (e.g. 'VAST'), 'field' (e.g. 'VAST_1453-62') and 'sbid' (e.g. 50301),
+        missing for filenames that do not follow the selavy naming
+    """
+    parts = filenames.astype(str).str.extract(SELAVY_FILENAME_PATTERN)
+
+    return pd.DataFrame({'survey': parts['survey'],
+                         'field': (parts['survey'] + '_' + parts['field']),
+                         'sbid': pd.to_numeric(parts['sbid']).astype('Int64')}, index=filenames.index)
+
+
+class PubdatIndex:
+    """Index of the CASDA public data table for epoch and field queries.
+
+    Catalogues are sorted on a combined key of their field and start time (and, separately, of
+    their field and epoch), so time windows and nearest epochs are found with binary searches,
+    for any number of fields in one vectorised call, instead of masking the whole table.
+    """
+
+    def __init__(self, pubdat: pd.DataFrame):
+        """
+        Args:
+            pubdat (pd.DataFrame): public data table with 'filename', 't_min' and 't_max' (MJD)
+        """
+        catalogues = pubdat.drop_duplicates('filename').reset_index(drop=True)
+        catalogues = pd.concat([catalogues, parse_selavy_filename(catalogues['filename'])], axis=1)
+        self.catalogues = catalogues
+
+        # epoch (t_max) of every catalogue, as casda_util.extract_epoch_from_pubdat_catalogue
+        self.epochs = pd.Series(catalogues['t_max'].to_numpy(dtype=np.float64), index=catalogues['filename'])
+
+        indexed = catalogues[catalogues['field'].notna()]
+        self.field_codes = pd.Index(np.sort(indexed['field'].unique()))
+        codes = self.field_codes.get_indexer(indexed['field']).astype(np.float64)
+        t_min = indexed['t_min'].to_numpy(dtype=np.float64)
+        t_max = indexed['t_max'].to_numpy(dtype=np.float64)
+        rows = indexed.index.to_numpy()
+
+        # windows: sorted by (field, t_min), with the longest observation bounding how far back an overlap can start
+        order = np.argsort(codes * FIELD_KEY_STRIDE + t_min, kind='stable')
+        self.start_keys = (codes * FIELD_KEY_STRIDE + t_min)[order]
+        self.start_rows = rows[order]
+        self.max_duration = float(np.nanmax(t_max - t_min)) if len(rows) else 0.0
+
+        # nearest epochs: sorted by (field, t_max)
+        order = np.argsort(codes * FIELD_KEY_STRIDE + t_max, kind='stable')
+        self.epoch_keys = (codes * FIELD_KEY_STRIDE + t_max)[order]
+        self.epoch_rows = rows[order]
+        self.epoch_codes = codes[order]
+
+        logger.info(f"Pubdat index: {len(catalogues)} catalogues, {len(indexed)} in {len(self.field_codes)} fields")
+
+    def epoch(self, filename: str) -> float:
+        """Epoch (t_max, MJD) of a catalogue
+
+        Args:
+            filename (str): catalogue filename
+
+        Returns:
+            float: epoch, None if the catalogue is not in the table
+        """
+        epoch = self.epochs.get(filename)
+
+        return None if epoch is None else float(epoch)
+
+    def fields(self, survey: str = None) -> list:
+        """Fields in the table
+
+        Args:
+            survey (str, optional): only the fields of this survey, e.g. 'VAST'. Defaults to None.
+
+        Returns:
+            list: field names, e.g. 'VAST_1453-62'
+        """
+        fields = list(self.field_codes)
+        if survey is not None:
+            fields = [field for field in fields if field.startswith(f"{survey}_")]
+
+        return fields
+
+    def field_key(self, fields) -> np.ndarray:
+        """Offset of each field on the combined sort keys, NaN for fields not in the table"""
+        codes = self.field_codes.get_indexer(pd.Index(np.atleast_1d(fields))).astype(np.float64)
+        codes[codes < 0] = np.nan
+
+        return codes * FIELD_KEY_STRIDE
+
+    def window(self, start: float, end: float, fields=None, survey: str = None) -> pd.DataFrame:
+        """Catalogues observed at any time between two epochs
+
+        Args:
+            start (float): start of the window (MJD)
+            end (float): end of the window (MJD)
+            fields (str | list, optional): fields to search, e.g. 'VAST_1453-62'. Defaults to every field.
+            survey (str, optional): only the fields of this survey, if no fields are given. Defaults to None.
+
+        Returns:
+            DataFrame: rows of the table whose [t_min, t_max] overlaps the window, by field and time
+        """
+        if fields is None:
+            fields = self.fields(survey)
+        offsets = self.field_key(fields)
+        offsets = offsets[np.isfinite(offsets)]
+
+        # every overlap starts within the window or at most one observation length before it
+        lower = np.searchsorted(self.start_keys, offsets + start - self.max_duration, side='left')
+        upper = np.searchsorted(self.start_keys, offsets + end, side='right')
+        candidates = np.concatenate([self.start_rows[low:high] for low, high in zip(lower, upper)] or [np.array([], dtype=int)])
+
+        matches = self.catalogues.loc[candidates]
+
+        return matches[matches['t_max'].to_numpy(dtype=np.float64) >= start]
+
+    def nearest(self, epochs, fields) -> pd.DataFrame:
+        """Catalogue of each field closest in time to an epoch, e.g. to a Gaia reference epoch
+
+        Args:
+            epochs (float | ArrayLike): epochs (MJD), one per field or one for all fields
+            fields (str | ArrayLike): fields to search, one per epoch
+
+        Returns:
+            DataFrame: one row per query with the table columns of the catalogue whose epoch (t_max)
+            is closest, and 'query_field', 'query_epoch' and 'epoch_offset' (days). Fields that are
+            not in the table give a row of missing values.
+        """
+        fields = np.atleast_1d(fields)
+        epochs = np.broadcast_to(np.asarray(epochs, dtype=np.float64), fields.shape)
+        offsets = self.field_key(fields)
+        codes = offsets / FIELD_KEY_STRIDE
+
+        keys = offsets + epochs
+        rows = np.full(len(keys), -1)
+        if len(self.epoch_keys):
+            last = len(self.epoch_keys) - 1
+            after = np.searchsorted(self.epoch_keys, np.nan_to_num(keys, nan=-np.inf), side='left')
+            before = after - 1
+
+            # the neighbours on the combined key only count if they are in the queried field
+            after_distance = np.where((after <= last) & (self.epoch_codes[np.minimum(after, last)] == codes),
+                                      self.epoch_keys[np.minimum(after, last)] - keys, np.inf)
+            before_distance = np.where((before >= 0) & (self.epoch_codes[np.maximum(before, 0)] == codes),
+                                       keys - self.epoch_keys[np.maximum(before, 0)], np.inf)
+
+            position = np.where(before_distance <= after_distance, before, after)
+            found = np.isfinite(np.minimum(before_distance, after_distance))
+            rows[found] = self.epoch_rows[position[found]]
+
+        nearest = self.catalogues.reindex(rows).reset_index(drop=True)
+        nearest['query_field'] = fields
+        nearest['query_epoch'] = epochs
+        nearest['epoch_offset'] = nearest['t_max'].to_numpy(dtype=np.float64) - epochs
+
+        return nearest
+
+
+@functools.lru_cache(maxsize=1)
+def load_pubdat_index() -> PubdatIndex:
+    """Index of the cached CASDA public data table, built once per process
+
+    Returns:
+        PubdatIndex: index of the cached pubdat
+    """
+    # imported here so the index can be built from any table without a CASDA session
+    from casda_util import get_public_data_table
+
+    return PubdatIndex(get_public_data_table())
@@ -0,0 +1,309 @@
+import os
+import json
+import sqlite3
+import functools
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from light_curves import catalogue_basename
+
+# Import the centralized logger
+from logger_config import logger
+
+
+RESULT_STORE_PATH = os.path.join(os.path.dirname(__file__), "casda_matches", "crossmatch_results.sqlite")
+
+# Columns of the matches table with their SQLite types
+MATCH_COLUMNS = {
+    'run_id': 'TEXT NOT NULL',
+    'planet': 'TEXT NOT NULL',
+    'component_id': 'TEXT',
+    'component_name': 'TEXT',
+    'catalogue': 'TEXT',
+    'epoch': 'REAL',
+    'ra_deg_cont': 'REAL',
+    'dec_deg_cont': 'REAL',
+    'separation_arcsec': 'REAL',
+    'search_radius': 'REAL',
+    'match_probability': 'REAL',
+    'flux_peak': 'REAL',
+    'flux_peak_err': 'REAL',
+    'flux_int': 'REAL',
+    'flux_int_err': 'REAL',
+    'rms_image': 'REAL',
+}
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, started TEXT NOT NULL, parameters TEXT)",
+    f"CREATE TABLE IF NOT EXISTS matches ({', '.join(f'{column} {column_type}' for column, column_type in MATCH_COLUMNS.items())})",
+    "CREATE INDEX IF NOT EXISTS matches_planet ON matches (planet)",
+    "CREATE INDEX IF NOT EXISTS matches_catalogue ON matches (catalogue)",
+    "CREATE INDEX IF NOT EXISTS matches_epoch ON matches (epoch)",
+    "CREATE INDEX IF NOT EXISTS matches_run ON matches (run_id)",
+    # planet and catalogue pairs of a sample already matched, see delta_crossmatch
+    "CREATE TABLE IF NOT EXISTS processed_pairs (catalogue TEXT NOT NULL, sample TEXT NOT NULL, planet TEXT NOT NULL, "
+    "run_id TEXT, processed TEXT NOT NULL, PRIMARY KEY (sample, planet, catalogue))",
+]
+
+# Run the results of this process are appended under, set by 'start_run'
+current_run_id = None
+
+
+def connect(store_path: str = RESULT_STORE_PATH) -> sqlite3.Connection:
+    """Open the result store, creating it if needed. Write-ahead logging lets readers query the
+    store while workers append to it, and the busy timeout makes concurrent writers wait their turn.
+
+    Args:
+        store_path (str, optional): path of the SQLite database. Defaults to RESULT_STORE_PATH.
+
+    Returns:
+        Connection: connection in autocommit mode, transactions are opened explicitly
+    """
+    os.makedirs(os.path.dirname(store_path), exist_ok=True)
+    connection = sqlite3.connect(store_path, timeout=60, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    for statement in SCHEMA:
+        connection.execute(statement)
+
+    return connection
+
+
+def start_run(parameters: dict = None, store_path: str = RESULT_STORE_PATH) -> str:
+    """Register a new pipeline run, under which all later appends of this process are stored
+
+    Args:
+        parameters (dict, optional): JSON serialisable parameters of the run. Defaults to None.
+        store_path (str, optional): path of the SQLite database. Defaults to RESULT_STORE_PATH.
+
+    Returns:
+        str: id of the run
+    """
+    global current_run_id
+
+    started = datetime.now()
+    current_run_id = f"{started.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+    connection = connect(store_path)
+    try:
+        connection.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?)",
+                           (current_run_id, started.isoformat(), json.dumps(parameters or {}, default=str)))
+    finally:
+        connection.close()
+
+    logger.info(f"Storing crossmatch results of run {current_run_id} in {store_path}")
+
+    return current_run_id
+
+
+def resume_run(run_id: str) -> str:
+    """Append all later results of this process under an existing run, e.g. one resumed from its journal
+
+    Args:
+        run_id (str): id of the run from 'start_run'
+
+    Returns:
+        str: id of the run
+    """
+    global current_run_id
+
+    current_run_id = run_id
+    logger.info(f"Resuming run {current_run_id} of the result store")
+
+    return current_run_id
+
+
+@functools.lru_cache(maxsize=1)
+def catalogue_epochs() -> pd.Series:
+    """Epoch (t_max, MJD) of every catalogue in the cached CASDA public data table, read once per process
+
+    Returns:
+        Series: epochs indexed by bare catalogue filename
+    """
+    # imported here so the store can be queried without a CASDA session
+    from casda_util import get_public_data_table
+
+    pubdat = get_public_data_table()
+
+    return pd.Series(pubdat['t_max'].to_numpy(), index=catalogue_basename(pubdat['filename'])).groupby(level=0).first()
+
+
+def append_matches(planet: str, components: pd.DataFrame, separation_arcsec, search_radius: float = None,
+                   match_probability=None, epochs: pd.Series = None, store_path: str = RESULT_STORE_PATH) -> int:
+    """Append the matched components of a planet to the store in a single transaction
+
+    The write lock is taken when the transaction begins, so appends from parallel workers are
+    serialised and each one is either stored completely or not at all.
+
+    Args:
+        planet (str): planet name
+        components (pd.DataFrame): matched selavy components, with 'source_filename'
+        separation_arcsec (ArrayLike): separation of each component from the planet in arcseconds
+        search_radius (float, optional): search radius of the match in arcseconds. Defaults to None.
+        match_probability (ArrayLike, optional): probability of each match. Defaults to None.
+        epochs (pd.Series, optional): catalogue filename to epoch. Defaults to the cached pubdat epochs.
+        store_path (str, optional): path of the SQLite database. Defaults to RESULT_STORE_PATH.
+
+    Returns:
+        int: number of rows appended
+    """
+    if components.empty:
+        return 0
+
+    run_id = current_run_id or start_run(store_path=store_path)
+    if epochs is None:
+        try:
+            epochs = catalogue_epochs()
+        except (OSError, IndexError, KeyError) as e:
+            logger.info(f"Catalogue epochs unavailable, stored without epochs. Reason: {e}")
+            epochs = pd.Series(dtype=np.float64)
+
+    catalogues = catalogue_basename(components['source_filename']) if 'source_filename' in components else pd.Series([None] * len(components))
+
+    def column(name):
+        return components[name].to_numpy() if name in components else np.full(len(components), None)
+
+    rows = pd.DataFrame({'run_id': run_id,
+                         'planet': planet,
+                         'component_id': column('component_id'),
+                         'component_name': column('component_name'),
+                         'catalogue': catalogues.to_numpy(),
+                         'epoch': catalogues.map(epochs).to_numpy(),
+                         'ra_deg_cont': column('ra_deg_cont'),
+                         'dec_deg_cont': column('dec_deg_cont'),
+                         'separation_arcsec': np.asarray(separation_arcsec, dtype=np.float64),
+                         'search_radius': search_radius,
+                         'match_probability': match_probability if match_probability is not None else None,
+                         'flux_peak': column('flux_peak'),
+                         'flux_peak_err': column('flux_peak_err'),
+                         'flux_int': column('flux_int'),
+                         'flux_int_err': column('flux_int_err'),
+                         'rms_image': column('rms_image')})[list(MATCH_COLUMNS)]
+    # SQLite takes python scalars, NaN is stored as NULL
+    records = [tuple(None if isinstance(value, float) and np.isnan(value)
+                     else value.item() if isinstance(value, np.generic) else value for value in row)
+               for row in rows.astype(object).itertuples(index=False, name=None)]
+
+    connection = connect(store_path)
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(f"INSERT INTO matches VALUES ({', '.join('?' * len(MATCH_COLUMNS))})", records)
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+    finally:
+        connection.close()
+
+    return len(records)
+
+
+def delete_matches(planets: list, run_id: str = None, store_path: str = RESULT_STORE_PATH) -> int:
+    """Delete the matches of planets stored under a run, e.g. those a resumed run stored before it
+    stopped without recording the planets as done, so matching them again stores them only once
+
+    Args:
+        planets (list): planet names
+        run_id (str, optional): run id. Defaults to the current run.
+        store_path (str, optional): path of the SQLite database. Defaults to RESULT_STORE_PATH.
+
+    Returns:
+        int: number of rows deleted
+    """
+    run_id = run_id or current_run_id
+    if run_id is None or not planets:
+        return 0
+
+    connection = connect(store_path)
+    try:
+        cursor = connection.execute(f"DELETE FROM matches WHERE run_id = ? AND planet IN ({', '.join('?' * len(planets))})",
+                                    [run_id, *planets])
+    finally:
+        connection.close()
+
+    return cursor.rowcount
+
+
+def query_matches(planet: str = None, catalogue: str = None, epoch_range: tuple = None, run_id: str = None,
+                  store_path: str = RESULT_STORE_PATH) -> pd.DataFrame:
+    """Read matches from the store, filtered on the indexed columns
+
+    Args:
+        planet (str, optional): planet name. Defaults to None.
+        catalogue (str, optional): catalogue filename, or a SQL LIKE pattern such as '%VAST_1453-62%'
+            to select a field. Defaults to None.
+        epoch_range (tuple, optional): (first, last) epoch in MJD, inclusive. Defaults to None.
+        run_id (str, optional): run id, 'latest' for the most recent run. Defaults to None.
+        store_path (str, optional): path of the SQLite database. Defaults to RESULT_STORE_PATH.
+
+    Returns:
+        DataFrame: matching rows of the store
+    """
+    conditions, parameters = [], []
+    if planet is not None:
+        conditions.append("planet = ?")
+        parameters.append(planet)
+    if catalogue is not None:
+        conditions.append("catalogue LIKE ?" if '%' in catalogue else "catalogue = ?")
+        parameters.append(catalogue)
+    if epoch_range is not None:
+        conditions.append("epoch BETWEEN ? AND ?")
+        parameters.extend(epoch_range)
+    if run_id == 'latest':
+        conditions.append("run_id = (SELECT run_id FROM runs ORDER BY started DESC LIMIT 1)")
+    elif run_id is not None:
+        conditions.append("run_id = ?")
+        parameters.append(run_id)
+
+    query = "SELECT * FROM matches"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+
+    connection = connect(store_path)
+    try:
+        return pd.read_sql_query(query, connection, params=parameters)
+    finally:
+        connection.close()
+
+
+def processed_pairs(sample: str, store_path: str = RESULT_STORE_PATH) -> set:
+    """Planet and catalogue pairs of a sample already matched. Kept per planet, so planets added to
+    the sample later are still matched against the catalogues processed before them.
+
+    Args:
+        sample (str): name of the planet sample, e.g. the source list filename
+        store_path (str, optional): path of the SQLite database. Defaults to RESULT_STORE_PATH.
+
+    Returns:
+        set: (bare catalogue filename, planet name) pairs
+    """
+    connection = connect(store_path)
+    try:
+        rows = connection.execute("SELECT catalogue, planet FROM processed_pairs WHERE sample = ?", (sample,)).fetchall()
+    finally:
+        connection.close()
+
+    return set(rows)
+
+
+def mark_processed(pairs, sample: str, store_path: str = RESULT_STORE_PATH) -> None:
+    """Record planet and catalogue pairs of a sample as matched, under the current run
+
+    Args:
+        pairs (Iterable[tuple]): (bare catalogue filename, planet name) pairs
+        sample (str): name of the planet sample
+        store_path (str, optional): path of the SQLite database. Defaults to RESULT_STORE_PATH.
+    """
+    run_id = current_run_id or start_run(store_path=store_path)
+    processed = datetime.now().isoformat()
+
+    connection = connect(store_path)
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        connection.executemany("INSERT OR REPLACE INTO processed_pairs VALUES (?, ?, ?, ?, ?)",
+                               [(catalogue, sample, planet, run_id, processed) for catalogue, planet in pairs])
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
@@ -0,0 +1,53 @@
+import os
+import json
+import time
+
+# Import the centralized logger
+from logger_config import logger
+
+
+# Counters and values collected during a run, written out once at the end
+metrics = {}
+
+
+def increment(name: str, amount: int = 1) -> None:
+    """Increase a counter in the run metrics
+
+    Args:
+        name (str): name of the counter
+        amount (int, optional): amount to add to the counter. Defaults to 1.
+    """
+    metrics[name] = metrics.get(name, 0) + amount
+
+
+def record(name: str, value) -> None:
+    """Set a value in the run metrics, replacing any previous value
+
+    Args:
+        name (str): name of the metric
+        value (Any): JSON serialisable value of the metric
+    """
+    metrics[name] = value
+
+
+def log_metrics() -> None:
+    """Write all run metrics collected so far to the log file"""
+    logger.info("RUN METRICS")
+    for name in sorted(metrics):
+        logger.info(f"{name}: {metrics[name]}")
+
+
+def write_metrics(metrics_path: str = None) -> None:
+    """Append the run metrics as a single JSON line to the metrics file,
+    so that the metrics of past runs are kept
+
+    Args:
+        metrics_path (str, optional): path of the metrics file.
+            Defaults to run_metrics.jsonl next to this file.
+    """
+    if metrics_path is None:
+        metrics_path = os.path.join(os.path.dirname(__file__), "run_metrics.jsonl")
+
+    entry = {"timestamp": time.time(), **metrics}
+    with open(metrics_path, 'a') as metrics_file:
+        metrics_file.write(json.dumps(entry, default=str) + "\n")
@@ -0,0 +1,151 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+from sky_separation import search_around
+
+# Import the centralized logger
+from logger_config import logger
+
+
+CASDA_XML_DOWNLOAD_PATH = os.path.join(os.path.dirname(__file__), "casda_xml_downloads")
+RUN_METRICS_PATH = os.path.join(os.path.dirname(__file__), "run_metrics.jsonl")
+
+# Catalogues whose centres are within this many degrees of a planet are fetched, as in casda_util.casda_search
+CATALOGUE_SEARCH_RADIUS = 3
+
+# Costs assumed before any run has recorded its metrics
+DEFAULT_SECONDS_PER_PLANET = 5
+DEFAULT_SECONDS_PER_CATALOGUE = 60
+
+
+def load_run_history(metrics_path: str = RUN_METRICS_PATH) -> pd.DataFrame:
+    """Metrics of past runs that recorded their wall time
+
+    Args:
+        metrics_path (str, optional): path of the metrics file written by run_metrics. Defaults to RUN_METRICS_PATH.
+
+    Returns:
+        DataFrame: one row per run with 'run_seconds', 'n_planets' and 'catalogues_staged'
+    """
+    runs = []
+    if os.path.exists(metrics_path):
+        with open(metrics_path, 'r') as metrics_file:
+            for line in metrics_file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if 'run_seconds' in entry and 'n_planets' in entry:
+                    runs.append({'run_seconds': entry['run_seconds'],
+                                 'n_planets': entry['n_planets'],
+                                 'catalogues_staged': entry.get('catalogues_staged', 0)})
+
+    return pd.DataFrame(runs, columns=['run_seconds', 'n_planets', 'catalogues_staged'])
+
+
+def fit_wall_time(history: pd.DataFrame) -> tuple:
+    """Seconds per planet and per staged catalogue, fitted to past runs
+
+    With two or more runs both costs are fitted by least squares. With a single run the default
+    costs are scaled to reproduce it, and without any run the defaults are used.
+
+    Args:
+        history (pd.DataFrame): past runs from 'load_run_history'
+
+    Returns:
+        seconds_per_planet (float): cost of crossmatching one planet
+        seconds_per_catalogue (float): cost of staging and downloading one catalogue
+    """
+    defaults = np.array([DEFAULT_SECONDS_PER_PLANET, DEFAULT_SECONDS_PER_CATALOGUE], dtype=np.float64)
+    if history.empty:
+        return tuple(defaults)
+
+    counts = history[['n_planets', 'catalogues_staged']].to_numpy(dtype=np.float64)
+    seconds = history['run_seconds'].to_numpy(dtype=np.float64)
+
+    if len(history) >= 2 and np.linalg.matrix_rank(counts) == 2:
+        coefficients = np.clip(np.linalg.lstsq(counts, seconds, rcond=None)[0], 0, None)
+        if coefficients.any():
+            return tuple(coefficients)
+
+    predicted = counts @ defaults
+
+    return tuple(defaults * seconds.sum() / predicted.sum()) if predicted.sum() > 0 else tuple(defaults)
+
+
+def plan_run(planets: pd.DataFrame, pubdat: pd.DataFrame, xml_path: str = CASDA_XML_DOWNLOAD_PATH,
+             metrics_path: str = RUN_METRICS_PATH) -> dict:
+    """Estimate the staging, download and compute cost of a run without contacting CASDA
+
+    Args:
+        planets (pd.DataFrame): planets of the run with 'pl_name', 'ra' and 'dec'
+        pubdat (pd.DataFrame): cached CASDA public data table with 'filename', 's_ra', 's_dec' and 'access_estsize'
+        xml_path (str, optional): directory of the downloaded catalogues. Defaults to casda_xml_downloads.
+        metrics_path (str, optional): metrics of past runs. Defaults to RUN_METRICS_PATH.
+
+    Returns:
+        dict: planet and catalogue counts, bytes to download, cached bytes and the projected wall time,
+        with 'per_planet', a DataFrame of the catalogues and new catalogues of each planet for sizing shards
+    """
+    catalogues = pubdat[pubdat['filename'].str.contains(r'.*.cont.taylor.0.restored.conv.components.xml$', regex=True)]
+    catalogues = catalogues.drop_duplicates('filename').reset_index(drop=True)
+
+    planet_index, catalogue_index, _ = search_around(planets['ra'].to_numpy(dtype=np.float64),
+                                                     planets['dec'].to_numpy(dtype=np.float64),
+                                                     catalogues['s_ra'].to_numpy(dtype=np.float64),
+                                                     catalogues['s_dec'].to_numpy(dtype=np.float64),
+                                                     CATALOGUE_SEARCH_RADIUS)
+
+    needed_index = np.unique(catalogue_index)
+    needed = catalogues.iloc[needed_index]
+    cached = np.array([os.path.isfile(os.path.join(xml_path, filename)) for filename in needed['filename']], dtype=bool)
+    is_cached = np.zeros(len(catalogues), dtype=bool)
+    is_cached[needed_index] = cached
+    # ObsCore access_estsize is in kilobytes
+    estimated_bytes = needed['access_estsize'].fillna(0).to_numpy(dtype=np.float64) * 1024 if 'access_estsize' in needed else np.zeros(len(needed))
+
+    # the first planet needing a catalogue pays for staging it, later planets reuse it
+    new_catalogue = np.zeros(len(catalogue_index), dtype=bool)
+    if len(catalogue_index):
+        order = np.lexsort((catalogue_index, planet_index))
+        first_use = np.unique(catalogue_index[order], return_index=True)[1]
+        new_catalogue[order[first_use]] = True
+        new_catalogue &= ~is_cached[catalogue_index]
+
+    per_planet = pd.DataFrame({'pl_name': planets['pl_name'].to_numpy(),
+                               'n_catalogues': np.bincount(planet_index, minlength=len(planets)),
+                               'n_new_catalogues': np.bincount(planet_index[new_catalogue], minlength=len(planets))})
+
+    seconds_per_planet, seconds_per_catalogue = fit_wall_time(load_run_history(metrics_path))
+    n_to_fetch = int((~cached).sum())
+    n_planets = int((per_planet['n_catalogues'] > 0).sum())
+
+    return {'n_planets': len(planets),
+            'n_planets_covered': n_planets,
+            'n_catalogues': len(needed),
+            'n_catalogues_cached': int(cached.sum()),
+            'n_catalogues_to_fetch': n_to_fetch,
+            'bytes_to_download': float(estimated_bytes[~cached].sum()),
+            'bytes_cached': float(estimated_bytes[cached].sum()),
+            'seconds_per_planet': float(seconds_per_planet),
+            'seconds_per_catalogue': float(seconds_per_catalogue),
+            'projected_seconds': float(n_planets * seconds_per_planet + n_to_fetch * seconds_per_catalogue),
+            'per_planet': per_planet}
+
+
+def log_plan(plan: dict) -> None:
+    """Write a run plan to the log file
+
+    Args:
+        plan (dict): plan from 'plan_run'
+    """
+    logger.info("DRY RUN PLAN")
+    logger.info(f"Planets: {plan['n_planets']} ({plan['n_planets_covered']} covered by catalogues)")
+    logger.info(f"Catalogues: {plan['n_catalogues']} unique, {plan['n_catalogues_cached']} cached, "
+                f"{plan['n_catalogues_to_fetch']} to stage and download")
+    logger.info(f"Download: {plan['bytes_to_download'] / 1024 ** 3:.2f} GB, already cached: {plan['bytes_cached'] / 1024 ** 3:.2f} GB")
+    logger.info(f"Projected wall time: {plan['projected_seconds'] / 3600:.2f} h "
+                f"({plan['seconds_per_planet']:.1f} s per planet, {plan['seconds_per_catalogue']:.1f} s per catalogue)")
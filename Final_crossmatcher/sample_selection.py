@@ -0,0 +1,145 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+import nasa_ingest
+
+# Import the centralized logger
+from logger_config import logger
+
+
+SAMPLE_CACHE_FOLDER = os.path.join(os.path.dirname(__file__), "sample_cache")
+
+# Criteria are lists of (column, operator, value) tuples, all of which must hold for a planet
+# to be selected. Comparisons against missing values never select the planet.
+OPERATORS = {
+    '<': lambda column, value: column < value,
+    '<=': lambda column, value: column <= value,
+    '>': lambda column, value: column > value,
+    '>=': lambda column, value: column >= value,
+    '==': lambda column, value: column == value,
+    '!=': lambda column, value: column.notna() & (column != value),
+    'between': lambda column, value: (column >= value[0]) & (column <= value[1]),
+    'in': lambda column, value: column.isin(value),
+    'contains': lambda column, value: column.str.contains(value, regex=False, na=False),
+    'notna': lambda column, value: column.notna(),
+}
+
+# Planets with Gaia DR2 identifiers and TICv8 system parameters, so the J2015.5 reference epoch
+# can be used for all proper motion corrections (see proper_motion.filter_for_gaia)
+GAIA_DR2_CRITERIA = [
+    ('gaia_id', 'contains', 'Gaia DR2'),
+    ('sy_refname', 'contains', 'TICv8'),
+]
+
+
+def hot_jupiter_criteria(dec_lower_limit: float = 40, orbital_period_lower: float = 7,
+                         jp_mass_upper_limit: float = 1, dist_to_earth_upper: float = 100) -> list:
+    """Criteria of the hot Jupiter samples, with the thresholds of filter_nasa.filter_nasa_database
+
+    Args:
+        dec_lower_limit (float, optional): minimum declination in degrees. Defaults to 40.
+        orbital_period_lower (float, optional): maximum orbital period in days. Defaults to 7.
+        jp_mass_upper_limit (float, optional): minimum mass in Jupiter masses. Defaults to 1.
+        dist_to_earth_upper (float, optional): maximum distance in parsecs. Defaults to 100.
+
+    Returns:
+        list: selection criteria
+    """
+    return [
+        ('dec', '>', dec_lower_limit),
+        ('pl_orbper', '<', orbital_period_lower),
+        ('pl_massj', '>', jp_mass_upper_limit),
+        ('sy_dist', '<', dist_to_earth_upper),
+    ]
+
+
+def compile_criteria(criteria: list):
+    """Compile selection criteria into a single function computing the selection mask
+
+    Args:
+        criteria (list): (column, operator, value) tuples
+
+    Returns:
+        Callable: function of a DataFrame returning a boolean numpy mask of the selected rows
+    """
+    compiled = []
+    for column, operator, value in criteria:
+        if operator not in OPERATORS:
+            raise ValueError(f"Unknown selection operator '{operator}', expected one of {list(OPERATORS)}")
+        compiled.append((column, OPERATORS[operator], value))
+
+    def mask(source_table: pd.DataFrame) -> np.ndarray:
+        selected = np.ones(len(source_table), dtype=bool)
+        for column, operator_function, value in compiled:
+            selected &= np.asarray(operator_function(source_table[column], value), dtype=bool)
+        return selected
+
+    return mask
+
+
+def select(source_table: pd.DataFrame, criteria: list) -> pd.DataFrame:
+    """Select the planets of a table matching all criteria
+
+    Args:
+        source_table (pd.DataFrame): planets
+        criteria (list): (column, operator, value) tuples
+
+    Returns:
+        DataFrame: the selected planets
+    """
+    return source_table[compile_criteria(criteria)(source_table)]
+
+
+def criteria_hash(criteria: list) -> str:
+    """Stable hash of selection criteria, independent of their order
+
+    Args:
+        criteria (list): (column, operator, value) tuples
+
+    Returns:
+        str: hexadecimal digest
+    """
+    canonical = json.dumps(sorted([list(criterion) for criterion in criteria], key=json.dumps), default=str)
+    return hashlib.sha1(canonical.encode()).hexdigest()
+
+
+def select_sample(source: str, criteria: list, refresh: bool = False) -> pd.DataFrame:
+    """Select a sample from a NASA Exoplanet Archive csv, caching the sample under a hash of
+    the criteria and of the source file so repeated selections are read back instantly
+
+    Args:
+        source (str): csv filename of the archive export or of a sample taken from it
+        criteria (list): (column, operator, value) tuples
+        refresh (bool, optional): recompute the sample even if it is cached. Defaults to False.
+
+    Returns:
+        DataFrame: the selected planets
+    """
+    extension = nasa_ingest.cache_format()
+    sample_key = hashlib.sha1(f"{criteria_hash(criteria)}-{nasa_ingest.source_hash(source)}-"
+                              f"v{nasa_ingest.INGEST_VERSION}".encode()).hexdigest()[:16]
+    sample_path = os.path.join(SAMPLE_CACHE_FOLDER, f"sample-{sample_key}.{extension}")
+
+    if os.path.exists(sample_path) and not refresh:
+        if extension == 'parquet':
+            return pd.read_parquet(sample_path)
+        return pd.read_pickle(sample_path)
+
+    sample = select(nasa_ingest.load_source_table(source), criteria)
+
+    # write to a temporary file first so an interrupted run never leaves a partial sample
+    os.makedirs(SAMPLE_CACHE_FOLDER, exist_ok=True)
+    temporary_path = sample_path + ".tmp"
+    if extension == 'parquet':
+        sample.to_parquet(temporary_path)
+    else:
+        sample.to_pickle(temporary_path)
+    os.replace(temporary_path, sample_path)
+
+    logger.info(f"Selected {len(sample)} planets from {source} with criteria {criteria}, cached as {sample_path}")
+
+    return sample
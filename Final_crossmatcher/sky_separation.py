@@ -0,0 +1,178 @@
+import numpy as np
+
+
+# Maximum number of candidate pairs held in memory at once
+DEFAULT_CHUNK_SIZE = 1_000_000
+
+
+def radec_to_unit_vectors(ra, dec) -> np.ndarray:
+    """Convert ICRS coordinates to cartesian unit vectors
+
+    Args:
+        ra (ArrayLike): right ascension in degrees
+        dec (ArrayLike): declination in degrees
+
+    Returns:
+        NDArray[float64]: array of shape (N, 3) of unit vectors
+    """
+    ra = np.radians(np.asarray(ra, dtype=np.float64))
+    dec = np.radians(np.asarray(dec, dtype=np.float64))
+    cos_dec = np.cos(dec)
+
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def angular_separation(ra1, dec1, ra2, dec2) -> np.ndarray:
+    """Great-circle separation between ICRS coordinates, broadcasting like numpy.
+
+    Uses the Vincenty formula (the same as astropy), which is accurate for
+    both very small and near-antipodal separations.
+
+    Args:
+        ra1 (ArrayLike): right ascension of the first coordinates in degrees
+        dec1 (ArrayLike): declination of the first coordinates in degrees
+        ra2 (ArrayLike): right ascension of the second coordinates in degrees
+        dec2 (ArrayLike): declination of the second coordinates in degrees
+
+    Returns:
+        NDArray[float64]: separations in degrees
+    """
+    ra1 = np.radians(np.asarray(ra1, dtype=np.float64))
+    dec1 = np.radians(np.asarray(dec1, dtype=np.float64))
+    ra2 = np.radians(np.asarray(ra2, dtype=np.float64))
+    dec2 = np.radians(np.asarray(dec2, dtype=np.float64))
+
+    delta_ra = ra2 - ra1
+    sin_delta_ra = np.sin(delta_ra)
+    cos_delta_ra = np.cos(delta_ra)
+    sin_dec1 = np.sin(dec1)
+    cos_dec1 = np.cos(dec1)
+    sin_dec2 = np.sin(dec2)
+    cos_dec2 = np.cos(dec2)
+
+    num1 = cos_dec2 * sin_delta_ra
+    num2 = cos_dec1 * sin_dec2 - sin_dec1 * cos_dec2 * cos_delta_ra
+    denominator = sin_dec1 * sin_dec2 + cos_dec1 * cos_dec2 * cos_delta_ra
+
+    return np.degrees(np.arctan2(np.hypot(num1, num2), denominator))
+
+
+def cone_filter(ra0: float, dec0: float, ra, dec, radius: float, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """Find the coordinates within a cone around a single position
+
+    Args:
+        ra0 (float): right ascension of the cone centre in degrees
+        dec0 (float): declination of the cone centre in degrees
+        ra (ArrayLike): right ascension of the coordinates to filter in degrees
+        dec (ArrayLike): declination of the coordinates to filter in degrees
+        radius (float): cone radius in degrees
+        chunk_size (int, optional): number of coordinates processed at once. Defaults to DEFAULT_CHUNK_SIZE.
+
+    Returns:
+        indices (NDArray[int64]): indices of the coordinates within the cone
+        separations (NDArray[float64]): separations of those coordinates from the centre in degrees
+    """
+    ra = np.asarray(ra, dtype=np.float64)
+    dec = np.asarray(dec, dtype=np.float64)
+
+    indices = []
+    separations = []
+    for start in range(0, len(ra), chunk_size):
+        # cheap declination cut before computing the exact separations
+        dec_chunk = dec[start:start + chunk_size]
+        candidates = np.nonzero(np.abs(dec_chunk - dec0) <= radius)[0]
+
+        seps = angular_separation(ra0, dec0, ra[start + candidates], dec_chunk[candidates])
+        within = seps <= radius
+        indices.append(start + candidates[within])
+        separations.append(seps[within])
+
+    if not indices:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+    return np.concatenate(indices).astype(np.int64), np.concatenate(separations)
+
+
+def search_around(ra1, dec1, ra2, dec2, seplimit: float, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """Find all pairs between two sets of coordinates separated by at most seplimit.
+    This is a plain float64 replacement for astropy's search_around_sky for ICRS coordinates.
+
+    The second set is sorted by declination so only pairs within a declination band are
+    compared. Candidate pairs are processed in chunks of at most chunk_size to bound memory.
+
+    Args:
+        ra1 (ArrayLike): right ascension of the first coordinates in degrees
+        dec1 (ArrayLike): declination of the first coordinates in degrees
+        ra2 (ArrayLike): right ascension of the second coordinates in degrees
+        dec2 (ArrayLike): declination of the second coordinates in degrees
+        seplimit (float): maximum separation in degrees
+        chunk_size (int, optional): maximum number of candidate pairs processed at once. Defaults to DEFAULT_CHUNK_SIZE.
+
+    Returns:
+        idx1 (NDArray[int64]): indices into the first coordinates of each pair
+        idx2 (NDArray[int64]): indices into the second coordinates of each pair
+        sep (NDArray[float64]): separation of each pair in degrees
+    """
+    ra1 = np.asarray(ra1, dtype=np.float64).ravel()
+    dec1 = np.asarray(dec1, dtype=np.float64).ravel()
+    ra2 = np.asarray(ra2, dtype=np.float64).ravel()
+    dec2 = np.asarray(dec2, dtype=np.float64).ravel()
+
+    dec_order = np.argsort(dec2, kind='stable')
+    dec2_sorted = dec2[dec_order]
+
+    # range of the sorted second set within the declination band of each first coordinate
+    lower = np.searchsorted(dec2_sorted, dec1 - seplimit, side='left')
+    upper = np.searchsorted(dec2_sorted, dec1 + seplimit, side='right')
+    counts = upper - lower
+
+    idx1_parts, idx2_parts, sep_parts = [], [], []
+
+    # split the first set so each chunk has at most chunk_size candidate pairs
+    # (a single coordinate with more candidates than chunk_size forms its own chunk)
+    cumulative = np.cumsum(counts)
+    start = 0
+    while start < len(ra1):
+        offset = cumulative[start - 1] if start > 0 else 0
+        stop = max(int(np.searchsorted(cumulative, offset + chunk_size, side='right')), start + 1)
+
+        chunk_counts = counts[start:stop]
+        total = int(chunk_counts.sum())
+        if total:
+            pair_idx1 = np.repeat(np.arange(start, stop), chunk_counts)
+            first_pair = np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+            pair_idx2 = dec_order[np.repeat(lower[start:stop], chunk_counts) + np.arange(total) - first_pair]
+
+            seps = angular_separation(ra1[pair_idx1], dec1[pair_idx1], ra2[pair_idx2], dec2[pair_idx2])
+            within = seps <= seplimit
+            idx1_parts.append(pair_idx1[within])
+            idx2_parts.append(pair_idx2[within])
+            sep_parts.append(seps[within])
+
+        start = stop
+
+    if not idx1_parts:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+    return (np.concatenate(idx1_parts).astype(np.int64),
+            np.concatenate(idx2_parts).astype(np.int64),
+            np.concatenate(sep_parts))
+
+
+def sweep_radii(separations, radii):
+    """Count the pairs within each of several radii from a single set of separations
+
+    Args:
+        separations (ArrayLike): separations of the candidate pairs found at the largest radius
+        radii (ArrayLike): radii to report, in the same unit as the separations
+
+    Returns:
+        order (NDArray[int64]): indices sorting the pairs by separation
+        counts (NDArray[int64]): number of pairs within each radius, so the pairs
+            within radii[k] are order[:counts[k]]
+    """
+    separations = np.asarray(separations, dtype=np.float64)
+    order = np.argsort(separations, kind='stable')
+    counts = np.searchsorted(separations[order], np.asarray(radii, dtype=np.float64), side='right')
+
+    return order, counts
@@ -0,0 +1,200 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from forced_photometry import CASDA_IMAGE_DOWNLOAD_PATH, CASDA_MATCHES_PATH, MappedImage, planet_epoch_tasks
+
+# Import the centralized logger
+from logger_config import logger
+
+
+# Name of the population stack in the results
+POPULATION = 'population'
+
+
+class StackAccumulator:
+    """Running inverse-variance weighted co-add of aligned cutouts. Only the weighted sum and the
+    sum of weights are kept, so memory does not grow with the number of stacked cutouts."""
+
+    def __init__(self, half_size: int):
+        """
+        Args:
+            half_size (int): half-size of the cutouts in pixels, cutouts are (2 * half_size + 1) pixels square
+        """
+        size = 2 * half_size + 1
+        self.half_size = half_size
+        self.weighted_sum = np.zeros((size, size))
+        self.weight_sum = np.zeros((size, size))
+        self.n_cutouts = 0
+
+    def add(self, cutout: np.ndarray, rms: float) -> None:
+        """Add a cutout with weight 1 / rms**2, ignoring its blank pixels
+
+        Args:
+            cutout (np.ndarray): aligned cutout centred on the position being stacked
+            rms (float): noise of the cutout
+        """
+        valid = np.isfinite(cutout)
+        weight = 1 / rms ** 2
+        self.weighted_sum[valid] += weight * cutout[valid]
+        self.weight_sum[valid] += weight
+        self.n_cutouts += 1
+
+    def image(self) -> np.ndarray:
+        """Stacked image, NaN where no cutout had data"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.weighted_sum / self.weight_sum
+
+    def result(self) -> dict:
+        """Stacked flux and noise at the centre of the stack
+
+        Returns:
+            dict: number of cutouts, stacked peak flux at the centre, the rms expected from the weights
+            and the rms measured from the stacked image outside the centre
+        """
+        stacked = self.image()
+        centre = self.half_size
+        expected_rms = 1 / np.sqrt(self.weight_sum[centre, centre]) if self.weight_sum[centre, centre] > 0 else np.nan
+
+        yy, xx = np.indices(stacked.shape)
+        outside = (np.hypot(xx - centre, yy - centre) > self.half_size / 2) & np.isfinite(stacked)
+        background = stacked[outside]
+        measured_rms = 1.4826 * np.median(np.abs(background - np.median(background))) if background.size else np.nan
+
+        return {'n_cutouts': self.n_cutouts,
+                'stacked_flux': stacked[centre, centre],
+                'stacked_rms': expected_rms,
+                'stacked_rms_measured': measured_rms}
+
+
+def extract_cutout(image: MappedImage, ra: float, dec: float, half_size: int) -> np.ndarray:
+    """Cutout centred on the pixel nearest a sky position, padded with NaN beyond the image edge
+
+    Args:
+        image (MappedImage): memory mapped image
+        ra (float): right ascension in degrees
+        dec (float): declination in degrees
+        half_size (int): half-size of the cutout in pixels
+
+    Returns:
+        NDArray[float64]: cutout in mJy/beam, or None if the position is outside the image
+    """
+    x, y = image.world_to_pixel(ra, dec)
+    if not (np.isfinite(x) and np.isfinite(y)):
+        return None
+    xc, yc = int(round(float(x))), int(round(float(y)))
+    if not (0 <= xc < image.shape[1] and 0 <= yc < image.shape[0]):
+        return None
+
+    size = 2 * half_size + 1
+    cutout = np.full((size, size), np.nan)
+    region = image.read_region(xc - half_size, xc + half_size + 1, yc - half_size, yc + half_size + 1)
+    x_offset = max(half_size - xc, 0)
+    y_offset = max(half_size - yc, 0)
+    cutout[y_offset:y_offset + region.shape[0], x_offset:x_offset + region.shape[1]] = region
+
+    return cutout
+
+
+def cutout_rms(cutout: np.ndarray, exclude_radius: float) -> float:
+    """Robust noise of a cutout from the pixels away from its centre
+
+    Args:
+        cutout (np.ndarray): cutout
+        exclude_radius (float): radius in pixels around the centre left out of the estimate
+
+    Returns:
+        float: 1.4826 times the median absolute deviation
+    """
+    centre = cutout.shape[0] // 2
+    yy, xx = np.indices(cutout.shape)
+    background = cutout[(np.hypot(xx - centre, yy - centre) > exclude_radius) & np.isfinite(cutout)]
+    if background.size == 0:
+        return np.nan
+
+    return 1.4826 * np.median(np.abs(background - np.median(background)))
+
+
+def stack_planets(tasks: pd.DataFrame, half_size: int = 30, population: bool = False) -> pd.DataFrame:
+    """Inverse-variance weighted image-plane stacks of planets across epochs
+
+    Cutouts are read through memory mapping one at a time and added to running stacks, so memory is
+    bounded by the number of stacks rather than the number of epochs. Cutouts are aligned on the pixel
+    nearest each position, so images of all epochs are assumed to share the same pixel scale.
+
+    Args:
+        tasks (pd.DataFrame): one row per planet and epoch with 'pl_name', 'image_path', and 'ra'/'dec'
+            of the planet corrected to that epoch (see proper_motion.proper_correct_positions)
+        half_size (int, optional): half-size of the cutouts in pixels. Defaults to 30.
+        population (bool, optional): also stack all cutouts of all planets together, e.g. all hot
+            Jupiters of a sample. Defaults to False.
+
+    Returns:
+        DataFrame: one row per planet (and one named 'population') with the stacked flux and rms in mJy/beam
+    """
+    stacks = {}
+    population_stack = StackAccumulator(half_size)
+
+    for image_path, image_tasks in tasks.groupby('image_path', sort=False):
+        try:
+            image = MappedImage(image_path)
+        except (OSError, KeyError) as e:
+            logger.error(f"Stacking skipped {image_path}. Reason: {e}")
+            continue
+
+        with image:
+            for pl_name, ra, dec in zip(image_tasks['pl_name'], image_tasks['ra'], image_tasks['dec']):
+                cutout = extract_cutout(image, ra, dec, half_size)
+                if cutout is None:
+                    continue
+                rms = cutout_rms(cutout, exclude_radius=2 * image.beam_major)
+                if not np.isfinite(rms) or rms <= 0:
+                    continue
+
+                stacks.setdefault(pl_name, StackAccumulator(half_size)).add(cutout, rms)
+                if population:
+                    population_stack.add(cutout, rms)
+
+    rows = [{'pl_name': pl_name, **stack.result()} for pl_name, stack in stacks.items()]
+    if population:
+        rows.append({'pl_name': POPULATION, **population_stack.result()})
+
+    logger.info(f"Stacked {len(stacks)} planets from {tasks['image_path'].nunique()} images")
+
+    return pd.DataFrame(rows, columns=['pl_name', 'n_cutouts', 'stacked_flux', 'stacked_rms', 'stacked_rms_measured'])
+
+
+def build_stacks(planets: pd.DataFrame, pubdat: pd.DataFrame = None, population: bool = False,
+                 image_path: str = CASDA_IMAGE_DOWNLOAD_PATH, matches_path: str = CASDA_MATCHES_PATH,
+                 **kwargs) -> pd.DataFrame:
+    """Pipeline stage stacking the non-detections of every planet across the downloaded images,
+    saved as stacks.csv next to the matches
+
+    Args:
+        planets (pd.DataFrame): planets with 'pl_name', their positions and proper motions
+        pubdat (pd.DataFrame, optional): CASDA public data table. Defaults to the cached pubdat.
+        population (bool, optional): also stack all planets together, e.g. all hot Jupiters of the
+            sample. Defaults to False.
+        image_path (str, optional): directory of the downloaded images. Defaults to casda_image_downloads.
+        matches_path (str, optional): directory of the match files. Defaults to casda_matches.
+        **kwargs: passed on to 'stack_planets'
+
+    Returns:
+        DataFrame: stacks from 'stack_planets'
+    """
+    # imported here so stacks of given tasks need no CASDA modules
+    from light_curves import load_matches
+
+    if pubdat is None:
+        from casda_util import get_public_data_table
+        pubdat = get_public_data_table()
+
+    # epochs with a catalogue detection are left out, only the non-detections are stacked
+    tasks = planet_epoch_tasks(planets, pubdat, image_path=image_path, detections=load_matches(matches_path))
+    stacks = stack_planets(tasks, population=population, **kwargs)
+
+    os.makedirs(matches_path, exist_ok=True)
+    stacks.to_csv(os.path.join(matches_path, "stacks.csv"), index=False)
+
+    return stacks
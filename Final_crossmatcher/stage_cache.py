@@ -0,0 +1,233 @@
+import os
+import re
+import json
+import pickle
+import hashlib
+import functools
+
+import run_metrics
+
+# Import the centralized logger
+from logger_config import logger
+
+
+STAGE_CACHE_PATH = os.path.join(os.path.dirname(__file__), "stage_cache")
+RUN_JOURNAL_PATH = os.path.join(STAGE_CACHE_PATH, "run_journal.json")
+
+# Modules whose code determines the stage outputs, editing any of them invalidates every cached stage
+CODE_FILES = ['casda_util.py', 'casda_tap.py', 'compact_schema.py', 'crossmatcher.py', 'proper_motion.py',
+              'sky_separation.py']
+
+# Per-planet outputs of the loop kept in the journal, so a resumed run can restore them for the planets it skips
+JOURNAL_POSITION_COLUMNS = ['epoch', 'ra_corrected', 'dec_corrected']
+
+# match pubdat-YYYY-MM-DD.csv, as casda_util.check_casda_cache
+PUBDAT_PATTERN = r"pubdat-\d{4}-\d{2}-\d{2}\.csv"
+
+
+@functools.lru_cache(maxsize=1)
+def code_version() -> str:
+    """Hash of the pipeline code the stage outputs depend on
+
+    Returns:
+        str: hexadecimal digest of CODE_FILES
+    """
+    sha1 = hashlib.sha1()
+    for code_file in CODE_FILES:
+        with open(os.path.join(os.path.dirname(__file__), code_file), 'rb') as f:
+            sha1.update(f.read())
+
+    return sha1.hexdigest()
+
+
+@functools.lru_cache(maxsize=1)
+def pubdat_version() -> str:
+    """Hash of the cached CASDA public data table snapshot, hashed once per process
+
+    Returns:
+        str: hexadecimal digest of the pubdat csv, None if no snapshot is cached
+    """
+    # imported here so the stage keys can be computed without pandas for light callers
+    from nasa_ingest import file_hash
+
+    directory = os.path.join(os.path.dirname(__file__), "casda_cache\\")
+    if not os.path.exists(directory):
+        return None
+
+    for filename in sorted(os.listdir(directory)):
+        if re.match(PUBDAT_PATTERN, filename):
+            return file_hash(os.path.join(directory, filename))
+
+    return None
+
+
+def stage_key(stage: str, **inputs) -> str:
+    """Key of a stage output: a hash of the stage name, its inputs and the code version
+
+    Args:
+        stage (str): name of the stage
+        **inputs: JSON serialisable inputs of the stage, numpy scalars are converted by value
+
+    Returns:
+        str: hexadecimal digest
+    """
+    description = json.dumps({'stage': stage, 'code': code_version(), 'inputs': inputs},
+                             sort_keys=True, default=lambda value: value.item() if hasattr(value, 'item') else str(value))
+
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+class StageCache:
+    """Outputs of pipeline stages on disk, keyed by a hash of the stage inputs (see 'stage_key').
+
+    Outputs are pickled one file per key, written to a temporary file first so an interrupted
+    run never leaves a partial output. None is never cached, so stages that failed run again.
+    """
+
+    def __init__(self, directory: str = STAGE_CACHE_PATH, enabled: bool = True):
+        """
+        Args:
+            directory (str, optional): directory of the cached outputs. Defaults to STAGE_CACHE_PATH.
+            enabled (bool, optional): False runs every stage without reading or writing the cache. Defaults to True.
+        """
+        self.directory = directory
+        self.enabled = enabled
+
+    def path(self, stage: str, key: str) -> str:
+        return os.path.join(self.directory, stage, f"{key}.pkl")
+
+    def memoise(self, stage: str, inputs: dict, compute, valid=None):
+        """Output of a stage, read from the cache or computed and cached
+
+        Args:
+            stage (str): name of the stage
+            inputs (dict): inputs of the stage, see 'stage_key'
+            compute (Callable): computes the output when it is not cached
+            valid (Callable, optional): checks that a cached output can still be used, e.g. that
+                files it refers to exist. Defaults to None.
+
+        Returns:
+            output of the stage
+        """
+        if not self.enabled:
+            return compute()
+
+        output_path = self.path(stage, stage_key(stage, **inputs))
+        if os.path.exists(output_path):
+            try:
+                with open(output_path, 'rb') as f:
+                    output = pickle.load(f)
+                if valid is None or valid(output):
+                    run_metrics.increment(f'stage_cache_hits_{stage}')
+                    return output
+            except (OSError, pickle.UnpicklingError, EOFError) as e:
+                logger.error(f"Cached {stage} output {output_path} could not be read, recomputing. Reason: {e}")
+
+        run_metrics.increment(f'stage_cache_misses_{stage}')
+        output = compute()
+        if output is not None:
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            temporary_path = output_path + ".tmp"
+            with open(temporary_path, 'wb') as f:
+                pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_path, output_path)
+
+        return output
+
+
+class RunJournal:
+    """Journal of the planets a run has finished, so a run that died part way can resume from where
+    it stopped. A journal only resumes a run with the same run key, i.e. the same parameters, pubdat
+    snapshot and code version, that did not finish.
+    """
+
+    def __init__(self, run_key: str, journal_path: str = RUN_JOURNAL_PATH, resume: bool = True):
+        """
+        Args:
+            run_key (str): key of the run parameters, see 'stage_key'
+            journal_path (str, optional): path of the journal. Defaults to RUN_JOURNAL_PATH.
+            resume (bool, optional): False starts a new journal even if an unfinished one matches. Defaults to True.
+        """
+        self.journal_path = journal_path
+        self.journal = {'run_key': run_key, 'run_id': None, 'finished': False, 'planets': {}}
+
+        if resume and os.path.exists(journal_path):
+            try:
+                with open(journal_path, 'r') as f:
+                    journal = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.error(f"Run journal {journal_path} could not be read, starting a new one. Reason: {e}")
+            else:
+                if journal.get('run_key') == run_key and not journal.get('finished'):
+                    self.journal = journal
+                    logger.info(f"Resuming run {journal['run_id']}, {len(journal['planets'])} planets already done")
+
+    @property
+    def run_id(self) -> str:
+        """Result store run id of a resumed run, None for a new run"""
+        return self.journal['run_id']
+
+    @property
+    def planets(self) -> dict:
+        """Planets already done, with whether their catalogues were searched and their epoch and corrected position"""
+        return self.journal['planets']
+
+    def searched(self, planet: str) -> bool:
+        """Whether the catalogues of a planet already done were searched"""
+        record = self.journal['planets'][planet]
+
+        # journals written before positions were recorded only hold the flag
+        return record['searched'] if isinstance(record, dict) else bool(record)
+
+    def restore(self, planet: str, planets) -> None:
+        """Write the recorded epoch and corrected position of a planet already done back to the planet table
+
+        Args:
+            planet (str): planet name
+            planets (pd.DataFrame): planet table with 'pl_name', updated in place
+        """
+        record = self.journal['planets'][planet]
+        if not isinstance(record, dict):
+            return
+
+        rows = planets['pl_name'] == planet
+        for column in JOURNAL_POSITION_COLUMNS:
+            if record.get(column) is not None:
+                planets.loc[rows, column] = record[column]
+
+    def save(self) -> None:
+        """Write the journal atomically, so a crash while writing never corrupts it"""
+        os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+        temporary_path = self.journal_path + ".tmp"
+        with open(temporary_path, 'w') as f:
+            json.dump(self.journal, f, indent=1)
+        os.replace(temporary_path, self.journal_path)
+
+    def start(self, run_id: str) -> None:
+        """Record the result store run id the results of this run are stored under
+
+        Args:
+            run_id (str): run id from result_store.start_run
+        """
+        self.journal['run_id'] = run_id
+        self.save()
+
+    def complete(self, planet: str, searched: bool, position: dict = None) -> None:
+        """Record a planet as done
+
+        Args:
+            planet (str): planet name
+            searched (bool): whether its catalogues were searched, for the upper limits of the run
+            position (dict, optional): its JOURNAL_POSITION_COLUMNS, for the proper motion corrected
+                list and the upper limits of a resumed run. Defaults to None.
+        """
+        record = {'searched': searched}
+        for column, value in (position or {}).items():
+            record[column] = None if value is None else float(value)
+        self.journal['planets'][planet] = record
+        self.save()
+
+    def finish(self) -> None:
+        """Record the run as finished, the next run with the same key starts over"""
+        self.journal['finished'] = True
+        self.save()
@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+import pandas as pd
+from astropy.table import Table
+
+import run_metrics
+
+# Import the centralized logger
+from logger_config import logger
+
+
+STAGING_JOURNAL_PATH = os.path.join(os.path.dirname(__file__), "casda_staging", "staging_journal.json")
+
+# Staged CASDA files stay downloadable for a limited time, jobs older than this are requested again
+STAGING_LIFETIME = 2 * 24 * 3600 # seconds
+
+# Jobs still running after this long are given up and requested again, once
+STAGING_MAX_WAIT = 6 * 3600 # seconds
+
+# UWS phases of jobs that are still running and of jobs that finished successfully
+ACTIVE_PHASES = ('PENDING', 'QUEUED', 'EXECUTING', 'SUSPENDED')
+COMPLETED_PHASE = 'COMPLETED'
+
+UWS_NAMESPACE = "{http://www.ivoa.net/xml/UWS/v1.0}"
+XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+
+
+class StagingManager:
+    """Stages CASDA catalogues in the background and remembers the staging jobs across runs.
+
+    Every catalogue gets its own staging job. Job urls, phases and result urls are written to a
+    JSON journal as soon as they change, so after a crash completed jobs are reused while they are
+    still valid and running jobs are polled again instead of being requested from scratch.
+    """
+
+    def __init__(self, casda, journal_path: str = STAGING_JOURNAL_PATH, max_workers: int = 4,
+                 poll_interval: float = 20, lifetime: float = STAGING_LIFETIME, max_wait: float = STAGING_MAX_WAIT):
+        """
+        Args:
+            casda (Casda): logged in casda instance
+            journal_path (str, optional): path of the journal. Defaults to STAGING_JOURNAL_PATH.
+            max_workers (int, optional): number of jobs polled at the same time. Defaults to 4.
+            poll_interval (float, optional): seconds between polls of a running job. Defaults to 20.
+            lifetime (float, optional): seconds a job stays valid after it was submitted. Defaults to STAGING_LIFETIME.
+            max_wait (float, optional): seconds a job is polled before it is requested again. Defaults to STAGING_MAX_WAIT.
+        """
+        self.casda = casda
+        self.journal_path = journal_path
+        self.poll_interval = poll_interval
+        self.lifetime = lifetime
+        self.max_wait = max_wait
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.jobs = self.load_journal()
+
+    def load_journal(self) -> dict:
+        """Read the journal, dropping expired and failed jobs
+
+        Returns:
+            dict: catalogue filename to job record
+        """
+        if not os.path.exists(self.journal_path):
+            return {}
+
+        try:
+            with open(self.journal_path, 'r') as f:
+                jobs = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"Staging journal {self.journal_path} could not be read, starting a new one. Reason: {e}")
+            return {}
+
+        valid_jobs = {filename: job for filename, job in jobs.items() if self.is_valid(job)}
+        logger.info(f"Staging journal: reusing {len(valid_jobs)} of {len(jobs)} jobs")
+
+        return valid_jobs
+
+    def save_journal(self) -> None:
+        """Write the journal atomically, so a crash while writing never corrupts it"""
+        with self.lock:
+            os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+            temporary_path = self.journal_path + ".tmp"
+            with open(temporary_path, 'w') as f:
+                json.dump(self.jobs, f, indent=1)
+            os.replace(temporary_path, self.journal_path)
+
+    def is_valid(self, job: dict) -> bool:
+        """Whether a journalled job can still be used
+
+        Args:
+            job (dict): job record
+
+        Returns:
+            bool: True if the job has not expired and has not failed
+        """
+        return (time.time() - job['submitted'] < self.lifetime
+                and (job['phase'] == COMPLETED_PHASE or job['phase'] in ACTIVE_PHASES))
+
+    def update(self, filename: str, **fields) -> None:
+        """Change a job record and persist the journal
+
+        Args:
+            filename (str): catalogue filename
+            **fields: fields of the record to set
+        """
+        with self.lock:
+            self.jobs[filename] = {**self.jobs.get(filename, {}), **fields}
+        self.save_journal()
+
+    def job_phase(self, job_url: str) -> tuple:
+        """Current phase and result urls of a staging job
+
+        Args:
+            job_url (str): url of the UWS job
+
+        Returns:
+            phase (str): UWS phase of the job
+            urls (list): urls of the staged files, empty until the job completes
+        """
+        job_details = self.casda._get_job_details_xml(job_url)
+        phase = self.casda._read_job_status(job_details, False)
+
+        urls = []
+        results = job_details.find(f"{UWS_NAMESPACE}results")
+        if phase == COMPLETED_PHASE and results is not None:
+            urls = [unquote(result.get(XLINK_HREF)) for result in results.findall(f"{UWS_NAMESPACE}result")]
+
+        return phase, urls
+
+    def start_job(self, filename: str, catalogue_row: pd.DataFrame) -> str:
+        """Create the staging job of one catalogue, journal it and set it running
+
+        Args:
+            filename (str): catalogue filename
+            catalogue_row (pd.DataFrame): the catalogue's row of the public data table, with 'access_url'
+
+        Returns:
+            str: url of the UWS job
+        """
+        job_url = self.casda._create_job(Table.from_pandas(catalogue_row), 'async_service', False)
+        self.update(filename, job_url=job_url, phase='PENDING', submitted=time.time(), urls=[])
+        self.casda._request('POST', job_url + "/phase", data={'phase': 'RUN'}, cache=False)
+        run_metrics.increment('staging_jobs_submitted')
+
+        return job_url
+
+    def run_job(self, filename: str, catalogue_row: pd.DataFrame) -> list:
+        """Submit (or resume) the staging job of one catalogue and poll it until it finishes
+
+        A resumed job that is still pending, because the run that created it stopped before starting
+        it, is started again. A job that expires or keeps running longer than max_wait is requested
+        again once, after that the catalogue is given up.
+
+        Args:
+            filename (str): catalogue filename
+            catalogue_row (pd.DataFrame): the catalogue's row of the public data table, with 'access_url'
+
+        Returns:
+            list: urls of the staged files
+        """
+        job = self.jobs.get(filename)
+        resubmitted = False
+
+        if job is None:
+            job_url = self.start_job(filename, catalogue_row)
+            submitted = time.time()
+        else:
+            job_url, submitted = job['job_url'], job['submitted']
+            run_metrics.increment('staging_jobs_resumed')
+
+        polling_since = time.time()
+        phase, urls = self.job_phase(job_url)
+        if job is not None and phase == 'PENDING':
+            self.casda._request('POST', job_url + "/phase", data={'phase': 'RUN'}, cache=False)
+            run_metrics.increment('staging_jobs_restarted')
+
+        journalled_phase = 'PENDING' if job is None else job['phase']
+        while phase in ACTIVE_PHASES:
+            if phase != journalled_phase:
+                self.update(filename, phase=phase)
+                journalled_phase = phase
+
+            if time.time() - submitted >= self.lifetime or time.time() - polling_since > self.max_wait:
+                if resubmitted:
+                    raise TimeoutError(f"Staging job {job_url} for {filename} still {phase} after being requested again")
+                logger.warning(f"Staging job {job_url} for {filename} still {phase} after "
+                               f"{time.time() - polling_since:.0f} s, requesting it again")
+                job_url = self.start_job(filename, catalogue_row)
+                run_metrics.increment('staging_jobs_resubmitted')
+                resubmitted = True
+                submitted = polling_since = time.time()
+                journalled_phase = 'PENDING'
+
+            if self.stopped.wait(self.poll_interval):
+                # left in the journal as running, so the next run resumes polling it
+                raise InterruptedError(f"Staging manager closed while {filename} was staging")
+            phase, urls = self.job_phase(job_url)
+
+        self.update(filename, phase=phase, urls=urls, completed=time.time())
+        if phase != COMPLETED_PHASE:
+            raise ValueError(f"Staging job {job_url} for {filename} ended with phase {phase}")
+
+        return urls
+
+    def submit(self, catalogues: pd.DataFrame) -> None:
+        """Start staging catalogues in the background, without waiting for them
+
+        Args:
+            catalogues (pd.DataFrame): rows of the public data table with 'filename' and 'access_url'
+        """
+        n_submitted = 0
+        for filename, catalogue_row in catalogues.groupby('filename', sort=False):
+            job = self.jobs.get(filename)
+            if job is not None and not self.is_valid(job):
+                with self.lock:
+                    del self.jobs[filename]
+                job = None
+
+            if job is not None and job['phase'] == COMPLETED_PHASE:
+                run_metrics.increment('staging_jobs_reused')
+                continue
+            if filename in self.futures and not self.futures[filename].done():
+                continue
+
+            self.futures[filename] = self.executor.submit(self.run_job, filename, catalogue_row.head(1))
+            n_submitted += 1
+
+        if n_submitted:
+            logger.info(f"Staging {n_submitted} catalogues in the background")
+
+    def stage(self, catalogues: pd.DataFrame) -> list:
+        """Urls of staged catalogues, the blocking counterpart of 'submit'. Catalogues that are not
+        staged yet are submitted first, those already staged are returned straight from the journal.
+
+        Args:
+            catalogues (pd.DataFrame): rows of the public data table with 'filename' and 'access_url'
+
+        Returns:
+            list: urls of the staged files (checksum files included, as from casda.stage_data)
+        """
+        self.submit(catalogues)
+
+        url_list = []
+        for filename in catalogues['filename'].unique():
+            job = self.jobs.get(filename)
+            if job is not None and job['phase'] == COMPLETED_PHASE and self.is_valid(job):
+                urls = job['urls']
+            else:
+                try:
+                    urls = self.futures[filename].result()
+                except Exception as e:
+                    logger.error(f"Staging failed for {filename}. Reason: {e}")
+                    continue
+            url_list.extend(url for url in urls if url not in url_list)
+
+        return url_list
+
+    def invalidate(self, filenames) -> None:
+        """Forget the jobs of catalogues, e.g. when their urls no longer download
+
+        Args:
+            filenames (Iterable[str]): catalogue filenames
+        """
+        with self.lock:
+            for filename in filenames:
+                self.jobs.pop(filename, None)
+                self.futures.pop(filename, None)
+        self.save_journal()
+
+    def close(self) -> None:
+        """Stop polling, running jobs stay in the journal and are resumed by the next run"""
+        self.stopped.set()
+        self.executor.shutdown(wait=True, cancel_futures=True)
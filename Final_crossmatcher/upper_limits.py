@@ -0,0 +1,208 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from catalogue_cache import catalogue_cache
+from catalogue_parser import PARSE_ERRORS
+from false_association import FieldIndex
+from light_curves import CASDA_MATCHES_PATH, catalogue_basename, load_matches
+from sky_separation import search_around
+
+# Import the centralized logger
+from logger_config import logger
+
+
+CASDA_XML_DOWNLOAD_PATH = os.path.join(os.path.dirname(__file__), "casda_xml_downloads")
+
+# Catalogues whose centres are within this many degrees of a planet may cover it, as in casda_util.casda_search
+CATALOGUE_SEARCH_RADIUS = 3
+
+UPPER_LIMIT_COLUMNS = ['pl_name', 'source_filename', 'epoch', 'ra', 'dec', 'nearest_separation_arcsec',
+                       'n_neighbours', 'local_rms', 'rms_origin', 'upper_limit']
+
+
+def catalogue_rms(index: FieldIndex, rms: np.ndarray, ra, dec, k: int = 5, max_separation: float = 0.25):
+    """Local noise at many positions from the rms_image of their nearest catalogue components
+
+    Args:
+        index (FieldIndex): spatial index of the components of one catalogue
+        rms (np.ndarray): rms_image of the components, in index order
+        ra (ArrayLike): right ascension of the positions in degrees
+        dec (ArrayLike): declination of the positions in degrees
+        k (int, optional): number of nearest components averaged. Defaults to 5.
+        max_separation (float, optional): components further than this many degrees are not used, so
+            positions off the edge of the field get no estimate. Defaults to 0.25.
+
+    Returns:
+        local_rms (NDArray[float64]): median rms_image of the neighbours, NaN without any neighbour
+        nearest_separation (NDArray[float64]): separation of the nearest component in arcseconds
+        n_neighbours (NDArray[int64]): number of neighbours used
+    """
+    # a catalogue without components gives no neighbours anywhere
+    if index.n_components == 0:
+        n_positions = len(np.atleast_1d(ra))
+        return np.full(n_positions, np.nan), np.full(n_positions, np.nan), np.zeros(n_positions, dtype=np.int64)
+
+    separations, indices = index.nearest(ra, dec, k=min(k, index.n_components), max_distance=max_separation)
+    found = np.isfinite(separations)
+    neighbour_rms = np.where(found, np.append(rms, np.nan)[indices], np.nan)
+
+    has_neighbour = found.any(axis=1)
+    local_rms = np.full(len(found), np.nan)
+    local_rms[has_neighbour] = np.nanmedian(neighbour_rms[has_neighbour], axis=1)
+
+    return local_rms, separations[:, 0] * 3600, found.sum(axis=1)
+
+
+def map_rms(rms_path: str, ra, dec) -> np.ndarray:
+    """Noise at many positions read from a selavy rms map through memory mapping
+
+    Args:
+        rms_path (str): path of the rms map
+        ra (ArrayLike): right ascension of the positions in degrees
+        dec (ArrayLike): declination of the positions in degrees
+
+    Returns:
+        NDArray[float64]: rms in mJy/beam, NaN outside the map
+    """
+    # imported here as astropy is only needed when rms maps are given
+    from forced_photometry import MappedImage
+
+    with MappedImage(rms_path) as rms_image:
+        x, y = rms_image.world_to_pixel(np.atleast_1d(ra), np.atleast_1d(dec))
+        values = np.full(len(x), np.nan)
+        for i, (xi, yi) in enumerate(zip(x, y)):
+            if np.isfinite(xi) and np.isfinite(yi):
+                xc, yc = int(round(float(xi))), int(round(float(yi)))
+                region = rms_image.read_region(xc, xc + 1, yc, yc + 1)
+                if region.size:
+                    values[i] = region[0, 0]
+
+    return values
+
+
+def upper_limits(planets: pd.DataFrame, pubdat: pd.DataFrame, detections: pd.DataFrame = None,
+                 xml_path: str = CASDA_XML_DOWNLOAD_PATH, rms_maps: dict = None, n_sigma: float = 3,
+                 loader=None, **kwargs) -> pd.DataFrame:
+    """Upper limits for every planet and epoch without a detection
+
+    The catalogues near every planet are paired with one search over the catalogue centres, and
+    every downloaded catalogue is indexed once and queried for all the planets it covers in a single
+    batched nearest-neighbour query.
+
+    Args:
+        planets (pd.DataFrame): planets with 'pl_name' and 'ra'/'dec' (or proper motion corrected
+            'ra_corrected'/'dec_corrected') in degrees
+        pubdat (pd.DataFrame): CASDA public data table
+        detections (pd.DataFrame, optional): matches with 'planet' (name without spaces) and
+            'source_filename', whose planet-epochs are left out. Defaults to None.
+        xml_path (str, optional): directory of the downloaded catalogues. Defaults to casda_xml_downloads.
+        rms_maps (dict, optional): catalogue filename to the path of its rms map. The map is used
+            instead of the catalogue components where one exists. Defaults to None.
+        n_sigma (float, optional): upper limits are n_sigma times the local rms. Defaults to 3.
+        loader (Callable, optional): function converting a catalogue xml file to a DataFrame. Defaults
+            to casda_util.load_catalogue.
+        **kwargs: passed on to 'catalogue_rms'
+
+    Returns:
+        DataFrame: one row per planet and catalogue epoch without a detection, with the local rms and
+        the upper limit in mJy/beam. Both are NaN for catalogues that could not be read.
+    """
+    if loader is None:
+        # imported here so upper limits can be rebuilt without a CASDA session
+        from casda_util import load_catalogue as loader
+    rms_maps = rms_maps or {}
+
+    planet_ra = (planets['ra_corrected'].fillna(planets['ra']) if 'ra_corrected' in planets else planets['ra']).to_numpy(dtype=np.float64)
+    planet_dec = (planets['dec_corrected'].fillna(planets['dec']) if 'dec_corrected' in planets else planets['dec']).to_numpy(dtype=np.float64)
+    planet_names = planets['pl_name'].to_numpy()
+
+    # catalogues near any planet, from the same continuum catalogues casda_search downloads
+    catalogues = pubdat[pubdat['filename'].str.contains(r'.*.cont.taylor.0.restored.conv.components.xml$', regex=True)]
+    catalogues = catalogues.assign(basename=catalogue_basename(catalogues['filename'])).drop_duplicates('basename')
+    epochs = pd.Series(catalogues['t_max'].to_numpy(), index=catalogues['basename'])
+
+    centre_ra = catalogues['s_ra'].to_numpy(dtype=np.float64)
+    centre_dec = catalogues['s_dec'].to_numpy(dtype=np.float64)
+    planet_index, catalogue_index, _ = search_around(planet_ra, planet_dec, centre_ra, centre_dec, CATALOGUE_SEARCH_RADIUS)
+    planets_by_catalogue = pd.Series(planet_index).groupby(catalogue_index, sort=True)
+
+    detected = set()
+    if detections is not None and not detections.empty:
+        detected = set(zip(detections['planet'], catalogue_basename(detections['source_filename'])))
+
+    limit_dfs = []
+    for catalogue_position, covered in planets_by_catalogue:
+        basename = catalogues['basename'].iloc[catalogue_position]
+        xml_file = os.path.join(xml_path, basename)
+        if basename not in rms_maps and not os.path.exists(xml_file):
+            continue
+
+        covered = np.array([i for i in covered if (planet_names[i].replace(' ', ''), basename) not in detected], dtype=np.int64)
+        if covered.size == 0:
+            continue
+
+        ra, dec = planet_ra[covered], planet_dec[covered]
+        if basename in rms_maps:
+            local_rms = map_rms(rms_maps[basename], ra, dec)
+            nearest_separation, n_neighbours, rms_origin = np.nan, 0, 'map'
+        else:
+            try:
+                catalogue_df = catalogue_cache.get(xml_file, loader=loader)
+            except PARSE_ERRORS + (OSError,) as e:
+                # the planets were observed at this epoch, their limits stay unknown rather than being dropped
+                logger.error(f"Upper limits: catalogue {xml_file} could not be read. Reason: {e}")
+                catalogue_df = None
+
+            if catalogue_df is None:
+                local_rms, nearest_separation, n_neighbours, rms_origin = np.nan, np.nan, 0, 'unreadable'
+            else:
+                index = FieldIndex(catalogue_df['ra_deg_cont'].to_numpy(dtype=np.float64),
+                                   catalogue_df['dec_deg_cont'].to_numpy(dtype=np.float64))
+                local_rms, nearest_separation, n_neighbours = catalogue_rms(index, catalogue_df['rms_image'].to_numpy(dtype=np.float64),
+                                                                            ra, dec, **kwargs)
+                rms_origin = 'catalogue'
+
+        limit_dfs.append(pd.DataFrame({'pl_name': planet_names[covered], 'source_filename': basename,
+                                       'epoch': epochs[basename], 'ra': ra, 'dec': dec,
+                                       'nearest_separation_arcsec': nearest_separation,
+                                       'n_neighbours': n_neighbours, 'local_rms': local_rms,
+                                       'rms_origin': rms_origin, 'upper_limit': n_sigma * local_rms}))
+
+    if not limit_dfs:
+        return pd.DataFrame(columns=UPPER_LIMIT_COLUMNS)
+
+    limits = pd.concat(limit_dfs, ignore_index=True)
+    # planets outside the footprint of a catalogue within the catalogue search radius were not observed,
+    # those of unreadable catalogues keep a NaN limit
+    limits = limits[limits['local_rms'].notna() | (limits['rms_origin'] == 'unreadable')]
+
+    return limits.sort_values(['pl_name', 'epoch'], ignore_index=True)[UPPER_LIMIT_COLUMNS]
+
+
+def build_upper_limits(planets: pd.DataFrame, pubdat: pd.DataFrame = None, matches_path: str = CASDA_MATCHES_PATH,
+                       **kwargs) -> pd.DataFrame:
+    """Pipeline stage computing upper limits for all non-detections, saved as upper_limits.csv
+    next to the matches
+
+    Args:
+        planets (pd.DataFrame): planets with 'pl_name' and their positions
+        pubdat (pd.DataFrame, optional): CASDA public data table. Defaults to the cached pubdat.
+        matches_path (str, optional): directory of the match files. Defaults to casda_matches.
+        **kwargs: passed on to 'upper_limits'
+
+    Returns:
+        DataFrame: upper limits from 'upper_limits'
+    """
+    if pubdat is None:
+        from casda_util import get_public_data_table
+        pubdat = get_public_data_table()
+
+    limits = upper_limits(planets, pubdat, detections=load_matches(matches_path), **kwargs)
+
+    os.makedirs(matches_path, exist_ok=True)
+    limits.to_csv(os.path.join(matches_path, "upper_limits.csv"), index=False)
+    logger.info(f"Upper limits computed for {limits['pl_name'].nunique()} planets over {len(limits)} planet-epochs")
+
+    return limits